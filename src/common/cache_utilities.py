@@ -0,0 +1,127 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Module-level cache of clients, secrets and configuration, which survives between invocations of a warm lambda
+container. Entries expire after a TTL; call invalidate to drop them earlier.
+"""
+import copy
+import threading
+import time
+
+import thiscovery_lib.utilities as utils
+from thiscovery_lib.core_api_utilities import CoreApiClient
+from thiscovery_lib.dynamodb_utilities import Dynamodb
+from thiscovery_lib.s3_utilities import S3Client
+
+from common.constants import STACK_NAME, PROJECTS_TABLE
+
+
+CACHE_TTL = 300  # seconds
+
+_entries = dict()  # name: (expiry, value)
+_lock = threading.Lock()
+
+
+def get_or_create(name, factory, ttl=CACHE_TTL):
+    """
+    Args:
+        name (str): cache key
+        factory: callable that returns the value to cache if name is missing or has expired
+        ttl (int): number of seconds the value remains valid for
+
+    Returns:
+        Cached value
+    """
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(name)
+        if entry and (entry[0] > now):
+            return entry[1]
+    value = factory()
+    with _lock:
+        _entries[name] = (now + ttl, value)
+    return value
+
+
+def invalidate(name=None):
+    """
+    Drops name from cache, or all entries if name is None
+    """
+    with _lock:
+        if name is None:
+            _entries.clear()
+        else:
+            _entries.pop(name, None)
+
+
+def get_secret(secret_name, namespace_override=None):
+    return get_or_create(
+        f'secret:{namespace_override}:{secret_name}',
+        lambda: utils.get_secret(secret_name, namespace_override=namespace_override),
+    )
+
+
+def invalidate_secret(secret_name, namespace_override=None):
+    invalidate(f'secret:{namespace_override}:{secret_name}')
+
+
+def with_correlation_id(client, correlation_id):
+    """
+    Returns:
+        Shallow copy of a cached client with its own correlation_id; the copy shares the underlying boto3 client or
+        session, so cached clients are never mutated by callers with different correlation ids
+    """
+    client = copy.copy(client)
+    client.correlation_id = correlation_id
+    return client
+
+
+def get_ddb_client(correlation_id=None):
+    return with_correlation_id(get_or_create('ddb_client', lambda: Dynamodb(stack_name=STACK_NAME)), correlation_id)
+
+
+def get_s3_client():
+    return get_or_create('s3_client', S3Client)
+
+
+def get_media_convert_client():
+    from common.mediaconvert_utilities import MediaConvertClient  # mediaconvert_utilities uses this module's get_secret
+    return get_or_create('media_convert_client', MediaConvertClient)
+
+
+def get_core_api_client(correlation_id=None):
+    return with_correlation_id(get_or_create('core_api_client', CoreApiClient), correlation_id)
+
+
+def get_projects(filter_attr_name, filter_attr_values):
+    """
+    Returns:
+        Cached result of scanning PROJECTS_TABLE using the specified filter
+    """
+    return get_or_create(
+        f'projects:{filter_attr_name}:{filter_attr_values}',
+        lambda: get_ddb_client().scan(
+            table_name=PROJECTS_TABLE,
+            filter_attr_name=filter_attr_name,
+            filter_attr_values=filter_attr_values,
+        ),
+    )
+
+
+def get_active_projects():
+    return get_projects(filter_attr_name="interview_task_status", filter_attr_values=['active'])
@@ -1,4 +1,6 @@
 AUDIT_TABLE = 'FileTransferAudit'
+CHECKPOINTS_TABLE = 'MonitorCheckpoints'
 PROJECTS_TABLE = 'ResearchProjects'
 STACK_NAME = 's3-to-sdhs'
-STATUS_TABLE = 'FileTransferStatus'
\ No newline at end of file
+STATUS_TABLE = 'FileTransferStatus'
+STATUS_INDEX = 'processing-status-modified-index'  # GSI of STATUS_TABLE; processing_status (hash) and modified (range)
\ No newline at end of file
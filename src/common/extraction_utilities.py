@@ -0,0 +1,214 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import thiscovery_lib.utilities as utils
+
+from common.mediaconvert_utilities import AUDIO_EXTRACTION_SETTINGS
+
+
+FFMPEG_LAYER_PATH = '/opt/bin/ffmpeg'  # location of the binary in the ffmpeg lambda layer
+FFMPEG_TIMEOUT = 120  # seconds
+FFMPEG_MAX_CONCURRENCY = 2  # ffmpeg processes running at once in a lambda container; callers never wait for a slot
+PRESIGNED_URL_EXPIRY = 15 * 60  # seconds
+UPLOAD_PART_SIZE = 8 * 1024 * 1024  # bytes of ffmpeg output held in memory at a time; S3's minimum part size is 5 MiB
+# inputs up to these sizes (bytes) are extracted in-lambda with ffmpeg; larger ones are sent to MediaConvert
+FAST_PATH_MAX_VIDEO_SIZE = int(os.environ.get('FAST_PATH_MAX_VIDEO_SIZE', 50 * 1024 * 1024))
+FAST_PATH_MAX_AUDIO_SIZE = int(os.environ.get('FAST_PATH_MAX_AUDIO_SIZE', 200 * 1024 * 1024))
+
+_MP3_SETTINGS = AUDIO_EXTRACTION_SETTINGS["OutputGroups"][0]["Outputs"][0]["AudioDescriptions"][0]["CodecSettings"]["Mp3Settings"]
+
+
+def get_ffmpeg_path():
+    """
+    Returns:
+        Path of the ffmpeg binary set in the FFMPEG_PATH environment variable, on PATH or in the ffmpeg lambda layer;
+        None if ffmpeg is not available
+    """
+    for path in [os.environ.get('FFMPEG_PATH'), shutil.which('ffmpeg'), FFMPEG_LAYER_PATH]:
+        if path and os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+
+
+def get_audio_output_key(input_file_s3_key):
+    """
+    Returns:
+        Key of the .mp3 extracted from input_file_s3_key; the same key MediaConvert writes to (its $fn$ destination)
+    """
+    folders, filename = os.path.split(input_file_s3_key)
+    return f'{folders}/{os.path.splitext(filename)[0]}.mp3'
+
+
+class FfmpegAudioExtractor:
+    """
+    Extracts the audio of an S3 object with ffmpeg, inside the lambda. ffmpeg reads the input through a presigned URL,
+    issuing ranged GETs as it seeks (e.g. to the moov atom at the end of an MP4), so the input is never downloaded to
+    disk. Output is encoded with the same MP3 settings as MediaConvert jobs and streamed to the audio bucket as the parts
+    of a multipart upload, which is only completed once ffmpeg has exited successfully (and aborted otherwise), so a
+    failed extraction never publishes a truncated .mp3.
+    """
+    _semaphore = threading.BoundedSemaphore(FFMPEG_MAX_CONCURRENCY)
+
+    def __init__(self, s3_client, audio_bucket_name, ffmpeg_path=None, timeout=FFMPEG_TIMEOUT, logger=None):
+        """
+        Args:
+            s3_client (S3Client): thiscovery_lib S3Client instance
+            audio_bucket_name (str): bucket the .mp3 is written to
+            ffmpeg_path (str): path of ffmpeg binary; looked up with get_ffmpeg_path if not specified
+            timeout (int): seconds after which ffmpeg is killed
+            logger:
+        """
+        self.s3_client = s3_client
+        self.audio_bucket_name = audio_bucket_name
+        self.ffmpeg_path = ffmpeg_path or get_ffmpeg_path()
+        self.timeout = timeout
+        self.logger = logger
+        if logger is None:
+            self.logger = utils.get_logger()
+
+    @property
+    def available(self):
+        return self.ffmpeg_path is not None
+
+    def get_command(self, input_url):
+        return [
+            self.ffmpeg_path,
+            '-nostdin',
+            '-loglevel', 'error',
+            '-i', input_url,
+            '-map', '0:a:0',  # first audio stream, like MediaConvert's default audio selector
+            '-vn',
+            '-codec:a', 'libmp3lame',
+            '-b:a', str(_MP3_SETTINGS['Bitrate']),
+            '-ac', str(_MP3_SETTINGS['Channels']),
+            '-ar', str(_MP3_SETTINGS['SampleRate']),
+            '-f', 'mp3',
+            'pipe:1',
+        ]
+
+    def has_time_for_extraction(self, deadline):
+        return (deadline is None) or (deadline - time.monotonic() >= self.timeout)
+
+    def extract(self, input_bucket_name, input_file_s3_key, deadline=None):
+        """
+        Raises DetailedValueError without starting ffmpeg if all FFMPEG_MAX_CONCURRENCY slots are taken or if, once a
+        slot is acquired, ffmpeg could time out after deadline; callers then fall back to MediaConvert rather than wait.
+
+        Args:
+            input_bucket_name (str):
+            input_file_s3_key (str):
+            deadline (float): time.monotonic() value by which extraction must have finished
+
+        Returns:
+            Dict of output_key and output_size of the uploaded .mp3
+        """
+        if not self._semaphore.acquire(blocking=False):
+            raise utils.DetailedValueError('All ffmpeg slots are busy', details={
+                'input_file_s3_key': input_file_s3_key,
+                'max_concurrency': FFMPEG_MAX_CONCURRENCY,
+            })
+        try:
+            if not self.has_time_for_extraction(deadline):
+                raise utils.DetailedValueError('Not enough time left for ffmpeg audio extraction', details={
+                    'input_file_s3_key': input_file_s3_key,
+                    'timeout': self.timeout,
+                })
+            input_url = self.s3_client.client.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': input_bucket_name, 'Key': input_file_s3_key},
+                ExpiresIn=PRESIGNED_URL_EXPIRY,
+            )
+            output_key = get_audio_output_key(input_file_s3_key)
+            output_size = self.run_and_upload(self.get_command(input_url), input_file_s3_key, output_key)
+        finally:
+            self._semaphore.release()
+        self.logger.debug('Extracted audio with ffmpeg', extra={
+            'input_file_s3_key': input_file_s3_key,
+            'output_key': output_key,
+            'output_size': output_size,
+        })
+        return {'output_key': output_key, 'output_size': output_size}
+
+    def run_and_upload(self, command, input_file_s3_key, output_key):
+        """
+        Runs ffmpeg, uploading its stdout to output_key in UPLOAD_PART_SIZE parts as it is produced
+
+        Returns:
+            Size of the uploaded .mp3 in bytes
+        """
+        s3 = self.s3_client.client
+        upload_id = s3.create_multipart_upload(
+            Bucket=self.audio_bucket_name,
+            Key=output_key,
+            ContentType='audio/mpeg',
+        )['UploadId']
+        parts = list()
+        output_size = 0
+        # stderr goes to a file so that ffmpeg never blocks on a full pipe while stdout is being read
+        with tempfile.TemporaryFile() as stderr:
+            started = time.monotonic()
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+            timer = threading.Timer(self.timeout, process.kill)
+            timer.start()
+            try:
+                while True:
+                    chunk = process.stdout.read(UPLOAD_PART_SIZE)
+                    if not chunk:
+                        break
+                    response = s3.upload_part(
+                        Bucket=self.audio_bucket_name,
+                        Key=output_key,
+                        UploadId=upload_id,
+                        PartNumber=len(parts) + 1,
+                        Body=chunk,
+                    )
+                    parts.append({'PartNumber': len(parts) + 1, 'ETag': response['ETag']})
+                    output_size += len(chunk)
+                returncode = process.wait()
+                timed_out = time.monotonic() - started >= self.timeout
+                if returncode or (not output_size):
+                    stderr.seek(0)
+                    raise utils.DetailedValueError(
+                        'ffmpeg audio extraction timed out' if timed_out else 'ffmpeg audio extraction failed',
+                        details={
+                            'input_file_s3_key': input_file_s3_key,
+                            'returncode': returncode,
+                            'timeout': self.timeout,
+                            'stderr': stderr.read().decode('utf-8', errors='replace')[-2000:],
+                        }
+                    )
+                s3.complete_multipart_upload(
+                    Bucket=self.audio_bucket_name,
+                    Key=output_key,
+                    UploadId=upload_id,
+                    MultipartUpload={'Parts': parts},
+                )
+            except BaseException:
+                process.kill()
+                process.wait()
+                s3.abort_multipart_upload(Bucket=self.audio_bucket_name, Key=output_key, UploadId=upload_id)
+                raise
+            finally:
+                timer.cancel()
+                process.stdout.close()
+        return output_size
@@ -15,26 +15,40 @@
 #   A copy of the GNU Affero General Public License is available in the
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
+import json
 import os
 import paramiko
 import pysftp
 import thiscovery_lib.utilities as utils
+import common.cache_utilities as cache
+from common.constants import STATUS_INDEX, STATUS_TABLE
+from common.sftp_utilities import parse_transfer_tuning
 from base64 import decodebytes
-from dateutil import parser
+from boto3.dynamodb.conditions import Key
+from collections import namedtuple
+from dateutil import parser, tz
+from types import MappingProxyType
+from urllib.parse import unquote_plus
 
 
 def get_appointment_datetime(appointment_dict, output_format='%Y-%m-%d %H:%M'):
     return parser.parse(appointment_dict['acuity_info']['datetime']).strftime(output_format)
 
 
-def get_sftp_parameters(project_acronym, correlation_id=None):
-    sdhs_secret = utils.get_secret("sdhs-connection")
-    project_params = sdhs_secret['project_specific_parameters'].get(project_acronym)
-    if project_params is None:
-        raise utils.ObjectDoesNotExistError(f'Could not find SDHS parameters for project', details={
-            'project_acronym': project_acronym,
-            'correlation_id': correlation_id
-        })
+SftpProfile = namedtuple('SftpProfile', ['project_acronym', 'connection_params', 'target_folder', 'cnopts', 'tuning'])
+
+
+def parse_sftp_profile(project_acronym, project_params, sdhs_secret):
+    """
+    Args:
+        project_acronym (str): project the profile belongs to
+        project_params (dict): project-specific parameters from sdhs-connection secret
+        sdhs_secret (dict): sdhs-connection secret, whose top-level parameters apply to projects that do not override them
+
+    Returns:
+        SftpProfile, whose connection_params is a read-only mapping of pysftp.Connection keyword arguments and whose
+        tuning is the TransferTuning of the project
+    """
     target_folder = project_params['folder']
     sdhs_params = dict()
     for param_name in ['host', 'port', 'hostkey', 'hostkey_type', 'username', 'password']:
@@ -59,7 +73,195 @@ def get_sftp_parameters(project_acronym, correlation_id=None):
     cnopts.hostkeys.add(sdhs_params['host'], sdhs_params['hostkey_type'], host_key)
     del sdhs_params['hostkey']
     del sdhs_params['hostkey_type']
-    return sdhs_params, target_folder, cnopts
+    return SftpProfile(
+        project_acronym=project_acronym,
+        connection_params=MappingProxyType(sdhs_params),
+        target_folder=target_folder,
+        cnopts=cnopts,
+        tuning=parse_transfer_tuning(project_params, sdhs_secret),
+    )
+
+
+class SftpProfileRegistry:
+    """
+    Loads the sdhs-connection secret once and parses the SFTP connection profiles of all projects up front; profiles are
+    kept in the warm container cache and reloaded from Secrets Manager after ttl seconds
+    """
+    CACHE_KEY = 'sftp_profiles'
+
+    def __init__(self, ttl=cache.CACHE_TTL):
+        self.ttl = ttl
+
+    @staticmethod
+    def _load_profiles():
+        sdhs_secret = utils.get_secret("sdhs-connection")
+        profiles = dict()
+        for project_acronym, project_params in sdhs_secret['project_specific_parameters'].items():
+            try:
+                profiles[project_acronym] = parse_sftp_profile(project_acronym, project_params, sdhs_secret)
+            except Exception as err:
+                # a misconfigured project must not prevent transfers of other projects; error is raised on request
+                profiles[project_acronym] = err
+        return profiles
+
+    def get_profile(self, project_acronym, correlation_id=None):
+        """
+        Returns:
+            SftpProfile of project_acronym
+        """
+        profile = cache.get_or_create(self.CACHE_KEY, self._load_profiles, ttl=self.ttl).get(project_acronym)
+        if profile is None:
+            raise utils.ObjectDoesNotExistError(f'Could not find SDHS parameters for project', details={
+                'project_acronym': project_acronym,
+                'correlation_id': correlation_id
+            })
+        if isinstance(profile, Exception):
+            raise profile
+        return profile
+
+    def refresh(self):
+        cache.invalidate(self.CACHE_KEY)
+
+
+sftp_profile_registry = SftpProfileRegistry()
+
+
+def get_sftp_parameters(project_acronym, correlation_id=None):
+    profile = sftp_profile_registry.get_profile(project_acronym, correlation_id=correlation_id)
+    return dict(profile.connection_params), profile.target_folder, profile.cnopts
+
+
+def iter_ddb_items(table_method, **kwargs):
+    """
+    Pages through the results of a boto3 DynamoDB Table scan or query, one page at a time
+
+    Args:
+        table_method: bound method of a boto3 Table resource (e.g. table.scan or table.query)
+        **kwargs: request parameters (e.g. ProjectionExpression, KeyConditionExpression)
+
+    Yields:
+        Items
+    """
+    while True:
+        response = table_method(**kwargs)
+        for item in response['Items']:
+            yield item
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def format_ddb_timestamp(timestamp):
+    """
+    Formats a timezone-aware datetime like the modified attribute that thiscovery_lib's Dynamodb client writes, so
+    that it can be compared with it as a string in key conditions
+    """
+    return str(timestamp.astimezone(tz.tzutc()))
+
+
+def update_item_if_status(ddb_client, key, processing_status, name_value_pairs):
+    """
+    Updates an item of STATUS_TABLE only if its processing_status is still processing_status, so that a status set by
+    another function in the meantime is not reverted
+
+    Args:
+        ddb_client (Dynamodb): thiscovery_lib Dynamodb client
+        key (str): status table key
+        processing_status (str): expected current processing_status of the item
+        name_value_pairs (dict): attributes to set; modified is set too, as thiscovery_lib's update_item does
+
+    Returns:
+        update_item response if the item was updated; None if its processing_status had changed
+    """
+    name_value_pairs = {**name_value_pairs, 'modified': format_ddb_timestamp(utils.now_with_tz())}
+    names = list(name_value_pairs.keys())
+    status_table = ddb_client.get_table(STATUS_TABLE)
+    try:
+        return status_table.update_item(
+            Key={'id': key},
+            UpdateExpression='SET ' + ', '.join(f'#n{i} = :v{i}' for i in range(len(names))),
+            ConditionExpression='#processing_status = :expected_status',
+            ExpressionAttributeNames={
+                '#processing_status': 'processing_status',
+                **{f'#n{i}': x for i, x in enumerate(names)},
+            },
+            ExpressionAttributeValues={
+                ':expected_status': processing_status,
+                **{f':v{i}': name_value_pairs[x] for i, x in enumerate(names)},
+            },
+        )
+    except status_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return None
+
+
+def iter_items_by_status(ddb_client, processing_status, modified_after=None, modified_before=None, **kwargs):
+    """
+    Pages through the items of STATUS_TABLE that have processing_status, using STATUS_INDEX, so that only matching items
+    are read (and billed)
+
+    Args:
+        ddb_client (Dynamodb): thiscovery_lib Dynamodb client
+        processing_status (str): e.g. 'new' or 'processed'
+        modified_after (datetime.datetime): if specified, only items modified at or after this time are returned
+        modified_before (datetime.datetime): if specified, only items modified before this time are returned
+        **kwargs: additional query parameters (e.g. ProjectionExpression)
+
+    Yields:
+        Items, in ascending order of modified
+    """
+    key_condition = Key('processing_status').eq(processing_status)
+    if modified_after and modified_before:
+        # BETWEEN is inclusive of both bounds
+        key_condition &= Key('modified').between(format_ddb_timestamp(modified_after), format_ddb_timestamp(modified_before))
+    elif modified_after:
+        key_condition &= Key('modified').gte(format_ddb_timestamp(modified_after))
+    elif modified_before:
+        key_condition &= Key('modified').lt(format_ddb_timestamp(modified_before))
+    status_table = ddb_client.get_table(STATUS_TABLE)
+    return iter_ddb_items(status_table.query, IndexName=STATUS_INDEX, KeyConditionExpression=key_condition, **kwargs)
+
+
+def iter_s3_event_records(event):
+    """
+    Unpacks S3 event notifications delivered to a lambda either directly by S3 or wrapped in SQS messages
+
+    Args:
+        event (dict): lambda event
+
+    Yields:
+        (sqs_message_id, s3_bucket_name, s3_key) tuples; sqs_message_id is None for records delivered directly by S3
+    """
+    for record in event.get('Records', list()):
+        if record.get('eventSource') == 'aws:sqs':
+            message_id = record['messageId']
+            s3_records = json.loads(record['body']).get('Records', list())  # s3:TestEvent messages have no Records
+        else:
+            message_id = None
+            s3_records = [record]
+        for s3_record in s3_records:
+            s3 = s3_record['s3']
+            yield message_id, s3['bucket']['name'], unquote_plus(s3['object']['key'])
+
+
+def iter_s3_objects(s3_client, s3_bucket_name, page_size=1000, **kwargs):
+    """
+    Lazily walks the contents of an S3 bucket, fetching one list_objects_v2 page at a time, so that
+    callers can start working on the first page before the rest of the bucket has been listed
+
+    Args:
+        s3_client (S3Client): thiscovery_lib S3Client instance
+        s3_bucket_name (str): name of the bucket to walk
+        page_size (int): maximum number of keys requested per page (1000 is the S3 maximum)
+        **kwargs: extra list_objects_v2 parameters (e.g. Prefix, StartAfter)
+
+    Yields:
+        Object summaries (dicts containing Key, LastModified, Size, ETag, etc) in key order
+    """
+    paginator = s3_client.client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=s3_bucket_name, PaginationConfig={'PageSize': page_size}, **kwargs)
+    for page in pages:
+        for obj in page.get('Contents', list()):
+            yield obj
 
 
 def parse_s3_path(s3_path):
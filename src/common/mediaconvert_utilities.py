@@ -16,13 +16,147 @@
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
 import os
+import random
+import threading
+import time
+import uuid
 from http import HTTPStatus
 
 import thiscovery_lib.utilities as utils
+from botocore.exceptions import ClientError
+import common.cache_utilities as cache
 from common.constants import STACK_NAME
 
 
 ENDPOINT_SECRET_NAME = "media-convert-endpoint"
+CREATE_JOB_TPS = 10  # requests per second; kept below MediaConvert's CreateJob quota to leave headroom for other callers
+CREATE_JOB_BURST = 10
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_CAP = 20  # seconds
+BACKOFF_MAX_ATTEMPTS = 6
+THROTTLING_ERROR_CODES = ['TooManyRequestsException']
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket; acquire blocks until a token is available
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        Args:
+            rate (float): tokens added per second
+            capacity (int): maximum number of tokens, i.e. the largest burst allowed
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# Settings of audio extraction jobs, built once per container. Per-job input and destination are patched in by
+# MediaConvertClient.get_audio_extraction_settings. ExtractAudioJobTemplate in template.yaml is not used because its
+# output settings (192 kbps stereo, fixed destination) differ from these.
+AUDIO_EXTRACTION_SETTINGS = {
+    "OutputGroups": [
+        {
+            "Name": "File Group",
+            "Outputs": [
+                {
+                    "ContainerSettings": {
+                        "Container": "RAW"
+                    },
+                    "AudioDescriptions": [
+                        {
+                            "AudioTypeControl": "FOLLOW_INPUT",
+                            "AudioSourceName": "Audio Selector 1",
+                            "CodecSettings": {
+                                "Codec": "MP3",
+                                "Mp3Settings": {
+                                    "Bitrate": 64000,
+                                    "Channels": 1,
+                                    "RateControlMode": "CBR",
+                                    "SampleRate": 44100,
+                                }
+                            },
+                            "LanguageCodeControl": "FOLLOW_INPUT"
+                        }
+                    ]
+                }
+            ],
+            "OutputGroupSettings": {
+                "Type": "FILE_GROUP_SETTINGS",
+                "FileGroupSettings": {
+                    "Destination": None  # set for each job
+                }
+            }
+        }
+    ],
+    "AdAvailOffset": 0,
+    "Inputs": [
+        {
+            "AudioSelectors": {
+                "Audio Selector 1": {
+                    "Offset": 0,
+                    "DefaultSelection": "DEFAULT",
+                    "ProgramSelection": 1
+                }
+            },
+            "FilterEnable": "AUTO",
+            "PsiControl": "USE_PSI",
+            "FilterStrength": 0,
+            "DeblockFilter": "DISABLED",
+            "DenoiseFilter": "DISABLED",
+            "TimecodeSource": "EMBEDDED",
+            "FileInput": None  # set for each job
+        }
+    ]
+}
+
+
+create_job_rate_limiter = TokenBucket(rate=CREATE_JOB_TPS, capacity=CREATE_JOB_BURST)
+
+
+def call_with_backoff(function, *args, rate_limiter=None, max_attempts=BACKOFF_MAX_ATTEMPTS, **kwargs):
+    """
+    Calls function, retrying with exponential backoff and full jitter if AWS throttles the request
+
+    Args:
+        function: boto3 client method
+        rate_limiter (TokenBucket): if specified, a token is acquired before each attempt
+        max_attempts (int): number of attempts before the throttling error is raised
+    """
+    for attempt in range(max_attempts):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            return function(*args, **kwargs)
+        except ClientError as err:
+            if (err.response['Error']['Code'] not in THROTTLING_ERROR_CODES) or (attempt == max_attempts - 1):
+                raise
+            time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+
+
+def get_client_request_token(input_file_s3_key, attempt):
+    """
+    Idempotency token of a job submission. MediaConvert only de-duplicates requests with the same token for about a
+    minute, so this guards against retries of the same CreateJob call, not against resubmissions by a later run; those
+    are detected with the submission marker written to the status item (see ProcessIncoming.find_submitted_job)
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f'{STACK_NAME}/{input_file_s3_key}#{attempt}'))
 
 
 class MediaConvertClient(utils.BaseClient):
@@ -31,12 +165,14 @@ class MediaConvertClient(utils.BaseClient):
         if endpoint_url is None:
             super().__init__('mediaconvert', profile_name=profile_name)
         elif endpoint_url == 'default':
-            secret_endpoint_url = utils.get_secret(ENDPOINT_SECRET_NAME)['Url']
+            secret_endpoint_url = cache.get_secret(ENDPOINT_SECRET_NAME)['Url']
             super().__init__('mediaconvert', profile_name=profile_name, endpoint_url=secret_endpoint_url)
         else:
             super().__init__('mediaconvert', profile_name=profile_name, endpoint_url=endpoint_url)
         self.sm_client = None
         self.env_name = utils.get_environment_name()
+        self.audio_bucket_name = f"{STACK_NAME}-{self.env_name}-interview-audio"
+        self._role_arn = None
 
     def describe_endpoints(self, **kwargs):
         """
@@ -51,67 +187,48 @@ class MediaConvertClient(utils.BaseClient):
         if self.sm_client is None:
             self.sm_client = utils.SecretsManager()
         self.sm_client.create_or_update_secret(ENDPOINT_SECRET_NAME, first_endpoint)
+        cache.invalidate_secret(ENDPOINT_SECRET_NAME)
+
+    @property
+    def role_arn(self):
+        """
+        ARN of the role MediaConvert jobs run as; resolved once per client, i.e. once per container
+        """
+        if self._role_arn is None:
+            aws_account_number = cache.get_secret('aws-account')['number']
+            self._role_arn = f"arn:aws:iam::{aws_account_number}:role/MediaConvert_Default_Role"
+        return self._role_arn
+
+    @staticmethod
+    def get_audio_extraction_settings(input_file_url, destination_url):
+        """
+        Returns job settings for input_file_url, sharing all but the patched input and destination dicts with
+        AUDIO_EXTRACTION_SETTINGS, so that only a handful of small dicts are built for each job
+        """
+        output_group = AUDIO_EXTRACTION_SETTINGS["OutputGroups"][0]
+        input_settings = AUDIO_EXTRACTION_SETTINGS["Inputs"][0]
+        return {
+            **AUDIO_EXTRACTION_SETTINGS,
+            "OutputGroups": [{
+                **output_group,
+                "OutputGroupSettings": {
+                    **output_group["OutputGroupSettings"],
+                    "FileGroupSettings": {"Destination": destination_url},
+                },
+            }],
+            "Inputs": [{**input_settings, "FileInput": input_file_url}],
+        }
 
     def create_audio_extraction_job(self, input_bucket_name, input_file_s3_key, **kwargs):
         folders = os.path.split(input_file_s3_key)[0]
-        aws_account_number = utils.get_secret('aws-account')['number']
-        response = self.client.create_job(
-            Role=f"arn:aws:iam::{aws_account_number}:role/MediaConvert_Default_Role",
-            Settings={
-                "OutputGroups": [
-                    {
-                        "Name": "File Group",
-                        "Outputs": [
-                            {
-                                "ContainerSettings": {
-                                    "Container": "RAW"
-                                },
-                                "AudioDescriptions": [
-                                    {
-                                        "AudioTypeControl": "FOLLOW_INPUT",
-                                        "AudioSourceName": "Audio Selector 1",
-                                        "CodecSettings": {
-                                            "Codec": "MP3",
-                                            "Mp3Settings": {
-                                                "Bitrate": 64000,
-                                                "Channels": 1,
-                                                "RateControlMode": "CBR",
-                                                "SampleRate": 44100,
-                                            }
-                                        },
-                                        "LanguageCodeControl": "FOLLOW_INPUT"
-                                    }
-                                ]
-                            }
-                        ],
-                        "OutputGroupSettings": {
-                            "Type": "FILE_GROUP_SETTINGS",
-                            "FileGroupSettings": {
-                                "Destination": f"s3://{STACK_NAME}-{self.env_name}-interview-audio/{folders}/$fn$"
-                            }
-                        }
-                    }
-                ],
-                "AdAvailOffset": 0,
-                "Inputs": [
-                    {
-                        "AudioSelectors": {
-                            "Audio Selector 1": {
-                                "Offset": 0,
-                                "DefaultSelection": "DEFAULT",
-                                "ProgramSelection": 1
-                            }
-                        },
-                        "FilterEnable": "AUTO",
-                        "PsiControl": "USE_PSI",
-                        "FilterStrength": 0,
-                        "DeblockFilter": "DISABLED",
-                        "DenoiseFilter": "DISABLED",
-                        "TimecodeSource": "EMBEDDED",
-                        "FileInput": f"s3://{input_bucket_name}/{input_file_s3_key}"
-                    }
-                ]
-            },
+        response = call_with_backoff(
+            self.client.create_job,
+            rate_limiter=create_job_rate_limiter,
+            Role=self.role_arn,
+            Settings=self.get_audio_extraction_settings(
+                input_file_url=f"s3://{input_bucket_name}/{input_file_s3_key}",
+                destination_url=f"s3://{self.audio_bucket_name}/{folders}/$fn$",
+            ),
             StatusUpdateInterval="SECONDS_60",
             **kwargs
         )
@@ -123,6 +240,25 @@ class MediaConvertClient(utils.BaseClient):
         assert response['ResponseMetadata']['HTTPStatusCode'] == HTTPStatus.OK, f'MediaConvert list_jobs call failed with response: {response}'
         return response
 
+    def iter_jobs(self, created_after, **kwargs):
+        """
+        Pages through jobs, newest first, stopping at the first job created before created_after
+
+        Args:
+            created_after (datetime): timezone-aware datetime
+            **kwargs: passed to list_jobs (e.g. Status)
+        """
+        kwargs = {'Order': 'DESCENDING', 'MaxResults': 20, **kwargs}
+        while True:
+            response = call_with_backoff(self.list_jobs, **kwargs)
+            for job in response['Jobs']:
+                if job['CreatedAt'] < created_after:
+                    return
+                yield job
+            if 'NextToken' not in response:
+                return
+            kwargs['NextToken'] = response['NextToken']
+
 
 if __name__ == '__main__':
     mediaconvert_client = MediaConvertClient(endpoint_url=None)
@@ -0,0 +1,298 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import math
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import pysftp
+import thiscovery_lib.utilities as utils
+
+
+SFTP_MAX_CONNECTIONS_PER_HOST = 4
+SFTP_MAX_IDLE_SECONDS = 240  # idle connections older than this are closed rather than health-checked
+SFTP_HEALTH_CHECK_TIMEOUT = 10  # seconds
+PARTIAL_SUFFIX = '.partial'
+PARTIAL_MAX_AGE = 24 * 60 * 60  # seconds; older partial files are assumed to be left over from crashed transfers
+
+SFTP_PIPELINE_DEPTH = 100  # paramiko's SFTPFile waits for acknowledgements once this many pipelined writes are outstanding
+SFTP_MIN_REQUEST_SIZE = 32 * 1024  # paramiko default
+SFTP_MAX_MESSAGE_SIZE = 256 * 1024  # maximum SFTP message length accepted by OpenSSH's sftp-server
+SFTP_REQUEST_OVERHEAD = 1024  # bytes of each SFTP message reserved for write request headers
+SFTP_MAX_REQUEST_SIZE = SFTP_MAX_MESSAGE_SIZE - SFTP_REQUEST_OVERHEAD
+SFTP_RTT_SAMPLES = 3
+
+# Only settings that affect uploads are exposed. The SSH window that limits data in flight on an upload is the one
+# advertised by the server, which the client cannot change, so the client's own window and packet sizes are left alone.
+TransferTuning = namedtuple('TransferTuning', ['request_size', 'pipelined', 'prefetch', 'auto_tune', 'bandwidth'])
+
+DEFAULT_TRANSFER_TUNING = TransferTuning(
+    request_size=SFTP_MIN_REQUEST_SIZE,
+    pipelined=True,
+    prefetch=True,
+    auto_tune=False,
+    bandwidth=100 * 1000 * 1000 // 8,  # bytes per second; used by auto_tune to estimate the bandwidth-delay product
+)
+
+
+def parse_transfer_tuning(project_params, sdhs_secret):
+    """
+    Reads the transfer_profile of a project in the sdhs-connection secret, e.g.
+        {"request_size": 131072, "pipelined": true, "prefetch": true, "auto_tune": false}
+    Parameters missing from the project's transfer_profile are read from the top-level transfer_profile of the secret,
+    and then from DEFAULT_TRANSFER_TUNING.
+
+    Returns:
+        TransferTuning
+    """
+    tuning_params = dict(DEFAULT_TRANSFER_TUNING._asdict())
+    for params in [sdhs_secret.get('transfer_profile', dict()), project_params.get('transfer_profile', dict())]:
+        unknown_params = set(params.keys()) - set(TransferTuning._fields)
+        if unknown_params:
+            raise utils.DetailedValueError('Unknown transfer_profile parameters', details={'unknown_params': list(unknown_params)})
+        tuning_params.update(params)
+    for param_name in ['request_size', 'bandwidth']:
+        tuning_params[param_name] = int(tuning_params[param_name])
+    tuning_params['request_size'] = min(max(tuning_params['request_size'], SFTP_MIN_REQUEST_SIZE), SFTP_MAX_REQUEST_SIZE)
+    return TransferTuning(**tuning_params)
+
+
+def measure_rtt(transport, samples=SFTP_RTT_SAMPLES):
+    """
+    Returns:
+        Shortest round-trip time in seconds of a few keepalive global requests, which the server answers without doing
+        any work
+    """
+    rtts = list()
+    for _ in range(samples):
+        start = time.perf_counter()
+        transport.global_request('keepalive@openssh.com', wait=True)
+        rtts.append(time.perf_counter() - start)
+    return min(rtts)
+
+
+def auto_tune(tuning, rtt):
+    """
+    Sizes SFTP write requests so that SFTP_PIPELINE_DEPTH pipelined requests cover the bandwidth-delay product. This
+    reduces the number of requests paramiko has to wait on; the data actually in flight is still capped by the window
+    the server advertises, so throughput is only improved up to that limit.
+
+    Args:
+        tuning (TransferTuning): profile whose bandwidth is used in the calculation
+        rtt (float): round-trip time in seconds
+
+    Returns:
+        TransferTuning with request_size replaced and pipelining enabled
+    """
+    request_size = math.ceil(tuning.bandwidth * rtt / SFTP_PIPELINE_DEPTH)
+    return tuning._replace(
+        request_size=min(max(request_size, SFTP_MIN_REQUEST_SIZE), SFTP_MAX_REQUEST_SIZE),
+        pipelined=True,
+    )
+
+
+def get_effective_tuning(transport, tuning, logger=None):
+    """
+    Returns:
+        tuning, auto-tuned from the round-trip time of transport if tuning.auto_tune is set
+    """
+    if not tuning.auto_tune:
+        return tuning
+    rtt = measure_rtt(transport)
+    tuning = auto_tune(tuning, rtt)
+    if logger is not None:
+        logger.debug('Auto-tuned SFTP transfer profile', extra={'rtt': rtt, 'tuning': tuning._asdict()})
+    return tuning
+
+
+def tune_file(sftp_file, tuning):
+    """
+    Applies pipelining and SFTP request size to an open paramiko.SFTPFile
+    """
+    sftp_file.set_pipelined(tuning.pipelined)
+    sftp_file.MAX_REQUEST_SIZE = tuning.request_size
+    return sftp_file
+
+
+class SftpConnectionPool:
+    """
+    Pool of authenticated SFTP sessions, keyed by (host, port, username, folder). Being module-level, the pool
+    survives between invocations of a warm lambda container. Idle sessions are health-checked with a stat of
+    their working directory before being reused, and the number of concurrent sessions per host is capped.
+    """
+
+    def __init__(self, max_connections_per_host=SFTP_MAX_CONNECTIONS_PER_HOST, logger=None):
+        self.max_connections_per_host = max_connections_per_host
+        self.logger = logger
+        if logger is None:
+            self.logger = utils.get_logger()
+        self._idle = dict()  # key: list of (last_used, connection) tuples
+        self._host_semaphores = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(profile):
+        params = profile.connection_params
+        return params['host'], params['port'], params['username'], profile.target_folder
+
+    def _get_host_semaphore(self, host):
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return self._host_semaphores[host]
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def is_healthy(connection):
+        channel = connection.sftp_client.get_channel()
+        try:
+            channel.settimeout(SFTP_HEALTH_CHECK_TIMEOUT)
+            connection.stat('.')
+            return True
+        except Exception:
+            return False
+        finally:
+            try:
+                channel.settimeout(None)
+            except Exception:
+                pass
+
+    def _checkout(self, key, profile):
+        while True:
+            with self._lock:
+                idle_connections = self._idle.get(key)
+                if not idle_connections:
+                    break
+                last_used, connection = idle_connections.pop()
+            if (time.monotonic() - last_used < SFTP_MAX_IDLE_SECONDS) and self.is_healthy(connection):
+                self.logger.debug('Reusing SFTP connection', extra={'host': key[0], 'folder': key[3]})
+                return connection
+            self._close(connection)
+
+        self.logger.debug('Opening SFTP connection', extra={'host': key[0], 'folder': key[3]})
+        connection = pysftp.Connection(**profile.connection_params, cnopts=profile.cnopts)
+        try:
+            connection.transfer_tuning = get_effective_tuning(
+                connection.sftp_client.get_channel().get_transport(), profile.tuning, self.logger)
+            connection.chdir(profile.target_folder)
+        except BaseException:
+            self._close(connection)
+            raise
+        return connection
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            self._idle.setdefault(key, list()).append((time.monotonic(), connection))
+
+    @contextmanager
+    def connection(self, profile):
+        """
+        Context manager yielding a pysftp.Connection whose working directory is profile.target_folder. The effective
+        TransferTuning of the session is available as its transfer_tuning attribute. Sessions are returned to the pool
+        on exit, unless an exception was raised, in which case they are closed.
+
+        Args:
+            profile (SftpProfile): connection profile, as returned by SftpProfileRegistry.get_profile
+        """
+        key = self.get_key(profile)
+        semaphore = self._get_host_semaphore(key[0])
+        with semaphore:
+            connection = self._checkout(key, profile)
+            try:
+                yield connection
+            except BaseException:
+                self._close(connection)
+                raise
+            self._checkin(key, connection)
+
+    def close_all(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = dict()
+        for connections in idle.values():
+            for _, connection in connections:
+                self._close(connection)
+
+
+def get_partial_filename(target_filename, attempt_id):
+    """
+    Returns:
+        Name of the partial file written by one transfer attempt; each attempt writes its own, so concurrent transfers
+        of the same file never write to, rename or delete each other's partial files
+    """
+    return f'{target_filename}.{attempt_id}{PARTIAL_SUFFIX}'
+
+
+def is_unsupported_operation(err):
+    """
+    Returns:
+        True if err is paramiko's IOError for an SSH_FX_OP_UNSUPPORTED status, i.e. the server does not implement the
+        request (paramiko raises it without an errno, with the server's message or the "Operation unsupported" default)
+    """
+    return (err.errno is None) and ('unsupported' in str(err).lower())
+
+
+def rename(sftp_client, source, target):
+    """
+    Renames source to target, replacing target if it exists. Uses the posix-rename@openssh.com extension, which is
+    atomic; only if the server does not support it is target removed before a plain SFTP rename (which fails if target
+    exists). Any other error is raised, so that a failed rename never removes a good target file.
+    """
+    try:
+        sftp_client.posix_rename(source, target)
+    except IOError as err:
+        if not is_unsupported_operation(err):
+            raise
+        try:
+            sftp_client.remove(target)
+        except FileNotFoundError:
+            pass
+        sftp_client.rename(source, target)
+
+
+def remove_stale_partials(sftp_client, max_age=PARTIAL_MAX_AGE, logger=None):
+    """
+    Deletes partial files in the working directory of sftp_client that have not been modified for max_age seconds
+
+    Returns:
+        List of deleted filenames
+    """
+    if logger is None:
+        logger = utils.get_logger()
+    cutoff = time.time() - max_age
+    deleted = list()
+    for attr in sftp_client.listdir_attr('.'):
+        if attr.filename.endswith(PARTIAL_SUFFIX) and (attr.st_mtime < cutoff):
+            try:
+                sftp_client.remove(attr.filename)
+                deleted.append(attr.filename)
+            except IOError as err:
+                logger.warning('Failed to delete stale partial file', extra={'filename': attr.filename, 'exception': repr(err)})
+    if deleted:
+        logger.info('Deleted stale partial files', extra={'deleted': deleted})
+    return deleted
+
+
+sftp_connection_pool = SftpConnectionPool()
@@ -0,0 +1,327 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import hashlib
+import re
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import thiscovery_lib.utilities as utils
+
+
+TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024  # bytes
+TRANSFER_MAX_WORKERS = 4  # parallel S3 ranged GETs
+TRANSFER_PROGRESS_INTERVAL = 64 * 1024 * 1024  # bytes written between calls to progress_callback
+RESUME_VERIFY_BYTES = 1024 * 1024  # size of the trailing window compared when checking a partial remote file
+SHA256_METADATA_KEY = 'sha256'  # user metadata key of S3 objects uploaded with a stored checksum
+MAX_VERIFIED_PARTS = 64  # multipart objects with more parts are not checked part by part, so their ETag is not used
+
+
+def readinto(body, view):
+    """
+    Reads a botocore StreamingBody into view. StreamingBody.readinto reads straight into view; botocore versions that
+    do not implement it are read with StreamingBody.read, at the cost of one copy per read.
+
+    Returns:
+        Number of bytes read
+    """
+    body_readinto = getattr(body, 'readinto', None)
+    n = 0
+    while n < len(view):
+        if body_readinto is None:
+            data = body.read(len(view) - n)
+            count = len(data)
+            view[n:n + count] = data
+        else:
+            count = body_readinto(view[n:])
+        if not count:
+            break
+        n += count
+    return n
+
+
+def write_view(sftp_file, view):
+    """
+    Writes a memoryview to a paramiko SFTPFile. paramiko >= 3.0 accepts any bytes-like object in SFTPFile.write, and
+    unbuffered files (opened with bufsize=0) pass it straight to their write requests, which slice it without copying.
+    """
+    sftp_file.write(view)
+
+
+# etag_is_md5 is False for objects whose ETag is not derived from MD5s of their content (SSE-KMS and SSE-C objects)
+S3ObjectInfo = namedtuple('S3ObjectInfo', ['size', 'etag', 'part_size', 'sha256', 'last_modified', 'etag_is_md5'],
+                          defaults=(None, True))
+
+
+class TransferDigest:
+    """
+    MD5 and SHA-256 digests computed incrementally as chunks are written, plus per-part MD5s so that the ETag of
+    objects uploaded in multiple parts can be reproduced
+    """
+    ETAG_PATTERN = re.compile(r'^[0-9a-f]{32}(-\d+)?$')
+
+    def __init__(self, part_size=None):
+        """
+        Args:
+            part_size (int): size of each part of a multipart upload; None for objects uploaded in a single part
+        """
+        self.part_size = part_size
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.part_digests = list()
+        self._part_md5 = hashlib.md5()
+        self._part_remaining = part_size
+
+    def update(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        if self.part_size is None:
+            return
+        data = memoryview(data)
+        while data:
+            n = min(len(data), self._part_remaining)
+            self._part_md5.update(data[:n])
+            data = data[n:]
+            self._part_remaining -= n
+            if not self._part_remaining:
+                self.part_digests.append(self._part_md5.digest())
+                self._part_md5 = hashlib.md5()
+                self._part_remaining = self.part_size
+
+    @property
+    def etag(self):
+        if self.part_size is None:
+            return self.md5.hexdigest()
+        part_digests = list(self.part_digests)
+        if self._part_remaining != self.part_size:
+            part_digests.append(self._part_md5.digest())
+        return f'{hashlib.md5(b"".join(part_digests)).hexdigest()}-{len(part_digests)}'
+
+    def verify(self, object_info):
+        """
+        Compares digests with the stored SHA-256 checksum of the S3 object, if there is one, or with its ETag otherwise
+
+        Returns:
+            'passed', 'failed' or 'unverifiable', if the object has no stored checksum and its ETag cannot be reproduced:
+            objects encrypted with SSE-KMS or SSE-C (whose ETags are not MD5s of their content) and multipart objects
+            whose parts could not be confirmed to have a uniform size
+        """
+        if object_info.sha256:
+            return 'passed' if self.sha256.hexdigest() == object_info.sha256 else 'failed'
+        if (not object_info.etag_is_md5) or (not self.ETAG_PATTERN.match(object_info.etag)):
+            return 'unverifiable'
+        if ('-' in object_info.etag) and (object_info.part_size is None):
+            return 'unverifiable'
+        return 'passed' if self.etag == object_info.etag else 'failed'
+
+
+class S3ToSftpTransfer:
+    """
+    Copies an S3 object to an open SFTP file. Byte ranges of the object are fetched in parallel into a bounded ring of
+    reusable buffers and written to the SFTP file in order, using pipelined writes, so S3 reads overlap SFTP writes.
+    Response bodies are read straight into the buffers and memoryview slices of them are handed to paramiko, so no
+    per-chunk bytes objects are allocated and peak memory is bounded by chunk_size * (max_workers + 1).
+    """
+
+    def __init__(self, s3_client, chunk_size=TRANSFER_CHUNK_SIZE, max_workers=TRANSFER_MAX_WORKERS, logger=None):
+        """
+        Args:
+            s3_client (S3Client): thiscovery_lib S3Client instance
+            chunk_size (int): size in bytes of each ranged GET and of each buffer in the ring
+            max_workers (int): number of ranged GETs running in parallel
+            logger:
+        """
+        self.s3_client = s3_client
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.logger = logger
+        if logger is None:
+            self.logger = utils.get_logger()
+
+    def get_object_size(self, s3_bucket_name, s3_key):
+        return self.s3_client.client.head_object(Bucket=s3_bucket_name, Key=s3_key)['ContentLength']
+
+    def get_object_info(self, s3_bucket_name, s3_key):
+        """
+        Returns:
+            S3ObjectInfo of the object; part_size is only set for objects uploaded in multiple parts of uniform size
+        """
+        response = self.s3_client.client.head_object(Bucket=s3_bucket_name, Key=s3_key)
+        etag = response['ETag'].strip('"')
+        etag_is_md5 = (not response.get('ServerSideEncryption', '').startswith('aws:kms')) and \
+            ('SSECustomerAlgorithm' not in response)
+        part_size = None
+        if etag_is_md5 and ('-' in etag):
+            part_size = self.get_uniform_part_size(s3_bucket_name, s3_key, response['ContentLength'],
+                                                   int(etag.split('-')[1]))
+        return S3ObjectInfo(
+            size=response['ContentLength'],
+            etag=etag,
+            part_size=part_size,
+            sha256=response.get('Metadata', dict()).get(SHA256_METADATA_KEY),
+            last_modified=response.get('LastModified'),
+            etag_is_md5=etag_is_md5,
+        )
+
+    def get_uniform_part_size(self, s3_bucket_name, s3_key, object_size, parts_count):
+        """
+        Multipart ETags can only be reproduced if every part but the last has the same size, which is checked with a
+        HEAD request per part
+
+        Returns:
+            Size of the parts of the object; None if they are not uniform or the object has more than
+            MAX_VERIFIED_PARTS parts
+        """
+        if parts_count > MAX_VERIFIED_PARTS:
+            return None
+
+        def get_part_length(part_number):
+            return self.s3_client.client.head_object(
+                Bucket=s3_bucket_name, Key=s3_key, PartNumber=part_number)['ContentLength']
+
+        part_size = get_part_length(1)
+        # checked first as it needs no further requests
+        if not ((parts_count - 1) * part_size < object_size <= parts_count * part_size):
+            return None
+        for part_number in range(2, parts_count):
+            if get_part_length(part_number) != part_size:
+                return None
+        return part_size
+
+    def update_digest_from_s3(self, s3_bucket_name, s3_key, length, digest):
+        """
+        Feeds the first length bytes of the S3 object to digest; used to seed the digest of resumed transfers. The bytes
+        already at target are not read back over SFTP: get_resume_offset has checked that the partial file ends with
+        the same bytes as this range of the object, and in-region ranged GETs are much cheaper than reading from SDHS.
+        """
+        buffer = bytearray(min(self.chunk_size, length))
+        for start in range(0, length, self.chunk_size):
+            end = min(start + self.chunk_size, length)
+            _, n = self._fetch_range(s3_bucket_name, s3_key, start, end, buffer)
+            digest.update(memoryview(buffer)[:n])
+
+    def get_resume_offset(self, sftp_client, target_filename, s3_bucket_name, s3_key, object_size, prefetch=True):
+        """
+        Checks whether target_filename already holds the beginning of the S3 object (e.g. from an interrupted transfer),
+        by comparing its size and its last RESUME_VERIFY_BYTES with the same byte range of the S3 object
+
+        Args:
+            sftp_client (paramiko.SFTPClient): SFTP channel whose working directory contains target_filename
+            target_filename (str): remote file
+            s3_bucket_name (str): source bucket
+            s3_key (str): source object key
+            object_size (int): size of source object in bytes
+            prefetch (bool): whether to read the trailing window of target_filename with pipelined read requests
+
+        Returns:
+            Number of bytes that do not need to be transferred again; 0 if target does not exist or does not match
+        """
+        try:
+            remote_size = sftp_client.stat(target_filename).st_size
+        except IOError:
+            return 0
+        if (not remote_size) or (remote_size > object_size):
+            return 0
+        window_start = max(0, remote_size - RESUME_VERIFY_BYTES)
+        with sftp_client.open(target_filename, 'rb') as remote_f:
+            remote_f.seek(window_start)
+            if prefetch:
+                remote_f.prefetch(remote_size)  # paramiko prefetches from the current position up to this file size
+            remote_tail = remote_f.read(remote_size - window_start)
+        s3_tail = bytearray(remote_size - window_start)
+        self._fetch_range(s3_bucket_name, s3_key, window_start, remote_size, s3_tail)
+        if remote_tail == s3_tail:
+            return remote_size
+        self.logger.info('Remote file does not match S3 object; transfer will restart from byte 0', extra={
+            'target_filename': target_filename,
+            'remote_size': remote_size,
+        })
+        return 0
+
+    def _fetch_range(self, s3_bucket_name, s3_key, start, end, buffer):
+        """
+        Reads bytes start to end (exclusive) of S3 object into buffer
+
+        Returns:
+            Tuple of buffer and number of bytes read into it
+        """
+        response = self.s3_client.client.get_object(Bucket=s3_bucket_name, Key=s3_key, Range=f'bytes={start}-{end - 1}')
+        assert response['ResponseMetadata']['HTTPStatusCode'] == HTTPStatus.PARTIAL_CONTENT, \
+            f'Ranged get_object call failed with response: {response}'
+        body = response['Body']
+        try:
+            length = readinto(body, memoryview(buffer)[:end - start])
+        finally:
+            body.close()
+        assert length == end - start, f'Expected {end - start} bytes from range {start}-{end - 1}; got {length}'
+        return buffer, length
+
+    def transfer(self, s3_bucket_name, s3_key, sftp_file, object_size=None, start=0, progress_callback=None, digest=None,
+                 pipelined=True):
+        """
+        Args:
+            s3_bucket_name (str): source bucket
+            s3_key (str): source object key
+            sftp_file (paramiko.SFTPFile): target file, open for writing (or appending, if start > 0); open it with
+                    bufsize=0 to avoid copying chunks into paramiko's write buffer
+            object_size (int): size of source object in bytes; fetched with head_object if not specified
+            start (int): first byte of S3 object to transfer; used to resume interrupted transfers
+            progress_callback: called with the total number of bytes of the object at target (including any resumed
+                    bytes) roughly every TRANSFER_PROGRESS_INTERVAL bytes
+            digest (TransferDigest): if specified, updated with each chunk before it is written
+            pipelined (bool): whether to send SFTP writes without waiting for each to be acknowledged
+
+        Returns:
+            Number of bytes written to sftp_file
+        """
+        if object_size is None:
+            object_size = self.get_object_size(s3_bucket_name, s3_key)
+        offsets = range(start, object_size, self.chunk_size)
+        ranges = iter([(x, min(x + self.chunk_size, object_size)) for x in offsets])
+        free_buffers = deque(bytearray(self.chunk_size) for _ in range(min(self.max_workers + 1, len(offsets))))
+        sftp_file.set_pipelined(pipelined)
+        bytes_written = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque()
+
+            def submit_next_range():
+                next_range = next(ranges, None)
+                if next_range:
+                    pending.append(executor.submit(self._fetch_range, s3_bucket_name, s3_key, *next_range, free_buffers.popleft()))
+
+            for _ in range(len(free_buffers)):
+                submit_next_range()
+            while pending:
+                buffer, length = pending.popleft().result()
+                chunk = memoryview(buffer)[:length]
+                if digest is not None:
+                    digest.update(chunk)
+                write_view(sftp_file, chunk)
+                bytes_written += length
+                free_buffers.append(buffer)
+                submit_next_range()
+                if progress_callback and (bytes_written // TRANSFER_PROGRESS_INTERVAL != (bytes_written - length) // TRANSFER_PROGRESS_INTERVAL):
+                    progress_callback(start + bytes_written)
+        sftp_file.flush()
+        self.logger.debug('Transferred S3 object to SFTP', extra={
+            's3_bucket_name': s3_bucket_name,
+            's3_key': s3_key,
+            'start': start,
+            'bytes_written': bytes_written,
+        })
+        return bytes_written
@@ -16,117 +16,1082 @@
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
 import datetime
+import itertools
 import json
 import os
 import paramiko
 import pysftp
+import queue
+import threading
+import time
+import traceback
+import uuid
 
 from base64 import decodebytes
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from datetime import timedelta
 from dateutil import parser
 from http import HTTPStatus
 from pprint import pprint
-from thiscovery_lib.s3_utilities import S3Client
 
 import thiscovery_lib.utilities as utils
 from thiscovery_lib.dynamodb_utilities import Dynamodb
+
+import common.cache_utilities as cache
 from common.constants import STACK_NAME, STATUS_TABLE, AUDIT_TABLE, PROJECTS_TABLE
-from common.mediaconvert_utilities import MediaConvertClient
-from common.helpers import parse_s3_path, get_sftp_parameters
-from monitor import IncomingMonitor
+from common.helpers import parse_s3_path, iter_items_by_status, iter_s3_event_records, sftp_profile_registry, \
+    update_item_if_status
+from common.extraction_utilities import FAST_PATH_MAX_AUDIO_SIZE, FAST_PATH_MAX_VIDEO_SIZE, FfmpegAudioExtractor, \
+    get_audio_output_key
+from common.mediaconvert_utilities import get_client_request_token
+from common.sftp_utilities import DEFAULT_TRANSFER_TUNING, get_partial_filename, remove_stale_partials, rename, \
+    sftp_connection_pool, tune_file
+from common.transfer_utilities import S3ToSftpTransfer, TransferDigest
+from monitor import AppointmentsIndex, CoreApiCache, IncomingMonitor, InterviewFile, ProjectRoutingIndex, is_interview_file
+
+
+SUBMISSION_MAX_WORKERS = 8  # concurrent audio extraction job submissions in ProcessIncoming.main
+SUBMISSION_TIME_MARGIN = 30000  # milliseconds of lambda execution time left when ProcessIncoming.main stops submitting
+# milliseconds of lambda execution time left when TransferManager.transfer_files stops transfers; enough to write the
+# current chunk and return the messages of unfinished files for redelivery
+TRANSFER_TIME_MARGIN = 60000
+BATCH_TRANSFER_CHANNELS = 4  # SFTP channels opened on each session by TransferManager.transfer_files
+STALE_PARTIALS_CHECK_INTERVAL = 60 * 60  # seconds
+# transfer attempts started longer ago than this have certainly ended (TransferFile(s) time out after 900 s), so their
+# partial files can be resumed without racing the invocation that wrote them
+RESUMABLE_ATTEMPT_AGE = timedelta(seconds=900 + 60)
+MAX_AUDIO_EXTRACTION_ATTEMPTS = 3  # failed jobs are resubmitted until an item has had this many
+JOB_METADATA_APPLICATION_KEY = 'application'  # UserMetadata keys of MediaConvert jobs submitted by this stack
+JOB_METADATA_ENVIRONMENT_KEY = 'environment'
+JOB_METADATA_STATUS_KEY = 'status_table_key'
+JOB_METADATA_ATTEMPT_KEY = 'attempt'
+# margin for clock skew between lambda and MediaConvert when looking up jobs created after a submission marker
+SUBMISSION_LOOKUP_MARGIN = timedelta(minutes=5)
+FAILED_JOB_STATUSES = ['ERROR', 'CANCELED']
+# in-lambda extractions are marked in progress before their .mp3 is uploaded, so its S3 event can arrive before the
+# final update; processed files are accepted so that duplicate S3 events are checked against SDHS rather than failing
+# validation
+TRANSFERABLE_STATUSES = ('audio extraction in progress', 'audio extraction job submitted', 'processed')
+# in-lambda extractions marked in progress longer ago than this were interrupted (lambdas time out after 900 s), so are
+# retried by ProcessIncoming.main
+STALE_EXTRACTION_AGE = timedelta(seconds=900 + 60)
+
+
+def get_deadline(get_remaining_time_in_millis, margin=SUBMISSION_TIME_MARGIN):
+    """
+    Args:
+        get_remaining_time_in_millis: lambda context method
+        margin (int): milliseconds of lambda execution time to be left at the deadline
+
+    Returns:
+        time.monotonic() value of the deadline; None if get_remaining_time_in_millis is None
+    """
+    if get_remaining_time_in_millis is None:
+        return None
+    return time.monotonic() + (get_remaining_time_in_millis() - margin) / 1000
 
 
 class ProcessIncoming:
+    """
+    Extracts the audio of new interview files, using one of two backends: inputs up to a size threshold are processed
+    in-lambda with ffmpeg ('ffmpeg'), which avoids MediaConvert's queueing latency; larger inputs, and any input ffmpeg
+    fails on, are sent to MediaConvert ('mediaconvert'). Either way, the .mp3 lands in the audio bucket under the same key.
+    """
 
-    def __init__(self, logger, correlation_id=None):
+    def __init__(self, logger, correlation_id=None, max_workers=SUBMISSION_MAX_WORKERS, audio_extractor=None,
+                 fast_path_max_sizes=None):
+        """
+        Args:
+            logger:
+            correlation_id:
+            max_workers (int): number of threads used by main
+            audio_extractor (FfmpegAudioExtractor): in-lambda backend; the fast path is disabled if ffmpeg is not available
+            fast_path_max_sizes (dict): file type ('video' or 'audio'): largest input size in bytes sent to the fast path
+        """
         self.logger = logger
         self.correlation_id = correlation_id
-        self.ddb_client = Dynamodb(stack_name=STACK_NAME)
-        self.media_convert_client = MediaConvertClient()
+        self.max_workers = max_workers
+        self._thread_local = threading.local()
+        self.ddb_client = cache.get_ddb_client(correlation_id=correlation_id)
+        self.media_convert_client = cache.get_media_convert_client()
+        self.s3_client = cache.get_s3_client()
+        self.audio_extractor = audio_extractor
+        if audio_extractor is None:
+            self.audio_extractor = FfmpegAudioExtractor(
+                s3_client=self.s3_client,
+                audio_bucket_name=self.media_convert_client.audio_bucket_name,
+                logger=logger,
+            )
+        self.fast_path_max_sizes = fast_path_max_sizes
+        if fast_path_max_sizes is None:
+            self.fast_path_max_sizes = {'video': FAST_PATH_MAX_VIDEO_SIZE, 'audio': FAST_PATH_MAX_AUDIO_SIZE}
 
-    def main(self):
-        new_items = self.ddb_client.scan(STATUS_TABLE, filter_attr_name='processing_status', filter_attr_values=['new'])
-        self.logger.info('new_items', extra={'count': str(len(new_items))})
-        responses = list()
-        for i in new_items:
-            key = i['id']
-            media_convert_response = self.media_convert_client.create_audio_extraction_job(input_bucket_name=i["source_bucket"], input_file_s3_key=key)
-            ddb_response = self.ddb_client.update_item(
+    def _get_thread_ddb_client(self):
+        """
+        boto3 resources are not thread-safe, so worker threads of main get their own Dynamodb client
+        """
+        if threading.current_thread() is threading.main_thread():
+            return self.ddb_client
+        ddb_client = getattr(self._thread_local, 'ddb_client', None)
+        if ddb_client is None:
+            ddb_client = Dynamodb(stack_name=STACK_NAME, correlation_id=self.correlation_id)
+            self._thread_local.ddb_client = ddb_client
+        return ddb_client
+
+    def find_submitted_job(self, key, attempt, submission_started):
+        """
+        Looks up a job created by a submission that was interrupted before the job was recorded in the status item
+
+        Args:
+            key (str): status table key
+            attempt (int): attempt number in the submission marker of the status item
+            submission_started (str): timestamp in the submission marker of the status item
+
+        Returns:
+            The job (as returned by list_jobs) if found; otherwise None
+        """
+        created_after = parser.isoparse(submission_started) - SUBMISSION_LOOKUP_MARGIN
+        for job in self.media_convert_client.iter_jobs(created_after=created_after):
+            user_metadata = job.get('UserMetadata', dict())
+            if (user_metadata.get(JOB_METADATA_APPLICATION_KEY) == STACK_NAME) and \
+                    (user_metadata.get(JOB_METADATA_ENVIRONMENT_KEY) == utils.get_environment_name()) and \
+                    (user_metadata.get(JOB_METADATA_STATUS_KEY) == key) and \
+                    (user_metadata.get(JOB_METADATA_ATTEMPT_KEY) == str(attempt)):
+                return job
+
+    def submit_audio_extraction_job(self, key, source_bucket, audio_extraction_attempts, extra_attributes=None,
+                                    item=None):
+        """
+        A submission marker is written to the status item before the job is created. If a run is interrupted between
+        creating the job and recording it, the next submission of the same attempt finds the marker and adopts the
+        existing job instead of creating a second one.
+
+        Args:
+            key (str): status table key, which is also the S3 key of the input file
+            source_bucket (str): bucket of input file
+            audio_extraction_attempts (int): number of jobs previously submitted for key
+            extra_attributes (dict): additional attributes written to the status item in the same update
+            item (dict): status item; if specified, checked for the submission marker of an interrupted submission
+        """
+        ddb_client = self._get_thread_ddb_client()
+        attempt = audio_extraction_attempts + 1
+        media_convert_response = None
+        if item and (item.get('mediaconvert_submission_attempt') == attempt):
+            job = self.find_submitted_job(key, attempt, item['mediaconvert_submission_started'])
+            if job is not None:
+                self.logger.warning('Found job of interrupted submission', extra={'key': key, 'job_id': job['Id']})
+                media_convert_response = {'Job': job}
+        if media_convert_response is None:
+            ddb_client.update_item(
                 table_name=STATUS_TABLE,
                 key=key,
                 name_value_pairs={
-                    "audio_extraction_attempts": i["audio_extraction_attempts"] + 1,
-                    "processing_status": "audio extraction job submitted",
+                    "mediaconvert_submission_attempt": attempt,
+                    "mediaconvert_submission_started": str(utils.now_with_tz()),
                 },
                 correlation_id=self.correlation_id
             )
-            responses.append((media_convert_response, ddb_response))
+            media_convert_response = self.media_convert_client.create_audio_extraction_job(
+                input_bucket_name=source_bucket,
+                input_file_s3_key=key,
+                ClientRequestToken=get_client_request_token(key, audio_extraction_attempts),
+                UserMetadata={
+                    JOB_METADATA_APPLICATION_KEY: STACK_NAME,
+                    JOB_METADATA_ENVIRONMENT_KEY: utils.get_environment_name(),
+                    JOB_METADATA_STATUS_KEY: key,
+                    JOB_METADATA_ATTEMPT_KEY: str(attempt),
+                },
+            )
+        ddb_response = ddb_client.update_item(
+            table_name=STATUS_TABLE,
+            key=key,
+            name_value_pairs={
+                "audio_extraction_attempts": attempt,
+                "processing_status": "audio extraction job submitted",
+                "extraction_backend": "mediaconvert",
+                "mediaconvert_job_id": media_convert_response['Job']['Id'],
+                "mediaconvert_job_status": media_convert_response['Job']['Status'],
+                **(extra_attributes or dict()),
+            },
+            correlation_id=self.correlation_id
+        )
+        return media_convert_response, ddb_response
+
+    def run_ffmpeg_extraction(self, key, source_bucket, audio_extraction_attempts, deadline=None):
+        """
+        Extracts audio in-lambda. The item is marked as in progress before ffmpeg starts, so that the S3 event of the
+        .mp3 passes TransferManager's status check whenever it arrives, and updated with the output once the upload is
+        complete; its status is only changed if TransferManager has not already set it to processed. Items left in
+        progress by an interrupted invocation are retried by main.
+
+        Returns:
+            Tuple of extractor response and Dynamodb response of status item update; None if ffmpeg failed, was busy or
+            was short of time, in which case no .mp3 was published and the caller should fall back to MediaConvert
+        """
+        ddb_client = self._get_thread_ddb_client()
+        ddb_client.update_item(
+            table_name=STATUS_TABLE,
+            key=key,
+            name_value_pairs={
+                "processing_status": "audio extraction in progress",
+                "extraction_backend": "ffmpeg",
+            },
+            correlation_id=self.correlation_id
+        )
+        try:
+            extraction_response = self.audio_extractor.extract(
+                input_bucket_name=source_bucket,
+                input_file_s3_key=key,
+                deadline=deadline,
+            )
+        except Exception as err:
+            self.logger.warning('In-lambda audio extraction failed; falling back to MediaConvert', extra={
+                'key': key,
+                'exception': repr(err),
+            })
+            return None
+        name_value_pairs = {
+            "audio_extraction_attempts": audio_extraction_attempts + 1,
+            "audio_output_size": extraction_response['output_size'],
+        }
+        ddb_response = update_item_if_status(
+            ddb_client,
+            key,
+            "audio extraction in progress",
+            {**name_value_pairs, "processing_status": "audio extraction job submitted"},
+        )
+        if ddb_response is None:
+            ddb_response = ddb_client.update_item(
+                table_name=STATUS_TABLE,
+                key=key,
+                name_value_pairs=name_value_pairs,
+                correlation_id=self.correlation_id
+            )
+        return extraction_response, ddb_response
+
+    def select_backend(self, key, source_bucket, object_size=None):
+        """
+        Returns:
+            'ffmpeg' if the input is small enough for the fast path and ffmpeg is available; 'mediaconvert' otherwise
+        """
+        if not self.audio_extractor.available:
+            return 'mediaconvert'
+        _, _, file_type = parse_s3_path(key)
+        max_size = self.fast_path_max_sizes.get(file_type, 0)
+        if not max_size:
+            return 'mediaconvert'
+        if object_size is None:
+            object_size = self.s3_client.client.head_object(Bucket=source_bucket, Key=key)['ContentLength']
+        return 'ffmpeg' if object_size <= max_size else 'mediaconvert'
+
+    def extract_audio(self, key, source_bucket, audio_extraction_attempts, object_size=None, deadline=None, item=None):
+        """
+        Extracts audio using the backend chosen by select_backend, falling back to MediaConvert if ffmpeg fails, is
+        busy or could not finish before deadline
+
+        Args:
+            key (str): status table key, which is also the S3 key of the input file
+            source_bucket (str): bucket of input file
+            audio_extraction_attempts (int): number of extractions previously attempted for key
+            object_size (int): size of input file in bytes; fetched with head_object if needed and not specified
+            deadline (float): time.monotonic() value by which in-lambda extraction must have finished
+            item (dict): status item; passed to submit_audio_extraction_job
+
+        Returns:
+            Tuple of backend response and Dynamodb response of status item update
+        """
+        if self.audio_extractor.has_time_for_extraction(deadline) and \
+                (self.select_backend(key, source_bucket, object_size) == 'ffmpeg'):
+            responses = self.run_ffmpeg_extraction(key, source_bucket, audio_extraction_attempts, deadline=deadline)
+            if responses is not None:
+                return responses
+        return self.submit_audio_extraction_job(key, source_bucket, audio_extraction_attempts, item=item)
+
+    def main(self, get_remaining_time_in_millis=None):
+        """
+        Extracts audio of all new items, and of items whose in-lambda extraction was interrupted, concurrently.
+        MediaConvert calls are rate limited and retried with backoff when throttled (see mediaconvert_utilities). Each
+        item's status is updated as soon as its job is created (or its audio extracted), so items left when the run is
+        about to time out remain new and are picked up by the next run.
+
+        Args:
+            get_remaining_time_in_millis: lambda context method; if specified, no further jobs are submitted once less
+                    than SUBMISSION_TIME_MARGIN milliseconds remain
+
+        Returns:
+            List of (backend_response, ddb_response) tuples of successful extractions
+        """
+        deadline = get_deadline(get_remaining_time_in_millis)
+        new_items = itertools.chain(
+            iter_items_by_status(self.ddb_client, 'new'),
+            iter_items_by_status(
+                self.ddb_client,
+                'audio extraction in progress',
+                modified_before=utils.now_with_tz() - STALE_EXTRACTION_AGE,
+            ),
+        )
+        responses = list()
+        failed_keys = list()
+        deferred = False
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = dict()
+
+            def collect(done_futures):
+                for future in done_futures:
+                    key = pending.pop(future)
+                    try:
+                        responses.append(future.result())
+                    except Exception as err:
+                        self.logger.error('Failed to submit audio extraction job', extra={
+                            'key': key,
+                            'exception': repr(err),
+                        })
+                        failed_keys.append(key)
+
+            for i in new_items:
+                if (deadline is not None) and (time.monotonic() > deadline):
+                    deferred = True
+                    break
+                if len(pending) >= 2 * self.max_workers:
+                    done_futures, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done_futures)
+                future = executor.submit(
+                    self.extract_audio,
+                    key=i['id'],
+                    source_bucket=i["source_bucket"],
+                    audio_extraction_attempts=i["audio_extraction_attempts"],
+                    object_size=i.get('details', dict()).get('ContentLength'),
+                    deadline=deadline,
+                    item=i,
+                )
+                pending[future] = i['id']
+            collect(list(wait(pending).done))
+        self.logger.info('Submitted audio extraction jobs', extra={
+            'submitted': len(responses),
+            'failed': failed_keys,
+            'remaining_items_deferred_to_next_run': deferred,
+        })
         return responses
 
 
-class TransferManager:
+class IncomingEventProcessor:
+    """
+    Event-driven counterpart of IncomingMonitor and ProcessIncoming: registers each newly uploaded interview file in the
+    status table and submits its audio extraction job straight away. IncomingMonitor remains as a reconciliation sweep
+    for any file this misses.
+    """
+
+    def __init__(self, logger, correlation_id=None):
+        self.logger = logger
+        self.correlation_id = correlation_id
+        self.core_api_client = cache.get_core_api_client(correlation_id=correlation_id)
+        self.core_api_cache = CoreApiCache(self.core_api_client)
+        self.appointments_index = AppointmentsIndex(correlation_id=correlation_id)
+        self.ddb_client = cache.get_ddb_client(correlation_id=correlation_id)
+        self.s3_client = cache.get_s3_client()
+        self.incoming_processor = ProcessIncoming(logger=logger, correlation_id=correlation_id)
+        self.active_projects = cache.get_active_projects()
+        self.routing_index = ProjectRoutingIndex(self.active_projects)
+
+    def process_file(self, s3_bucket_name, s3_path, deadline=None):
+        """
+        Args:
+            s3_bucket_name (str):
+            s3_path (str):
+            deadline (float): time.monotonic() value by which in-lambda audio extraction must have finished
+
+        Returns:
+            True if file was added to status table and its audio extraction job submitted; False if file was skipped
+        """
+        if not is_interview_file(s3_path):
+            self.logger.debug(f'Skipped {s3_path}; not an interview file')
+            return False
+        if self.ddb_client.get_item(STATUS_TABLE, key=s3_path):
+            self.logger.info(f'Skipped {s3_path}; already in ddb table {STATUS_TABLE}')
+            return False
+        interview_file = InterviewFile(
+            s3_bucket_name=s3_bucket_name,
+            s3_path=s3_path,
+            active_projects=self.active_projects,
+            logger=self.logger,
+            correlation_id=self.correlation_id,
+            core_api_client=self.core_api_cache,
+            ddb_client=self.ddb_client,
+            s3_client=self.s3_client,
+            appointments_index=self.appointments_index,
+            routing_index=self.routing_index,
+        )
+        interview_file.add_to_status_table()
+        self.incoming_processor.extract_audio(
+            key=s3_path,
+            source_bucket=s3_bucket_name,
+            audio_extraction_attempts=0,
+            object_size=interview_file.head.get('ContentLength'),
+            deadline=deadline,
+        )
+        return True
+
+    def main(self, event, get_remaining_time_in_millis=None):
+        """
+        Args:
+            event (dict): S3 ObjectCreated event, or SQS event whose messages are S3 ObjectCreated events
+            get_remaining_time_in_millis: lambda context method; if specified, SQS messages not started once less than
+                    SUBMISSION_TIME_MARGIN milliseconds remain are returned for retry
+
+        Returns:
+            Dict of files added to status table and, for SQS events, the ids of messages that should be retried
+        """
+        deadline = get_deadline(get_remaining_time_in_millis)
+        files_added_to_status_table = list()
+        failed_message_ids = list()
+        for message_id, s3_bucket_name, s3_path in iter_s3_event_records(event):
+            if message_id and (deadline is not None) and (time.monotonic() > deadline):
+                if message_id not in failed_message_ids:
+                    failed_message_ids.append(message_id)
+                continue
+            try:
+                if self.process_file(s3_bucket_name, s3_path, deadline=deadline):
+                    files_added_to_status_table.append(s3_path)
+            except:
+                self.logger.error(
+                    f'Failed to process new file {s3_path}',
+                    extra={
+                        'traceback': traceback.format_exc()
+                    },
+                )
+                if message_id and (message_id not in failed_message_ids):
+                    failed_message_ids.append(message_id)
+        self.logger.info('Processed incoming file events', extra={
+            'files_added_to_status_table': len(files_added_to_status_table),
+            'core_api_cache': self.core_api_cache.stats(),
+        })
+        return {
+            'files_added_to_status_table': files_added_to_status_table,
+            'batchItemFailures': [{'itemIdentifier': x} for x in failed_message_ids],
+        }
+
+
+class JobStateTracker:
+    """
+    Keeps status items in step with their MediaConvert jobs, using "MediaConvert Job State Change" events and a periodic
+    reconciliation against list_jobs for any event that was missed. Failed jobs are resubmitted until an item has had
+    MAX_AUDIO_EXTRACTION_ATTEMPTS jobs, after which it is marked as 'audio extraction failed'.
+    """
 
     def __init__(self, logger, correlation_id=None):
         self.logger = logger
         self.correlation_id = correlation_id
-        self.ddb_client = Dynamodb(stack_name=STACK_NAME)
-        self.s3_client = S3Client()
+        self.ddb_client = cache.get_ddb_client(correlation_id=correlation_id)
+        self.s3_client = cache.get_s3_client()
+        self.media_convert_client = cache.get_media_convert_client()
+        self.incoming_processor = ProcessIncoming(logger=logger, correlation_id=correlation_id)
+
+    def get_output_attributes(self, output_group_details):
+        """
+        Returns:
+            Dict of duration and size of first output file of a job, as reported in its outputGroupDetails
+        """
+        attributes = dict()
+        try:
+            output_details = output_group_details[0]['outputDetails'][0]
+        except (IndexError, KeyError, TypeError):
+            return attributes
+        if 'durationInMs' in output_details:
+            attributes['audio_duration_ms'] = output_details['durationInMs']
+        output_paths = output_details.get('outputFilePaths')
+        if output_paths:
+            bucket_name, _, output_key = output_paths[0].replace('s3://', '', 1).partition('/')
+            response = self.s3_client.client.head_object(Bucket=bucket_name, Key=output_key)
+            attributes['audio_output_size'] = response['ContentLength']
+        return attributes
+
+    def handle_job_state(self, status_table_key, job_id, job_status, output_group_details=None, error_code=None,
+                         error_message=None):
+        """
+        Records the state of a job on its status item, in a single write; failed jobs are resubmitted or, if the item
+        has run out of attempts, the item is marked as failed
+
+        Returns:
+            Dynamodb response of the status item update, or None if job_id is not the item's current job
+        """
+        item = self.ddb_client.get_item(STATUS_TABLE, key=status_table_key)
+        if item is None:
+            raise utils.ObjectDoesNotExistError(f'Item not found in Dynamodb {STATUS_TABLE} table', details={
+                'key': status_table_key,
+                'correlation_id': self.correlation_id
+            })
+        if item.get('mediaconvert_job_id') != job_id:
+            self.logger.info('Ignored state change of superseded job', extra={
+                'status_table_key': status_table_key,
+                'job_id': job_id,
+                'current_job_id': item.get('mediaconvert_job_id'),
+            })
+            return None
 
-    def update_status_of_processed_item(self, item, status_table_key):
+        if job_status in FAILED_JOB_STATUSES:
+            failure_attributes = {
+                "mediaconvert_job_status": job_status,
+                "mediaconvert_error_code": error_code,
+                "mediaconvert_error_message": error_message,
+            }
+            attempts = item["audio_extraction_attempts"]
+            if attempts < MAX_AUDIO_EXTRACTION_ATTEMPTS:
+                self.logger.warning('Resubmitting failed audio extraction job', extra={
+                    'status_table_key': status_table_key,
+                    'job_id': job_id,
+                    'error_code': error_code,
+                    'audio_extraction_attempts': attempts,
+                })
+                _, ddb_response = self.incoming_processor.submit_audio_extraction_job(
+                    key=status_table_key,
+                    source_bucket=item["source_bucket"],
+                    audio_extraction_attempts=attempts,
+                    item=item,
+                    extra_attributes={
+                        "mediaconvert_error_code": error_code,
+                        "mediaconvert_error_message": error_message,
+                    },
+                )
+                return ddb_response
+            self.logger.error('Audio extraction failed; no attempts left', extra={
+                'status_table_key': status_table_key,
+                'job_id': job_id,
+                'error_code': error_code,
+                'error_message': error_message,
+            })
+            name_value_pairs = {
+                "processing_status": "audio extraction failed",
+                **failure_attributes,
+            }
+        else:
+            name_value_pairs = {
+                "mediaconvert_job_status": job_status,
+                **self.get_output_attributes(output_group_details),
+            }
         return self.ddb_client.update_item(
+            table_name=STATUS_TABLE,
+            key=status_table_key,
+            name_value_pairs=name_value_pairs,
+            correlation_id=self.correlation_id
+        )
+
+    def process_event(self, event):
+        """
+        Args:
+            event (dict): EventBridge "MediaConvert Job State Change" event
+        """
+        detail = event['detail']
+        user_metadata = detail.get('userMetadata', dict())
+        if (user_metadata.get(JOB_METADATA_APPLICATION_KEY) != STACK_NAME) or \
+                (user_metadata.get(JOB_METADATA_ENVIRONMENT_KEY) != utils.get_environment_name()):
+            self.logger.debug('Ignored event of job not submitted by this stack', extra={'job_id': detail.get('jobId')})
+            return None
+        return self.handle_job_state(
+            status_table_key=user_metadata[JOB_METADATA_STATUS_KEY],
+            job_id=detail['jobId'],
+            job_status=detail['status'],
+            output_group_details=detail.get('outputGroupDetails'),
+            error_code=detail.get('errorCode'),
+            error_message=detail.get('errorMessage'),
+        )
+
+    def get_output_group_details(self, job, status_table_key):
+        """
+        Converts the OutputGroupDetails of a job returned by list_jobs to the outputGroupDetails of a state change event.
+        Jobs returned by the API do not include output file paths, so for complete jobs the path of the .mp3 is derived
+        from the input key, as MediaConvert's $fn$ destination does (see get_audio_output_key).
+        """
+        output_group_details = list()
+        for group in job.get('OutputGroupDetails', list()):
+            output_details = list()
+            for output in group.get('OutputDetails', list()):
+                details = {'durationInMs': output['DurationInMs']} if 'DurationInMs' in output else dict()
+                if job['Status'] == 'COMPLETE':
+                    details['outputFilePaths'] = [
+                        f's3://{self.media_convert_client.audio_bucket_name}/{get_audio_output_key(status_table_key)}'
+                    ]
+                output_details.append(details)
+            output_group_details.append({'outputDetails': output_details})
+        return output_group_details
+
+    def reconcile(self):
+        """
+        Applies the final state of jobs of items still waiting for audio extraction, in case their state change events
+        were not delivered. Jobs are fetched in batches with list_jobs, filtered by status, rather than one by one.
+
+        Returns:
+            Dict of status_table_key: job status, for items that were updated
+        """
+        pending_items = {
+            x['mediaconvert_job_id']: x for x in iter_items_by_status(self.ddb_client, 'audio extraction job submitted')
+            if x.get('mediaconvert_job_id') and (x.get('mediaconvert_job_status') not in ['COMPLETE'] + FAILED_JOB_STATUSES)
+        }
+        if not pending_items:
+            return dict()
+        # a job is created shortly before its item is updated, so an hour's margin on the oldest item covers all jobs
+        created_after = min(parser.isoparse(x['modified']) for x in pending_items.values()) - timedelta(hours=1)
+        reconciled = dict()
+        for job_status in ['COMPLETE'] + FAILED_JOB_STATUSES:
+            for job in self.media_convert_client.iter_jobs(created_after=created_after, Status=job_status):
+                item = pending_items.pop(job['Id'], None)
+                if item is None:
+                    continue
+                try:
+                    self.handle_job_state(
+                        status_table_key=item['id'],
+                        job_id=job['Id'],
+                        job_status=job_status,
+                        output_group_details=self.get_output_group_details(job, item['id']),
+                        error_code=job.get('ErrorCode'),
+                        error_message=job.get('ErrorMessage'),
+                    )
+                    reconciled[item['id']] = job_status
+                except Exception as err:
+                    self.logger.error('Failed to reconcile job', extra={
+                        'status_table_key': item['id'],
+                        'job_id': job['Id'],
+                        'exception': repr(err),
+                    })
+                if not pending_items:
+                    break
+        self.logger.info('Reconciled MediaConvert jobs', extra={
+            'reconciled': reconciled,
+            'still_pending': len(pending_items),
+        })
+        return reconciled
+
+
+class TransferManager:
+
+    def __init__(self, logger, correlation_id=None, transfer_engine=None, max_channels=BATCH_TRANSFER_CHANNELS):
+        """
+        Args:
+            logger:
+            correlation_id:
+            transfer_engine (S3ToSftpTransfer): engine used to copy S3 objects to SDHS
+            max_channels (int): maximum number of SFTP channels opened on a session by transfer_files, each used to
+                    transfer one file at a time
+        """
+        self.logger = logger
+        self.correlation_id = correlation_id
+        self.max_channels = max_channels
+        self._thread_local = threading.local()
+        self.ddb_client = cache.get_ddb_client(correlation_id=correlation_id)
+        self.s3_client = cache.get_s3_client()
+        self.transfer_engine = transfer_engine
+        if transfer_engine is None:
+            self.transfer_engine = S3ToSftpTransfer(self.s3_client, logger=logger)
+
+    def _get_thread_ddb_client(self):
+        """
+        boto3 resources are not thread-safe, so worker threads of transfer_files get their own Dynamodb client
+        """
+        if threading.current_thread() is threading.main_thread():
+            return self.ddb_client
+        ddb_client = getattr(self._thread_local, 'ddb_client', None)
+        if ddb_client is None:
+            ddb_client = Dynamodb(stack_name=STACK_NAME, correlation_id=self.correlation_id)
+            self._thread_local.ddb_client = ddb_client
+        return ddb_client
+
+    @staticmethod
+    def get_status_table_key(file_s3_key):
+        return f'{os.path.splitext(file_s3_key)[0]}.mp4'
+
+    def register_transfer_attempt(self, item, status_table_key, partial_filename=None):
+        name_value_pairs = {
+            "sdhs_transfer_attempts": item["sdhs_transfer_attempts"] + 1,
+        }
+        if partial_filename is not None:
+            name_value_pairs.update({
+                "sdhs_partial_filename": partial_filename,
+                "sdhs_transfer_started": str(utils.now_with_tz()),
+            })
+        return self._get_thread_ddb_client().update_item(
+            table_name=STATUS_TABLE,
+            key=status_table_key,
+            name_value_pairs=name_value_pairs,
+            correlation_id=self.correlation_id
+        )
+
+    @staticmethod
+    def get_resumable_partial(item):
+        """
+        Returns:
+            Partial file written by the item's previous transfer attempt, if that attempt is known to have ended; None
+            otherwise
+        """
+        partial_filename = item.get('sdhs_partial_filename')
+        started = item.get('sdhs_transfer_started')
+        if partial_filename and started and (utils.now_with_tz() - parser.isoparse(started) > RESUMABLE_ATTEMPT_AGE):
+            return partial_filename
+
+    def take_over_partial(self, sftp_client, previous_partial_filename, partial_filename):
+        """
+        Renames the partial file of a previous attempt to this attempt's partial file. Plain SFTP rename fails if the
+        source no longer exists, so if several attempts try to resume the same partial file only one of them succeeds.
+
+        Returns:
+            True if partial_filename now holds the previous attempt's bytes
+        """
+        try:
+            sftp_client.rename(previous_partial_filename, partial_filename)
+            return True
+        except IOError as err:
+            self.logger.debug('Could not take over partial file of previous attempt', extra={
+                'previous_partial_filename': previous_partial_filename,
+                'exception': repr(err),
+            })
+            return False
+
+    def record_transfer_progress(self, status_table_key, bytes_transferred, object_size):
+        return self._get_thread_ddb_client().update_item(
             table_name=STATUS_TABLE,
             key=status_table_key,
             name_value_pairs={
-                "sdhs_transfer_attempts": item["sdhs_transfer_attempts"] + 1,
-                "processing_status": "processed",
+                "sdhs_bytes_transferred": bytes_transferred,
+                "sdhs_transfer_size": object_size,
             },
             correlation_id=self.correlation_id
         )
 
-    def get_item_and_validate_status(self, status_table_key):
-        item = self.ddb_client.get_item(STATUS_TABLE, key=status_table_key)
-        item_status = item['processing_status']
-        assert item_status == 'audio extraction job submitted', f'Item processing_status is {item_status}. Expected "audio extraction job submitted"'
-        return item
+    def record_integrity_check(self, status_table_key, digest, integrity_check):
+        return self._get_thread_ddb_client().update_item(
+            table_name=STATUS_TABLE,
+            key=status_table_key,
+            name_value_pairs={
+                "sdhs_md5": digest.md5.hexdigest(),
+                "sdhs_sha256": digest.sha256.hexdigest(),
+                "sdhs_etag": digest.etag,
+                "sdhs_integrity_check": integrity_check,
+            },
+            correlation_id=self.correlation_id
+        )
 
-    def transfer_file(self, file_s3_key, s3_bucket_name):
-        status_table_key = f'{os.path.splitext(file_s3_key)[0]}.mp4'
-        item = self.get_item_and_validate_status(status_table_key)
+    def update_status_of_processed_item(self, item, status_table_key, object_size=None):
+        name_value_pairs = {
+            "processing_status": "processed",
+        }
+        if object_size is not None:
+            name_value_pairs.update({
+                "sdhs_bytes_transferred": object_size,
+                "sdhs_transfer_size": object_size,
+            })
+        return self._get_thread_ddb_client().update_item(
+            table_name=STATUS_TABLE,
+            key=status_table_key,
+            name_value_pairs=name_value_pairs,
+            correlation_id=self.correlation_id
+        )
+
+    def get_item_and_validate_status(self, status_table_key, expected_statuses=('audio extraction job submitted',)):
+        item = self.ddb_client.get_item(STATUS_TABLE, key=status_table_key)
         if item is None:
             raise utils.ObjectDoesNotExistError(f'Item not found in Dynamodb {STATUS_TABLE} table', details={
                 'key': status_table_key,
                 'correlation_id': self.correlation_id
             })
-        project_acronym = item['project_acronym']
+        item_status = item['processing_status']
+        assert item_status in expected_statuses, f'Item processing_status is {item_status}. Expected one of {expected_statuses}'
+        return item
+
+    def record_duplicate_event(self, item, status_table_key):
+        return self._get_thread_ddb_client().update_item(
+            table_name=STATUS_TABLE,
+            key=status_table_key,
+            name_value_pairs={
+                "sdhs_duplicate_events": item.get("sdhs_duplicate_events", 0) + 1,
+            },
+            correlation_id=self.correlation_id
+        )
+
+    @staticmethod
+    def is_duplicate_of_processed(item, object_info):
+        """
+        Checks whether the S3 object is the one a processed item has already delivered, using the digest recorded by
+        that transfer. The remote file is not checked, as researchers may have moved it since.
+
+        Returns:
+            True if item is processed and its recorded digest matches the object's stored checksum or ETag
+        """
+        if item['processing_status'] != 'processed':
+            return False
+        if object_info.sha256 and item.get('sdhs_sha256'):
+            return item['sdhs_sha256'] == object_info.sha256
+        if item.get('sdhs_etag'):
+            return item['sdhs_etag'] == object_info.etag
+        return False
+
+    @staticmethod
+    def is_already_at_target(sftp_client, target_filename, object_info, item):
+        """
+        Checks whether target_filename is an up-to-date copy of the S3 object, without reading either: the remote file
+        must have the same size as the object and must not be older than it; if the item records the digest of a
+        previous transfer, that digest must also match the object's ETag or stored checksum
+
+        Returns:
+            True if transferring the object again is unnecessary
+        """
+        try:
+            remote_attr = sftp_client.stat(target_filename)
+        except IOError:
+            return False
+        if remote_attr.st_size != object_info.size:
+            return False
+        if object_info.last_modified and (remote_attr.st_mtime < object_info.last_modified.timestamp()):
+            return False
+        if object_info.sha256 and item.get('sdhs_sha256'):
+            return item['sdhs_sha256'] == object_info.sha256
+        if item.get('sdhs_etag'):
+            return item['sdhs_etag'] == object_info.etag
+        return True
+
+    @staticmethod
+    def check_deadline(deadline, file_s3_key):
+        """
+        Raises DetailedValueError if deadline (a time.monotonic() value) has passed
+        """
+        if (deadline is not None) and (time.monotonic() > deadline):
+            raise utils.DetailedValueError('Transfer deferred; invocation is about to time out', details={
+                'file_s3_key': file_s3_key,
+            })
+
+    def record_transfer_progress_or_stop(self, status_table_key, file_s3_key, bytes_transferred, object_size,
+                                         deadline=None):
+        self.record_transfer_progress(status_table_key, bytes_transferred, object_size)
+        self.check_deadline(deadline, file_s3_key)
+
+    def _transfer_to_sftp(self, sftp_client, file_s3_key, s3_bucket_name, status_table_key, item,
+                          tuning=DEFAULT_TRANSFER_TUNING, deadline=None):
+        """
+        Transfers a single file and updates its status item
+
+        Args:
+            sftp_client (paramiko.SFTPClient): SFTP channel whose working directory is the project's target folder
+            file_s3_key (str): key of file to transfer
+            s3_bucket_name (str): bucket of file to transfer
+            status_table_key (str): key of file in status table
+            item (dict): status table item, as returned by get_item_and_validate_status
+            tuning (TransferTuning): transfer profile of the SFTP session
+            deadline (float): time.monotonic() value after which the transfer is stopped (at its next progress
+                    update), leaving its partial file to be resumed by a later attempt
+        """
         target_basename = item['target_basename']
-        sdhs_params, target_folder, cnopts = get_sftp_parameters(project_acronym)
+        object_info = self.transfer_engine.get_object_info(s3_bucket_name, file_s3_key)
+        object_size = object_info.size
+        # s3_dirs, s3_filename = os.path.split(file_s3_key)
+        # self.logger.debug('Path of s3_obj', extra={'s3_dirs': s3_dirs, 's3_filename': s3_filename})
+        _, extension = os.path.splitext(file_s3_key)
+        target_filename = f'{target_basename}{extension}'
+        if self.is_duplicate_of_processed(item, object_info):
+            self.logger.info(f'File already delivered; skipping duplicate event', extra={
+                'file_s3_key': file_s3_key,
+                'target_filename': target_filename,
+            })
+            return self.record_duplicate_event(item, status_table_key)
+        if self.is_already_at_target(sftp_client, target_filename, object_info, item):
+            self.logger.info(f'File already at target; skipping transfer', extra={
+                'file_s3_key': file_s3_key,
+                'target_filename': target_filename,
+                'processing_status': item['processing_status'],
+            })
+            if item['processing_status'] == 'processed':
+                return self.record_duplicate_event(item, status_table_key)
+            return self.update_status_of_processed_item(item, status_table_key, object_size=object_size)
 
         self.logger.debug(f'Initiating transfer', extra={'s3_bucket_name': s3_bucket_name, 'file_s3_key': file_s3_key})
-        with pysftp.Connection(**sdhs_params, cnopts=cnopts) as sftp:
-            sftp.chdir(target_folder)
-            # s3_dirs, s3_filename = os.path.split(file_s3_key)
-            # self.logger.debug('Path of s3_obj', extra={'s3_dirs': s3_dirs, 's3_filename': s3_filename})
-            _, extension = os.path.splitext(file_s3_key)
-            target_filename = f'{target_basename}{extension}'
-            with sftp.sftp_client.open(target_filename, 'wb') as sdhs_f:
-                self.s3_client.download_fileobj(s3_bucket_name, file_s3_key, sdhs_f)
+        digest = TransferDigest(part_size=object_info.part_size)
+        partial_filename = get_partial_filename(target_filename, f"{item['sdhs_transfer_attempts'] + 1}-{uuid.uuid4().hex[:8]}")
+        previous_partial_filename = self.get_resumable_partial(item)
+        self.register_transfer_attempt(item, status_table_key, partial_filename=partial_filename)
+        resume_offset = 0
+        if previous_partial_filename and self.take_over_partial(sftp_client, previous_partial_filename, partial_filename):
+            resume_offset = self.transfer_engine.get_resume_offset(sftp_client, partial_filename, s3_bucket_name,
+                                                                   file_s3_key, object_size, prefetch=tuning.prefetch)
+        if resume_offset:
+            self.logger.info(f'Resuming interrupted transfer', extra={
+                'partial_filename': partial_filename,
+                'resume_offset': resume_offset,
+                'object_size': object_size,
+            })
+            self.transfer_engine.update_digest_from_s3(s3_bucket_name, file_s3_key, resume_offset, digest)
+        with sftp_client.open(partial_filename, 'ab' if resume_offset else 'wb', bufsize=0) as sdhs_f:
+            tune_file(sdhs_f, tuning)
+            self.transfer_engine.transfer(
+                s3_bucket_name,
+                file_s3_key,
+                sdhs_f,
+                object_size=object_size,
+                start=resume_offset,
+                progress_callback=lambda x: self.record_transfer_progress_or_stop(
+                    status_table_key, file_s3_key, x, object_size, deadline=deadline),
+                digest=digest,
+                pipelined=tuning.pipelined,
+            )
         self.logger.debug(f'Completed transfer', extra={'s3_bucket_name': s3_bucket_name, 'file_s3_key': file_s3_key})
 
-        return self.update_status_of_processed_item(item, status_table_key)
+        remote_size = sftp_client.stat(partial_filename).st_size
+        integrity_check = digest.verify(object_info)
+        if remote_size != object_size:
+            integrity_check = 'failed'
+        self.record_integrity_check(status_table_key, digest, integrity_check)
+        if integrity_check == 'failed':
+            # a corrupted partial file must not be resumed from
+            sftp_client.remove(partial_filename)
+            raise utils.DetailedValueError('Size or digest of transferred file does not match S3 object', details={
+                'file_s3_key': file_s3_key,
+                'target_filename': target_filename,
+                's3_size': object_size,
+                'remote_size': remote_size,
+                's3_etag': object_info.etag,
+                's3_sha256': object_info.sha256,
+                'transfer_etag': digest.etag,
+                'transfer_sha256': digest.sha256.hexdigest(),
+                'correlation_id': self.correlation_id,
+            })
+        self.logger.debug(f'Integrity check {integrity_check}', extra={'file_s3_key': file_s3_key, 'etag': digest.etag})
+        rename(sftp_client, partial_filename, target_filename)
+
+        return self.update_status_of_processed_item(item, status_table_key, object_size=object_size)
+
+    def remove_stale_partials(self, sftp_profile, sftp_client):
+        """
+        Deletes partial files left in the profile's target folder by crashed transfers, at most once every
+        STALE_PARTIALS_CHECK_INTERVAL seconds per folder in each container. Errors are logged and otherwise ignored.
+        """
+        try:
+            host, _, _, folder = sftp_connection_pool.get_key(sftp_profile)
+            return cache.get_or_create(
+                f'stale_partials_removed:{host}:{folder}',
+                lambda: remove_stale_partials(sftp_client, logger=self.logger),
+                ttl=STALE_PARTIALS_CHECK_INTERVAL,
+            )
+        except Exception as err:
+            self.logger.warning('Failed to remove stale partial files', extra={'exception': repr(err)})
+
+    def transfer_file(self, file_s3_key, s3_bucket_name):
+        status_table_key = self.get_status_table_key(file_s3_key)
+        item = self.get_item_and_validate_status(status_table_key, expected_statuses=TRANSFERABLE_STATUSES)
+        sftp_profile = sftp_profile_registry.get_profile(item['project_acronym'], correlation_id=self.correlation_id)
+        with sftp_connection_pool.connection(sftp_profile) as sftp:
+            self.remove_stale_partials(sftp_profile, sftp.sftp_client)
+            return self._transfer_to_sftp(sftp.sftp_client, file_s3_key, s3_bucket_name, status_table_key, item,
+                                          tuning=sftp.transfer_tuning)
+
+    def transfer_project_files(self, project_acronym, project_files, deadline=None):
+        """
+        Transfers files of a project concurrently, using one SFTP session and up to max_channels channels on it
+
+        Args:
+            project_acronym (str): project files belong to
+            project_files (list): tuples of (file_s3_key, s3_bucket_name, status_table_key, item)
+            deadline (float): time.monotonic() value after which no file is started and transfers in progress are
+                    stopped; those files are reported as failed
+
+        Returns:
+            Dict of file_s3_key: exception, for files that failed to transfer
+        """
+        failures = dict()
+        n_channels = min(self.max_channels, len(project_files))
+        try:
+            sftp_profile = sftp_profile_registry.get_profile(project_acronym, correlation_id=self.correlation_id)
+            with sftp_connection_pool.connection(sftp_profile) as sftp:
+                self.remove_stale_partials(sftp_profile, sftp.sftp_client)
+                transport = sftp.sftp_client.get_channel().get_transport()
+                target_folder = sftp.sftp_client.getcwd()
+                extra_channels = list()
+                channels = queue.Queue()
+                channels.put(sftp.sftp_client)
+                try:
+                    for _ in range(n_channels - 1):
+                        channel = paramiko.SFTPClient.from_transport(transport)
+                        extra_channels.append(channel)
+                        channel.chdir(target_folder)
+                        channels.put(channel)
+
+                    def transfer(project_file):
+                        sftp_client = channels.get()
+                        try:
+                            self.check_deadline(deadline, project_file[0])
+                            return self._transfer_to_sftp(sftp_client, *project_file, tuning=sftp.transfer_tuning,
+                                                          deadline=deadline)
+                        finally:
+                            channels.put(sftp_client)
+
+                    with ThreadPoolExecutor(max_workers=n_channels) as executor:
+                        futures = {executor.submit(transfer, x): x[0] for x in project_files}
+                        for future in as_completed(futures):
+                            err = future.exception()
+                            if err is not None:
+                                self.logger.error('Failed to transfer file', extra={
+                                    'file_s3_key': futures[future],
+                                    'project_acronym': project_acronym,
+                                    'exception': repr(err),
+                                })
+                                failures[futures[future]] = err
+                finally:
+                    for channel in extra_channels:
+                        channel.close()
+        except Exception as err:
+            self.logger.error('Failed to transfer files of project', extra={
+                'project_acronym': project_acronym,
+                'exception': repr(err),
+                'traceback': traceback.format_exc(),
+            })
+            for file_s3_key, *_ in project_files:
+                failures.setdefault(file_s3_key, err)
+        return failures
+
+    def transfer_files(self, files, deadline=None):
+        """
+        Transfers a batch of files, grouped by project so that each project's files share one SFTP session. Status
+        items are updated independently, so a failure only affects the file it relates to.
+
+        Args:
+            files: iterable of (file_s3_key, s3_bucket_name) tuples
+            deadline (float): time.monotonic() value after which no file is started and transfers in progress are
+                    stopped; those files are reported as failed, so that only they are retried
+
+        Returns:
+            Dict of file_s3_key: exception, for files that failed to transfer
+        """
+        failures = dict()
+        files_by_project = dict()
+        for file_s3_key, s3_bucket_name in files:
+            status_table_key = self.get_status_table_key(file_s3_key)
+            try:
+                item = self.get_item_and_validate_status(status_table_key, expected_statuses=TRANSFERABLE_STATUSES)
+            except Exception as err:
+                self.logger.error('Failed to validate status of file', extra={
+                    'file_s3_key': file_s3_key,
+                    'exception': repr(err),
+                })
+                failures[file_s3_key] = err
+                continue
+            files_by_project.setdefault(item['project_acronym'], list()).append(
+                (file_s3_key, s3_bucket_name, status_table_key, item)
+            )
+        for project_acronym, project_files in files_by_project.items():
+            failures.update(self.transfer_project_files(project_acronym, project_files, deadline=deadline))
+        self.logger.info('Batch transfer complete', extra={
+            'projects': list(files_by_project.keys()),
+            'failed_files': list(failures.keys()),
+        })
+        return failures
 
 
 class Cleaner:
     def __init__(self, logger, correlation_id=None):
         self.logger = logger
         self.correlation_id = correlation_id
-        self.ddb_client = Dynamodb(stack_name=STACK_NAME)
-        self.s3_client = S3Client()
+        self.ddb_client = cache.get_ddb_client(correlation_id=correlation_id)
+        self.s3_client = cache.get_s3_client()
         self.items_to_be_deleted = None
 
     def get_old_processed_items(self):
-        processed_items = self.ddb_client.scan(STATUS_TABLE, filter_attr_name='processing_status', filter_attr_values=['processed'])
         # todo: refactor this to allow for a project-specific deletion schedule (using ddb table storing project parameters)
         seven_days_ago = utils.now_with_tz() - timedelta(days=7)
+        processed_items = iter_items_by_status(self.ddb_client, 'processed', modified_before=seven_days_ago)
         old_proc_items = [x for x in processed_items if parser.isoparse(x['modified']) < seven_days_ago]
         self.items_to_be_deleted = old_proc_items
         return old_proc_items
@@ -138,7 +1103,7 @@ class Cleaner:
 
     def clean_incoming_bucket(self, s3_bucket_name=None):
         if s3_bucket_name is None:
-            s3_bucket_name = utils.get_secret("incoming-interviews-bucket")['name']
+            s3_bucket_name = cache.get_secret("incoming-interviews-bucket")['name']
         item_keys = list()
         video_keys = [x['id'] for x in self.items_to_be_deleted]
         for k in video_keys:
@@ -183,7 +1148,22 @@ def monitor_incoming_bucket(event, context):
     logger = event['logger']
     correlation_id = event['correlation_id']
     incoming_monitor = IncomingMonitor(logger=logger, correlation_id=correlation_id)
-    return incoming_monitor.main()
+    return incoming_monitor.main(full_rescan=event.get('full_rescan', False))
+
+
+@utils.lambda_wrapper
+def process_incoming_file_events(event, context):
+    """
+    Triggered by S3 ObjectCreated events on the incoming interviews bucket, delivered directly or via SQS
+    """
+    logger = event['logger']
+    correlation_id = event['correlation_id']
+    logger.debug('Event', extra={'event': event})
+    event_processor = IncomingEventProcessor(logger=logger, correlation_id=correlation_id)
+    return event_processor.main(
+        event,
+        get_remaining_time_in_millis=getattr(context, 'get_remaining_time_in_millis', None),
+    )
 
 
 @utils.lambda_wrapper
@@ -198,13 +1178,28 @@ def process_incoming_files(event, context):
             correlation_id=correlation_id,
         )
     processor = ProcessIncoming(logger=logger, correlation_id=correlation_id)
-    return processor.main()
+    return processor.main(get_remaining_time_in_millis=getattr(context, 'get_remaining_time_in_millis', None))
+
+
+@utils.lambda_wrapper
+def track_job_state(event, context):
+    """
+    Triggered by "MediaConvert Job State Change" events; invoked on a schedule with {"reconcile": true} to catch up
+    with any missed events
+    """
+    logger = event['logger']
+    correlation_id = event['correlation_id']
+    logger.debug('Event', extra={'event': event})
+    tracker = JobStateTracker(logger=logger, correlation_id=correlation_id)
+    if event.get('reconcile'):
+        return tracker.reconcile()
+    return tracker.process_event(event)
 
 
 @utils.lambda_wrapper
 def transfer_file(event, context):
     """
-    Triggered by S3 event when running on AWS
+    Transfers the file in the first record of an S3 event. Batches of S3 events are handled by transfer_files
     """
     logger = event['logger']
     correlation_id = event['correlation_id']
@@ -216,6 +1211,34 @@ def transfer_file(event, context):
     return transfer_manager.transfer_file(s3_object['key'], s3_bucket_name=bucket_name)
 
 
+@utils.lambda_wrapper
+def transfer_files(event, context):
+    """
+    Triggered by batches of S3 ObjectCreated events on the interview audio bucket, delivered via SQS. Can also be
+    invoked directly with a list of status table keys, e.g. {"status_table_keys": ["<uuid>/video/<uuid>.mp4"]}
+    """
+    logger = event['logger']
+    correlation_id = event['correlation_id']
+    logger.debug('Event', extra={'event': event})
+    transfer_manager = TransferManager(logger, correlation_id)
+    deadline = get_deadline(getattr(context, 'get_remaining_time_in_millis', None), margin=TRANSFER_TIME_MARGIN)
+    if 'status_table_keys' in event:
+        bucket_name = event.get('bucket_name', f'{STACK_NAME}-{utils.get_environment_name()}-interview-audio')
+        files = [(f'{os.path.splitext(x)[0]}.mp3', bucket_name) for x in event['status_table_keys']]
+        failures = transfer_manager.transfer_files(files, deadline=deadline)
+        return {'failed_status_table_keys': [transfer_manager.get_status_table_key(x) for x in failures.keys()]}
+
+    message_ids = dict()
+    for message_id, bucket_name, file_s3_key in iter_s3_event_records(event):
+        message_ids.setdefault((file_s3_key, bucket_name), list()).append(message_id)
+    failures = transfer_manager.transfer_files(message_ids.keys(), deadline=deadline)
+    failed_message_ids = list()
+    for (file_s3_key, bucket_name), ids in message_ids.items():
+        if file_s3_key in failures:
+            failed_message_ids.extend(x for x in ids if x is not None)
+    return {'batchItemFailures': [{'itemIdentifier': x} for x in failed_message_ids]}
+
+
 @utils.lambda_wrapper
 def clear_processed(event, context):
     logger = event['logger']
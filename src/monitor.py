@@ -17,46 +17,264 @@
 #
 import json
 import os
+import threading
 import traceback
 
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import timedelta
+from dateutil import parser
 from http import HTTPStatus
 from pprint import pprint
 from thiscovery_lib.interviews_api_utilities import InterviewsApiClient
-from thiscovery_lib.s3_utilities import S3Client
 
 import thiscovery_lib.utilities as utils
-from thiscovery_lib.core_api_utilities import CoreApiClient
 from thiscovery_lib.dynamodb_utilities import Dynamodb
-from common.constants import STACK_NAME, STATUS_TABLE, AUDIT_TABLE, PROJECTS_TABLE
-from common.helpers import parse_s3_path, get_appointment_datetime
+import common.cache_utilities as cache
+from common.constants import STACK_NAME, STATUS_TABLE, AUDIT_TABLE, PROJECTS_TABLE, CHECKPOINTS_TABLE
+from common.helpers import parse_s3_path, get_appointment_datetime, iter_ddb_items, iter_s3_objects
+
+
+# objects last modified up to this long before the checkpoint are still checked against known files, to allow for
+# S3 LastModified timestamps of multipart uploads reflecting the time the upload started, not when it completed
+CHECKPOINT_OVERLAP = timedelta(hours=2)
+IGNORE_EXTENSIONS = ['.mp3', '.flac']
+MONITOR_MAX_WORKERS = 8
+KNOWN_FILES_BATCH_SIZE = 100  # keys looked up in status table per BatchGetItem request (the API's maximum)
+# files that fail to register in this many runs (a day at the monitor's 20-minute schedule) no longer hold the
+# checkpoint back; they are logged and left to full rescans
+MAX_REGISTRATION_ATTEMPTS = 72
+CORE_API_CACHE_SIZE = 1024
+
+
+def is_interview_file(s3_path, ignore_extensions=IGNORE_EXTENSIONS):
+    """
+    Args:
+        s3_path (str): key of object in incoming bucket
+        ignore_extensions (list): list of file extensions to ignore
+
+    Returns:
+        True if s3_path is in a uuid-named folder and has an extension that is not ignored
+    """
+    folder = s3_path.split('/')[0]
+    try:
+        utils.validate_uuid(folder)
+    except utils.DetailedValueError:
+        return False
+    _, extension = os.path.splitext(s3_path)
+    return bool(extension) and (extension not in ignore_extensions)
+
+
+class CoreApiCache:
+    """
+    Run-scoped, size-bounded (LRU) memoisation of the Core API user lookups made by InterviewFile. It exposes the same
+    lookup methods as CoreApiClient, so it can be passed to InterviewFile as its core_api_client.
+    """
+    def __init__(self, core_api_client, maxsize=CORE_API_CACHE_SIZE):
+        self.core_api_client = core_api_client
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._user_ids = OrderedDict()
+        self._user_projects = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, cache, key, fetch):
+        with self._lock:
+            if key in cache:
+                cache.move_to_end(key)
+                self.hits += 1
+                return cache[key]
+            self.misses += 1
+        value = fetch()
+        with self._lock:
+            cache[key] = value
+            if len(cache) > self.maxsize:
+                cache.popitem(last=False)
+        return value
+
+    def get_user_id_by_email(self, email):
+        return self._lookup(self._user_ids, email, lambda: self.core_api_client.get_user_id_by_email(email=email))
+
+    def get_userprojects(self, user_id):
+        return self._lookup(self._user_projects, user_id, lambda: self.core_api_client.get_userprojects(user_id=user_id))
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'cached_user_ids': len(self._user_ids),
+            'cached_user_projects': len(self._user_projects),
+        }
+
+
+class AppointmentsIndex:
+    """
+    Run-scoped cache of interview appointments. Appointments are fetched once per project (i.e. per list of appointment
+    type ids) and indexed by participant email, similarly to ProjectParser._get_appointments. The lock only guards the
+    dict of futures, so fetches for different projects run concurrently and concurrent lookups for the same project
+    wait for a single fetch.
+    """
+    def __init__(self, correlation_id=None):
+        self.correlation_id = correlation_id
+        self.interviews_client = None
+        self._appointments_by_type_ids = dict()  # key: Future of appointments indexed by participant email
+        self._lock = threading.Lock()
+
+    def _fetch_appointments_by_email(self, appointment_type_ids):
+        response = self.interviews_client.get_appointments_by_type_ids(appointment_type_ids=appointment_type_ids)
+        appointments_by_email = dict()
+        for a in json.loads(response['body'])['appointments']:
+            appointments_by_email.setdefault(a['participant_email'], a)
+        return appointments_by_email
+
+    def get_appointments_by_email(self, appointment_type_ids):
+        key = tuple(appointment_type_ids)
+        with self._lock:
+            future = self._appointments_by_type_ids.get(key)
+            is_owner = future is None
+            if is_owner:
+                if self.interviews_client is None:
+                    self.interviews_client = InterviewsApiClient(correlation_id=self.correlation_id)
+                future = Future()
+                self._appointments_by_type_ids[key] = future
+        if is_owner:
+            try:
+                future.set_result(self._fetch_appointments_by_email(appointment_type_ids))
+            except BaseException as err:
+                with self._lock:
+                    del self._appointments_by_type_ids[key]  # let a later lookup retry the fetch
+                future.set_exception(err)
+        return future.result()
+
+    def get_appointment_datetime(self, appointment_type_ids, participant_email):
+        """
+        Returns:
+            Formatted datetime of participant's appointment, or None if no appointment was found
+        """
+        if appointment_type_ids:
+            appointment = self.get_appointments_by_email(appointment_type_ids).get(participant_email)
+            if appointment:
+                return get_appointment_datetime(appointment_dict=appointment, output_format='%Y-%m-%d-%H%M')
+
+
+class ProjectRoutingIndex:
+    """
+    Lookup tables built once per run from the active projects in PROJECTS_TABLE, used to resolve the project of on-demand
+    interview files (by referrer url) and live interview files (by interviewer and participant)
+    """
+    def __init__(self, active_projects):
+        self.active_projects = active_projects
+        self.projects_by_referrer = dict()
+        self.positions_by_project_id = dict()
+        self.positions_by_interviewer = dict()
+        for position, p in enumerate(active_projects):
+            referrer = p.get('on_demand_referrer')
+            if referrer:
+                self.projects_by_referrer.setdefault(referrer, p)
+            self.positions_by_project_id.setdefault(p['project_id'], set()).add(position)
+            for interviewer in p.get('interviewers', dict()).keys():
+                self.positions_by_interviewer.setdefault(interviewer, set()).add(position)
+
+    def _get_projects(self, positions):
+        """
+        Returns:
+            List of active projects at positions, in the same order as self.active_projects
+        """
+        return [self.active_projects[x] for x in sorted(positions)]
+
+    def get_on_demand_project(self, referrer_url):
+        project = self.projects_by_referrer.get(referrer_url)
+        assert project and project['filename_prefix'], f'Referrer url {referrer_url} not found in Dynamodb table {PROJECTS_TABLE}'
+        return project
+
+    def get_live_interview_project(self, interviewer, participant_project_ids, participant_email, s3_path):
+        """
+        Args:
+            interviewer (str): interviewer name, as in file metadata
+            participant_project_ids (list): ids of the projects participant is taking part in
+            participant_email (str): used in error messages
+            s3_path (str): used in error messages
+
+        Returns:
+            The only active project both interviewer and participant are taking part in
+        """
+        error_message = f'Could not resolve project of file {s3_path}.'
+        interviewer_positions = self.positions_by_interviewer.get(interviewer, set())
+        if not interviewer_positions:
+            raise utils.DetailedValueError(
+                f'{error_message} Interviewer {interviewer} is not taking part in any active project',
+                details={'active projects': self.active_projects},
+            )
+        interviewer_matches = self._get_projects(interviewer_positions)
+        if len(interviewer_matches) == 1:
+            return interviewer_matches[0]
+
+        participant_positions = set()
+        for project_id in participant_project_ids:
+            participant_positions |= self.positions_by_project_id.get(project_id, set())
+        participant_matches = self._get_projects(participant_positions)
+        if not participant_matches:
+            raise utils.DetailedValueError(
+                f'{error_message} Participant {participant_email} is not taking part in any active project.',
+                details={
+                    'active projects': self.active_projects,
+                    'interviewer_matches': interviewer_matches
+                },
+            )
+        common_matches = self._get_projects(interviewer_positions & participant_positions)
+        if not common_matches:
+            raise utils.DetailedValueError(
+                f'{error_message} Participant {participant_email} and interviewer {interviewer} active '
+                f'projects do not overlap',
+                details={
+                    'active projects': self.active_projects,
+                    'interviewer_matches': interviewer_matches,
+                    'participant_matches': participant_matches,
+                },
+            )
+        elif len(common_matches) == 1:
+            return common_matches[0]
+        raise utils.DetailedValueError(
+            f'{error_message} Participant {participant_email} and interviewer {interviewer} are '
+            f'taking part in more than one active project',
+            details={
+                'active projects': self.active_projects,
+                'interviewer_matches': interviewer_matches,
+                'participant_matches': participant_matches,
+            },
+        )
 
 
 class InterviewFile:
     def __init__(self, s3_bucket_name, s3_path, active_projects=None, core_api_client=None,
-                 ddb_client=None, s3_client=None, logger=None, correlation_id=None):
+                 ddb_client=None, s3_client=None, logger=None, correlation_id=None, appointments_index=None,
+                 routing_index=None):
         self.s3_bucket_name = s3_bucket_name
         self.s3_path = s3_path
         self.correlation_id = correlation_id
 
         self.ddb_client = ddb_client
         if ddb_client is None:
-            self.ddb_client = Dynamodb(stack_name=STACK_NAME, correlation_id=correlation_id)
+            self.ddb_client = cache.get_ddb_client(correlation_id=correlation_id)
         self.active_projects = active_projects
         if active_projects is None:
-            self.active_projects = self.ddb_client.scan(
-                table_name=PROJECTS_TABLE,
-                filter_attr_name="interview_task_status",
-                filter_attr_values=['active']
-            )
+            self.active_projects = cache.get_active_projects()
         self.logger = logger
         if logger is None:
             self.logger = utils.get_logger()
         self.core_api_client = core_api_client
         if core_api_client is None:
-            self.core_api_client = CoreApiClient(correlation_id=correlation_id)
+            self.core_api_client = cache.get_core_api_client(correlation_id=correlation_id)
         self.s3_client = s3_client
         if s3_client is None:
-            self.s3_client = S3Client()
+            self.s3_client = cache.get_s3_client()
+        self.appointments_index = appointments_index
+        if appointments_index is None:
+            self.appointments_index = AppointmentsIndex(correlation_id=correlation_id)
+        self.routing_index = routing_index
+        if routing_index is None:
+            self.routing_index = ProjectRoutingIndex(self.active_projects)
 
         self.head = self.s3_client.head_object(s3_bucket_name, s3_path)
         self.user_projects = None
@@ -74,19 +292,13 @@ class InterviewFile:
         })
 
     def _parse_on_demand_interview_metadata(self, metadata, user_id):
-        project_acronym = None
-        project_prefix = None
-        project_id = None
         interview_type = 'INT-O'
         referrer_url = metadata.get('referrer')
         question_number = metadata['question_index']
-        for p in self.active_projects:
-            if p.get('on_demand_referrer') == referrer_url:
-                project_acronym = p['id']
-                project_prefix = p['filename_prefix']
-                project_id = p['project_id']
-                break
-        assert project_prefix, f'Referrer url {referrer_url} not found in Dynamodb table {PROJECTS_TABLE}'
+        project = self.routing_index.get_on_demand_project(referrer_url)
+        project_acronym = project['id']
+        project_prefix = project['filename_prefix']
+        project_id = project['project_id']
         anon_project_specific_user_id = self._get_anon_project_specific_user_id(
             user_id=user_id,
             project_id=project_id,
@@ -95,71 +307,19 @@ class InterviewFile:
         return project_acronym, project_prefix, project_id, anon_project_specific_user_id, target_basename
 
     def _parse_live_interview_metadata(self, metadata, user_id, s3_path):
-
-        def get_appointment(appointment_type_ids, participant_email, correlation_id=None):
-            if appointment_type_ids:
-                interviews_client = InterviewsApiClient(correlation_id=correlation_id)
-                response = interviews_client.get_appointments_by_type_ids(appointment_type_ids=appointment_type_ids)
-                appointments = json.loads(response['body'])['appointments']
-                for a in appointments:
-                    if a['participant_email'] == participant_email:
-                        return get_appointment_datetime(appointment_dict=a, output_format='%Y-%m-%d-%H%M')
-
         interview_type = 'INT-L'
         interviewer = metadata['interviewer']
         if len(self.active_projects) == 1:
             project = self.active_projects[0]
         else:
-            interviewer_matches = list()
-            participant_matches = list()
             if self.user_projects is None:
                 self.user_projects = self.core_api_client.get_userprojects(user_id=user_id)
-            participant_projects = [x['project_id'] for x in self.user_projects]
-            for p in self.active_projects:
-                if interviewer in p['interviewers'].keys():
-                    interviewer_matches.append(p)
-                if p['project_id'] in participant_projects:
-                    participant_matches.append(p)
-            error_message = f'Could not resolve project of file {s3_path}.'
-            if not interviewer_matches:
-                raise utils.DetailedValueError(
-                    f'{error_message} Interviewer {interviewer} is not taking part in any active project',
-                    details={'active projects': self.active_projects},
-                )
-            elif len(interviewer_matches) == 1:
-                project = interviewer_matches[0]
-            else:
-                if not participant_matches:
-                    raise utils.DetailedValueError(
-                        f'{error_message} Participant {metadata["email"]} is not taking part in any active project.',
-                        details={
-                            'active projects': self.active_projects,
-                            'interviewer_matches': interviewer_matches
-                        },
-                    )
-                common_matches = [x for x in participant_matches if x in interviewer_matches]
-                if not common_matches:
-                    raise utils.DetailedValueError(
-                        f'{error_message} Participant {metadata["email"]} and interviewer {interviewer} active '
-                        f'projects do not overlap',
-                        details={
-                            'active projects': self.active_projects,
-                            'interviewer_matches': interviewer_matches,
-                            'participant_matches': participant_matches,
-                        },
-                    )
-                elif len(common_matches) == 1:
-                    project = common_matches[0]
-                else:
-                    raise utils.DetailedValueError(
-                        f'{error_message} Participant {metadata["email"]} and interviewer {interviewer} are '
-                        f'taking part in more than one active project',
-                        details={
-                            'active projects': self.active_projects,
-                            'interviewer_matches': interviewer_matches,
-                            'participant_matches': participant_matches,
-                        },
-                    )
+            project = self.routing_index.get_live_interview_project(
+                interviewer=interviewer,
+                participant_project_ids=[x['project_id'] for x in self.user_projects],
+                participant_email=metadata['email'],
+                s3_path=s3_path,
+            )
         project_acronym = project['id']
         project_prefix = project['filename_prefix']
         project_id = project['project_id']
@@ -169,10 +329,9 @@ class InterviewFile:
             project_id=project_id,
         )
         target_basename = f'{project_prefix}_{interview_type}_{interviewer_initials}_{anon_project_specific_user_id}'
-        appointment_datetime = get_appointment(
+        appointment_datetime = self.appointments_index.get_appointment_datetime(
             appointment_type_ids=project.get('type_ids'),
             participant_email=self.participant_email,
-            correlation_id=self.correlation_id,
         )
         if appointment_datetime:
             target_basename += f'_{appointment_datetime}'
@@ -247,26 +406,135 @@ class InterviewFile:
 
 class IncomingMonitor:
 
-    def __init__(self, logger, correlation_id=None):
+    def __init__(self, logger, correlation_id=None, max_workers=MONITOR_MAX_WORKERS):
+        """
+        Args:
+            logger:
+            correlation_id:
+            max_workers (int): number of threads used to resolve metadata of new files and add them to status table
+        """
         self.logger = logger
         self.correlation_id = correlation_id
-        self.core_api_client = CoreApiClient(correlation_id=correlation_id)
-        self.ddb_client = Dynamodb(stack_name=STACK_NAME, correlation_id=correlation_id)
-        self.s3_client = S3Client()
-        self.active_projects = self.ddb_client.scan(
-            table_name=PROJECTS_TABLE,
-            filter_attr_name="interview_task_status",
-            filter_attr_values=['active']
+        self.max_workers = max_workers
+        self._thread_local = threading.local()
+        self.core_api_client = cache.get_core_api_client(correlation_id=correlation_id)
+        self.core_api_cache = CoreApiCache(self.core_api_client)
+        self.appointments_index = AppointmentsIndex(correlation_id=correlation_id)
+        self.ddb_client = cache.get_ddb_client(correlation_id=correlation_id)
+        self.s3_client = cache.get_s3_client()
+        self.active_projects = cache.get_active_projects()
+        self.routing_index = ProjectRoutingIndex(self.active_projects)
+
+    def get_known_files(self, keys=None):
+        """
+        Args:
+            keys (list): if specified, only these keys (at most KNOWN_FILES_BATCH_SIZE) are looked up, with BatchGetItem;
+                    otherwise the whole status table is read
+
+        Returns:
+            Set of the ids of items in status table, read projecting only the id attribute
+        """
+        status_table = self.ddb_client.get_table(STATUS_TABLE)
+        if keys is None:
+            return {x['id'] for x in iter_ddb_items(
+                status_table.scan,
+                ProjectionExpression='#id',
+                ExpressionAttributeNames={'#id': 'id'},
+            )}
+        known_files = set()
+        request_items = {status_table.name: {
+            'Keys': [{'id': x} for x in keys],
+            'ProjectionExpression': '#id',
+            'ExpressionAttributeNames': {'#id': 'id'},
+        }}
+        while request_items:
+            response = status_table.meta.client.batch_get_item(RequestItems=request_items)
+            known_files.update(x['id'] for x in response['Responses'].get(status_table.name, list()))
+            request_items = response.get('UnprocessedKeys')
+        return known_files
+
+    def _get_thread_ddb_client(self):
+        """
+        boto3 resources are not thread-safe, so each worker thread gets its own Dynamodb client
+        """
+        ddb_client = getattr(self._thread_local, 'ddb_client', None)
+        if ddb_client is None:
+            ddb_client = Dynamodb(stack_name=STACK_NAME, correlation_id=self.correlation_id)
+            self._thread_local.ddb_client = ddb_client
+        return ddb_client
+
+    def register_file(self, s3_bucket_name, s3_path):
+        """
+        Resolves metadata of a new file and adds it to status table; runs in worker threads of main
+
+        Returns:
+            s3_path if file was added to status table; None otherwise
+        """
+        interview_file = InterviewFile(
+            s3_bucket_name=s3_bucket_name,
+            s3_path=s3_path,
+            active_projects=self.active_projects,
+            logger=self.logger,
+            correlation_id=self.correlation_id,
+            core_api_client=self.core_api_cache,
+            ddb_client=self._get_thread_ddb_client(),
+            s3_client=self.s3_client,
+            appointments_index=self.appointments_index,
+            routing_index=self.routing_index,
         )
-        self.known_files = [x['id'] for x in self.ddb_client.scan(STATUS_TABLE)]
+        try:
+            interview_file.add_to_status_table()
+            return s3_path
+        except:
+            self.logger.error(
+                f'Failed to add {s3_path} to ddb table {STATUS_TABLE}',
+                extra={
+                    'traceback': traceback.format_exc()
+                },
+            )
+
+    def get_checkpoint(self, s3_bucket_name, with_registration_failures=False):
+        """
+        Args:
+            s3_bucket_name (str): name of monitored bucket
+            with_registration_failures (bool): if True, also return the registration failures saved with the checkpoint
 
-    def main(self, ignore_extensions=['.mp3', '.flac'], bucket_name=None):
+        Returns:
+            LastModified high-water mark (datetime) saved by the last run over s3_bucket_name, or None if there is no checkpoint;
+            if with_registration_failures, a tuple of that and a dict of s3_path: number of consecutive runs that failed
+            to register the file
+        """
+        item = self.ddb_client.get_item(CHECKPOINTS_TABLE, key=s3_bucket_name)
+        checkpoint = parser.isoparse(item['last_modified']) if item else None
+        if not with_registration_failures:
+            return checkpoint
+        registration_failures = {k: int(v) for k, v in (item or dict()).get('registration_failures', dict()).items()}
+        return checkpoint, registration_failures
+
+    def save_checkpoint(self, s3_bucket_name, last_modified, registration_failures=None):
+        return self.ddb_client.put_item(
+            table_name=CHECKPOINTS_TABLE,
+            key=s3_bucket_name,
+            item_type='incoming_bucket_checkpoint',
+            item_details=None,
+            item={
+                'last_modified': last_modified.isoformat(),
+                'registration_failures': registration_failures or dict(),
+            },
+            update_allowed=True,
+            correlation_id=self.correlation_id,
+        )
+
+    def main(self, ignore_extensions=IGNORE_EXTENSIONS, bucket_name=None, full_rescan=False):
         """
         The main processing routine
 
         Args:
             ignore_extensions (list): list of file extensions to ignore
             bucket_name (str): specify a different target bucket; used for testing
+            full_rescan (bool): if True, ignore the saved checkpoint and check every object in the bucket (reconciliation mode);
+                    otherwise only objects modified after the checkpoint (minus CHECKPOINT_OVERLAP) are checked, and
+                    only their keys are looked up in status table
 
         Returns:
         """
@@ -274,41 +542,87 @@ class IncomingMonitor:
         if bucket_name:
             s3_bucket_name = f'{STACK_NAME}-{utils.get_environment_name()}-{bucket_name}'
         else:
-            s3_bucket_name = utils.get_secret("incoming-interviews-bucket", namespace_override='/prod/')['name']
-        objs = self.s3_client.list_objects(s3_bucket_name)['Contents']
-        for o in objs:
-            s3_path = o['Key']
-            self.logger.debug(f'Working on file {s3_path}')
-            folder = s3_path.split('/')[0]
-
-            # skip anything that is not in a uuid-named folder
-            try:
-                utils.validate_uuid(folder)
-            except utils.DetailedValueError:
-                continue
-
-            if s3_path not in self.known_files:
-                _, extension = os.path.splitext(s3_path)
-                if extension and (extension not in ignore_extensions):
-                    interview_file = InterviewFile(
-                        s3_bucket_name=s3_bucket_name,
-                        s3_path=s3_path,
-                        active_projects=self.active_projects,
-                        logger=self.logger,
-                        correlation_id=self.correlation_id,
-                        core_api_client=self.core_api_client,
-                        ddb_client=self.ddb_client,
-                        s3_client=self.s3_client,
-                    )
-                    try:
-                        interview_file.add_to_status_table()
-                        files_added_to_status_table.append(s3_path)
-                    except:
-                        self.logger.error(
-                            f'Failed to add {s3_path} to ddb table {STATUS_TABLE}',
-                            extra={
-                                'traceback': traceback.format_exc()
-                            },
-                        )
+            s3_bucket_name = cache.get_secret("incoming-interviews-bucket", namespace_override='/prod/')['name']
+
+        checkpoint, previous_failures = self.get_checkpoint(s3_bucket_name, with_registration_failures=True)
+        if full_rescan:
+            checkpoint = None
+        self.logger.info('Scanning incoming bucket', extra={
+            's3_bucket_name': s3_bucket_name,
+            'full_rescan': full_rescan,
+            'checkpoint': str(checkpoint),
+        })
+        high_water_mark = checkpoint
+        failures = dict()  # s3_path: LastModified of files that could not be registered
+        skipped_count = 0
+        # without a checkpoint every object is checked, so reading all keys of status table at once is cheaper;
+        # otherwise only the keys of objects modified after the checkpoint are looked up, in batches
+        known_files = self.get_known_files() if checkpoint is None else None
+        candidates = dict()  # s3_path: LastModified of interview files not yet looked up in status table
+
+        def collect_results(done_futures):
+            for f in done_futures:
+                s3_path, last_modified = pending.pop(f)
+                registered_path = f.result()
+                if registered_path:
+                    files_added_to_status_table.append(registered_path)
+                else:
+                    failures[s3_path] = last_modified
+
+        def register_unknown_candidates():
+            known = known_files if known_files is not None else self.get_known_files(list(candidates))
+            for s3_path, last_modified in candidates.items():
+                if s3_path in known:
+                    continue
+                pending[executor.submit(self.register_file, s3_bucket_name, s3_path)] = (s3_path, last_modified)
+                # bound the number of queued files, so the bucket walk does not run too far ahead of the workers
+                if len(pending) >= 2 * self.max_workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect_results(done)
+            candidates.clear()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = dict()  # future: (s3_path, LastModified) of file being registered
+            for o in iter_s3_objects(self.s3_client, s3_bucket_name):
+                s3_path = o['Key']
+                last_modified = o['LastModified']
+                if (high_water_mark is None) or (last_modified > high_water_mark):
+                    high_water_mark = last_modified
+                if checkpoint and (last_modified <= checkpoint - CHECKPOINT_OVERLAP):
+                    skipped_count += 1
+                    continue
+                self.logger.debug(f'Working on file {s3_path}')
+                if is_interview_file(s3_path, ignore_extensions):
+                    candidates[s3_path] = last_modified
+                    if len(candidates) >= KNOWN_FILES_BATCH_SIZE:
+                        register_unknown_candidates()
+            if candidates:
+                register_unknown_candidates()
+            done, _ = wait(pending)
+            collect_results(done)
+
+        # files that failed to register (e.g. participant not yet in Core API) must be retried by the next run, so the
+        # checkpoint is not moved past the oldest of them, unless they have failed in MAX_REGISTRATION_ATTEMPTS runs
+        registration_failures = {x: previous_failures.get(x, 0) + 1 for x in failures}
+        abandoned_files = [x for x, n in registration_failures.items() if n >= MAX_REGISTRATION_ATTEMPTS]
+        if abandoned_files:
+            self.logger.error('Files failed to register in too many runs; checkpoint no longer held back by them', extra={
+                'abandoned_files': abandoned_files,
+                'max_registration_attempts': MAX_REGISTRATION_ATTEMPTS,
+            })
+        retried_failures = [failures[x] for x in failures if x not in abandoned_files]
+        oldest_failure = min(retried_failures) if retried_failures else None
+        if (oldest_failure is not None) and (high_water_mark is not None) and (oldest_failure < high_water_mark):
+            high_water_mark = oldest_failure
+        if high_water_mark:
+            self.save_checkpoint(s3_bucket_name, high_water_mark, registration_failures=registration_failures)
+        self.logger.info('Completed scan of incoming bucket', extra={
+            'files_added_to_status_table': len(files_added_to_status_table),
+            'skipped_older_than_checkpoint': skipped_count,
+            'failed_files': len(failures),
+            'oldest_failure': str(oldest_failure),
+            'high_water_mark': str(high_water_mark),
+            'core_api_cache': self.core_api_cache.stats(),
+        })
         return files_added_to_status_table
 
@@ -16,33 +16,53 @@
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
 import csv
+import gzip
 import json
-import pysftp
+import shutil
+import tempfile
 import thiscovery_lib.utilities as utils
 
 from http import HTTPStatus
-from thiscovery_lib.core_api_utilities import CoreApiClient
-from thiscovery_lib.dynamodb_utilities import Dynamodb
 from thiscovery_lib.interviews_api_utilities import InterviewsApiClient
 from thiscovery_lib.lambda_utilities import Lambda
 
-from common.constants import STACK_NAME, PROJECTS_TABLE
-from common.helpers import get_sftp_parameters, get_appointment_datetime
+import common.cache_utilities as cache
+from common.constants import STACK_NAME
+from common.helpers import get_appointment_datetime, sftp_profile_registry
+from common.sftp_utilities import sftp_connection_pool, tune_file
 
 
 APPOINTMENT_TYPE_KEY = 'appointment_type'
 APPOINTMENT_DATETIME_KEY = 'appointment_datetime'
 INTERVIEWER_KEY = 'interviewer'
 
+CSV_SPOOL_MAX_SIZE = 16 * 1024 * 1024  # bytes of rendered CSV kept in memory before spooling to /tmp
+CSV_UPLOAD_CHUNK_SIZE = 1024 * 1024  # bytes per write to SDHS
+CSV_COMPRESSION_MODES = [None, 'gzip']
+
+
+class Utf8Writer:
+    """
+    Minimal text wrapper for csv writers over binary files. io.TextIOWrapper cannot be used because, until Python 3.11,
+    SpooledTemporaryFile does not implement the io.IOBase interface it requires.
+    """
+    def __init__(self, binary_f):
+        self.binary_f = binary_f
+
+    def write(self, s):
+        return self.binary_f.write(s.encode('utf-8'))
+
 
 class ProjectParser:
-    def __init__(self, project_acronym, project_id, filename_prefix, appointment_type_ids=None, core_api_client=None, logger=None, correlation_id=None):
+    def __init__(self, project_acronym, project_id, filename_prefix, appointment_type_ids=None, compression=None,
+                 core_api_client=None, logger=None, correlation_id=None):
         """
         Args:
             project_acronym (str): CORONET, COPD, etc
             project_id (str): project id in thiscovery db
             filename_prefix (str):
             appointment_type_ids (list): ids of acuity appointment types associated with project
+            compression (str): None or 'gzip'; compression of CSV file uploaded to SDHS
             core_api_client:
             logger:
             correlation_id:
@@ -51,13 +71,20 @@ class ProjectParser:
         self.project_id = project_id
         self.filename_prefix = filename_prefix
         self.appointment_type_ids = appointment_type_ids
+        if compression not in CSV_COMPRESSION_MODES:
+            raise utils.DetailedValueError('Unsupported compression mode', details={
+                'compression': compression,
+                'supported_modes': CSV_COMPRESSION_MODES,
+                'project_acronym': project_acronym,
+            })
+        self.compression = compression
         self.logger = logger
         self.correlation_id = correlation_id
         if logger is None:
             self.logger = utils.get_logger()
         self.core_api_client = core_api_client
         if core_api_client is None:
-            self.core_api_client = CoreApiClient(correlation_id=correlation_id)
+            self.core_api_client = cache.get_core_api_client(correlation_id=correlation_id)
 
         self.users = None
         self.appointments_by_user_id = dict()
@@ -122,33 +149,60 @@ class ProjectParser:
             **user
         }
 
+    def render_participant_csv(self, buffer):
+        """
+        Writes the participant CSV to buffer, gzip compressed if self.compression is 'gzip'
+
+        Args:
+            buffer: binary file-like object
+
+        Returns:
+            Number of bytes written to buffer
+        """
+        fieldnames = [
+            'anon_project_specific_user_id',
+            'first_name',
+            'last_name',
+            'email',
+            APPOINTMENT_TYPE_KEY,
+            APPOINTMENT_DATETIME_KEY,
+            INTERVIEWER_KEY,
+        ]
+        start = buffer.tell()
+        binary_f = buffer
+        if self.compression == 'gzip':
+            binary_f = gzip.GzipFile(fileobj=buffer, mode='wb')
+        writer = csv.DictWriter(Utf8Writer(binary_f), fieldnames=fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        if self.appointments_by_user_email:
+            for user in self.users:
+                writer.writerow(self._parse_user(user))
+        else:
+            writer.writerows(self.users)
+        if binary_f is not buffer:
+            binary_f.close()  # writes gzip trailer; does not close buffer
+        return buffer.tell() - start
+
     def transfer_participant_csv(self):
         self._get_users()
         self._get_appointments()
-        sdhs_params, target_folder, cnopts = get_sftp_parameters(self.project_acronym)
+        sftp_profile = sftp_profile_registry.get_profile(self.project_acronym, correlation_id=self.correlation_id)
         target_filename = f'{self.filename_prefix}_participants_{utils.now_with_tz().strftime("%Y-%m-%d")}.csv'
+        if self.compression == 'gzip':
+            target_filename += '.gz'
         if self.users:
-            with pysftp.Connection(**sdhs_params, cnopts=cnopts) as sftp:
-                sftp.chdir(target_folder)
-                with sftp.sftp_client.open(target_filename, 'w') as csvfile:
-                    fieldnames = [
-                        'anon_project_specific_user_id',
-                        'first_name',
-                        'last_name',
-                        'email',
-                        APPOINTMENT_TYPE_KEY,
-                        APPOINTMENT_DATETIME_KEY,
-                        INTERVIEWER_KEY,
-                    ]
-                    writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
-                    writer.writeheader()
-                    if self.appointments_by_user_email:
-                        for user in self.users:
-                            writer.writerow(self._parse_user(user))
-                    else:
-                        writer.writerows(self.users)
+            # rendering the whole file first means it is uploaded in a few large pipelined writes, rather than one
+            # SFTP round trip per row
+            with tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_MAX_SIZE) as buffer:
+                file_size = self.render_participant_csv(buffer)
+                buffer.seek(0)
+                with sftp_connection_pool.connection(sftp_profile) as sftp:
+                    with sftp.sftp_client.open(target_filename, 'wb') as sdhs_f:
+                        tune_file(sdhs_f, sftp.transfer_tuning)
+                        shutil.copyfileobj(buffer, sdhs_f, CSV_UPLOAD_CHUNK_SIZE)
             self.logger.debug(f'Completed transfer', extra={
                 'csv_filename': target_filename,
+                'file_size': file_size,
             })
         else:
             self.logger.info(f'{self.project_acronym} does not have any participants; skipped', extra={
@@ -164,16 +218,15 @@ class ParticipantInfoTransferManager:
             self.logger = utils.get_logger()
         self.core_api_client = core_api_client
         if core_api_client is None:
-            self.core_api_client = CoreApiClient(correlation_id=correlation_id)
+            self.core_api_client = cache.get_core_api_client(correlation_id=correlation_id)
         self.ddb_client = ddb_client
         if ddb_client is None:
-            self.ddb_client = Dynamodb(stack_name=STACK_NAME, correlation_id=correlation_id)
+            self.ddb_client = cache.get_ddb_client(correlation_id=correlation_id)
         self.correlation_id = correlation_id
 
         self.lambda_client = Lambda(stack_name=STACK_NAME)
 
-        self.projects_to_process = [x for x in self.ddb_client.scan(
-            table_name=PROJECTS_TABLE,
+        self.projects_to_process = [x for x in cache.get_projects(
             filter_attr_name="participant_data_to_sdhs",
             filter_attr_values=[True]
         ) if x["interview_task_status"] == 'active']
@@ -188,6 +241,7 @@ class ParticipantInfoTransferManager:
                     'project_id': project['project_id'],
                     'filename_prefix': project['filename_prefix'],
                     'appointment_type_ids': project.get('appointment_type_ids'),
+                    'compression': project.get('participant_data_compression'),
                     'correlation_id': self.correlation_id,
                 },
                 invocation_type='Event'
@@ -206,6 +260,7 @@ def parse_project_participants(event, context):
         project_id=event['project_id'],
         filename_prefix=event['filename_prefix'],
         appointment_type_ids=event.get('appointment_type_ids'),
+        compression=event.get('compression'),
         core_api_client=event.get('core_api_client'),
         logger=event.get('logger'),
         correlation_id=event['correlation_id'],
@@ -0,0 +1,91 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Benchmark of the two audio extraction backends of ProcessIncoming, reporting wall-clock time from the start of the
+upload of each input file to the .mp3 being available in S3.
+
+Runs against AWS: inputs are uploaded to the mock incoming bucket, under a folder that IncomingMonitor ignores, and the
+.mp3 files are written next to them, so that no transfer to SDHS is triggered. The ffmpeg backend runs locally, so
+requires ffmpeg on PATH (or FFMPEG_PATH), and its timings include the round trips between this machine and S3.
+
+Usage:
+    python -m tests.benchmarks.benchmark_audio_extraction input_file [input_file ...]
+"""
+import os
+import sys
+import time
+import uuid
+
+import thiscovery_lib.utilities as utils
+from thiscovery_lib.s3_utilities import S3Client
+
+from src.common.constants import STACK_NAME
+from src.common.extraction_utilities import FfmpegAudioExtractor, get_audio_output_key
+from src.common.mediaconvert_utilities import MediaConvertClient
+
+
+BENCHMARK_FOLDER = 'benchmark'  # not a uuid, so IncomingMonitor does not treat uploads as interview files
+POLL_INTERVAL = 1  # seconds
+MAX_WAIT = 30 * 60  # seconds
+
+
+def wait_for_object(s3_client, bucket_name, key):
+    s3_client.client.get_waiter('object_exists').wait(
+        Bucket=bucket_name,
+        Key=key,
+        WaiterConfig={'Delay': POLL_INTERVAL, 'MaxAttempts': MAX_WAIT // POLL_INTERVAL},
+    )
+
+
+def extract_with_ffmpeg(s3_client, bucket_name, key):
+    extractor = FfmpegAudioExtractor(s3_client=s3_client, audio_bucket_name=bucket_name)
+    assert extractor.available, 'ffmpeg is not available'
+    extractor.extract(input_bucket_name=bucket_name, input_file_s3_key=key)
+
+
+def extract_with_mediaconvert(s3_client, bucket_name, key):
+    media_convert_client = MediaConvertClient()
+    media_convert_client.audio_bucket_name = bucket_name
+    media_convert_client.create_audio_extraction_job(input_bucket_name=bucket_name, input_file_s3_key=key)
+    wait_for_object(s3_client, bucket_name, get_audio_output_key(key))
+
+
+def main(*input_files):
+    s3_client = S3Client()
+    bucket_name = f'{STACK_NAME}-{utils.get_environment_name()}-mockincomingbucket'
+    for input_file in input_files:
+        size = os.path.getsize(input_file)
+        print(f'{os.path.basename(input_file)} ({size / 1024 / 1024:.1f} MB)')
+        for label, extract in [('ffmpeg', extract_with_ffmpeg), ('mediaconvert', extract_with_mediaconvert)]:
+            key = f'{BENCHMARK_FOLDER}/video/{uuid.uuid4()}{os.path.splitext(input_file)[1]}'
+            start = time.perf_counter()
+            s3_client.client.upload_file(input_file, bucket_name, key)
+            uploaded = time.perf_counter()
+            extract(s3_client, bucket_name, key)
+            end = time.perf_counter()
+            audio_size = s3_client.client.head_object(Bucket=bucket_name, Key=get_audio_output_key(key))['ContentLength']
+            print(f'  {label:<14} upload {uploaded - start:>7.2f} s  extraction {end - uploaded:>7.2f} s  '
+                  f'upload to .mp3 {end - start:>7.2f} s  ({audio_size / 1024:.0f} KB)')
+            for k in [key, get_audio_output_key(key)]:
+                s3_client.client.delete_object(Bucket=bucket_name, Key=k)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    main(*sys.argv[1:])
@@ -0,0 +1,92 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Local benchmark of the paginated bucket walk used by IncomingMonitor.
+
+Lists a fake bucket of 100k keys (no AWS calls) and reports time to first key, total time and
+peak memory allocated while walking the bucket.
+
+Usage:
+    python -m tests.benchmarks.benchmark_bucket_listing [number_of_keys]
+"""
+import datetime
+import sys
+import time
+import tracemalloc
+import uuid
+
+from src.common.helpers import iter_s3_objects
+
+
+class FakePaginator:
+    """
+    Mimics a boto3 list_objects_v2 paginator; pages are generated on demand, like S3 would return them
+    """
+    def __init__(self, n_keys):
+        self.n_keys = n_keys
+
+    def paginate(self, Bucket, PaginationConfig=None, **kwargs):
+        page_size = (PaginationConfig or dict()).get('PageSize', 1000)
+        last_modified = datetime.datetime(2020, 6, 11, 13, 14, 28, tzinfo=datetime.timezone.utc)
+        for start in range(0, self.n_keys, page_size):
+            yield {
+                'Contents': [
+                    {
+                        'Key': f'{uuid.UUID(int=i)}/video/{uuid.UUID(int=i + 1)}.mp4',
+                        'LastModified': last_modified,
+                        'Size': 10084809,
+                        'ETag': '"c0fe76df38abb72163b583e0da06fbb9"',
+                    } for i in range(start, min(start + page_size, self.n_keys))
+                ]
+            }
+
+
+class FakeBotoS3:
+    def __init__(self, n_keys):
+        self.n_keys = n_keys
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'list_objects_v2'
+        return FakePaginator(self.n_keys)
+
+
+class FakeS3Client:
+    def __init__(self, n_keys):
+        self.client = FakeBotoS3(n_keys)
+
+
+def main(n_keys=100000):
+    s3_client = FakeS3Client(n_keys)
+    tracemalloc.start()
+    start = time.perf_counter()
+    time_to_first_key = None
+    count = 0
+    for _ in iter_s3_objects(s3_client, 'fake-incoming-bucket'):
+        if time_to_first_key is None:
+            time_to_first_key = time.perf_counter() - start
+        count += 1
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'Listed {count} keys in {elapsed:.2f} s ({count / elapsed:.0f} keys/s)')
+    print(f'Time to first key: {time_to_first_key * 1000:.2f} ms')
+    print(f'Peak traced memory: {peak / 1024:.0f} KiB')
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,108 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Micro-benchmark of ProjectRoutingIndex against the linear scans it replaced.
+
+Builds a few hundred synthetic active projects and resolves on-demand and live interview files with both approaches.
+
+Usage:
+    python -m tests.benchmarks.benchmark_project_routing [number_of_projects] [number_of_lookups]
+"""
+import random
+import sys
+import time
+import uuid
+
+from src.monitor import ProjectRoutingIndex
+
+
+def make_projects(n_projects, n_interviewers=50):
+    interviewers = [f'Interviewer {i}' for i in range(n_interviewers)]
+    projects = list()
+    for i in range(n_projects):
+        projects.append({
+            'id': f'project-{i}',
+            'project_id': str(uuid.UUID(int=i)),
+            'filename_prefix': f'PREFIX-{i}',
+            'on_demand_referrer': f'https://start.myinterview.com/this-institute/project-{i}',
+            'interviewers': {x: {'initials': x[-2:], 'name': x} for x in random.sample(interviewers, 3)},
+        })
+    return projects
+
+
+def linear_on_demand(active_projects, referrer_url):
+    for p in active_projects:
+        if p.get('on_demand_referrer') == referrer_url:
+            return p
+
+
+def linear_live(active_projects, interviewer, participant_projects):
+    interviewer_matches = list()
+    participant_matches = list()
+    for p in active_projects:
+        if interviewer in p['interviewers'].keys():
+            interviewer_matches.append(p)
+        if p['project_id'] in participant_projects:
+            participant_matches.append(p)
+    if len(interviewer_matches) == 1:
+        return interviewer_matches[0]
+    common_matches = [x for x in participant_matches if x in interviewer_matches]
+    if len(common_matches) == 1:
+        return common_matches[0]
+
+
+def indexed_live(index, interviewer, participant_projects):
+    try:
+        return index.get_live_interview_project(interviewer, participant_projects, 'participant@email.co.uk', 'benchmark')
+    except Exception:
+        return None
+
+
+def timed(label, function, lookups):
+    start = time.perf_counter()
+    results = [function(*x) for x in lookups]
+    elapsed = time.perf_counter() - start
+    print(f'{label:<30} {elapsed * 1000:>9.2f} ms ({elapsed / len(lookups) * 1e6:.2f} us/lookup)')
+    return results
+
+
+def main(n_projects=300, n_lookups=2000):
+    random.seed(1)
+    projects = make_projects(n_projects)
+
+    start = time.perf_counter()
+    index = ProjectRoutingIndex(projects)
+    print(f'Built index of {n_projects} projects in {(time.perf_counter() - start) * 1000:.2f} ms')
+
+    on_demand_lookups = [(random.choice(projects)['on_demand_referrer'],) for _ in range(n_lookups)]
+    linear = timed('linear on-demand', lambda x: linear_on_demand(projects, x), on_demand_lookups)
+    indexed = timed('indexed on-demand', index.get_on_demand_project, on_demand_lookups)
+    assert linear == indexed
+
+    live_lookups = list()
+    for _ in range(n_lookups):
+        project = random.choice(projects)
+        participant_projects = [project['project_id']] + [x['project_id'] for x in random.sample(projects, 2)]
+        live_lookups.append((random.choice(list(project['interviewers'].keys())), participant_projects))
+    linear = timed('linear live', lambda *x: linear_live(projects, *x), live_lookups)
+    indexed = timed('indexed live', lambda *x: indexed_live(index, *x), live_lookups)
+    assert linear == indexed
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
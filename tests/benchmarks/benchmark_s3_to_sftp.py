@@ -0,0 +1,140 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Benchmark of S3ToSftpTransfer against a local SFTP server and a fake S3 that throttles each GET stream, reporting MB/s
+and peak memory allocated by Python during each transfer (tracemalloc).
+
+Start a local SFTP server first, e.g.:
+    docker run -p 2222:22 -d atmoz/sftp foo:pass:::upload
+
+Usage:
+    python -m tests.benchmarks.benchmark_s3_to_sftp [size_mb] [host] [port] [username] [password] [folder]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+import paramiko
+
+from src.common.transfer_utilities import S3ToSftpTransfer
+
+
+class FakeBody:
+    """
+    Streams a memoryview of the fake object, so that serving a range does not itself allocate a copy of it
+    """
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = len(self.view) if size < 0 else min(self.pos + size, len(self.view))
+        data = bytes(self.view[self.pos:end])
+        self.pos = end
+        return data
+
+    def readinto(self, b):
+        n = min(len(b), len(self.view) - self.pos)
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        pass
+
+
+class FakeBotoS3:
+    """
+    Serves an in-memory object; every GET pays a first-byte latency and streams at a capped per-connection bandwidth
+    """
+    def __init__(self, data, first_byte_latency=0.03, stream_bandwidth=40 * 1024 * 1024):
+        self.data = data
+        self.first_byte_latency = first_byte_latency
+        self.stream_bandwidth = stream_bandwidth
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.data)}
+
+    def get_object(self, Bucket, Key, Range=None):
+        status_code = 200
+        body = memoryview(self.data)
+        if Range:
+            start, end = [int(x) for x in Range.replace('bytes=', '').split('-')]
+            body = body[start:end + 1]
+            status_code = 206
+        time.sleep(self.first_byte_latency + len(body) / self.stream_bandwidth)
+        return {
+            'ResponseMetadata': {'HTTPStatusCode': status_code},
+            'ContentLength': len(body),
+            'Body': FakeBody(body),
+        }
+
+
+class FakeS3Client:
+    def __init__(self, data):
+        self.client = FakeBotoS3(data)
+
+    def download_fileobj(self, bucket, key, fileobj):
+        """
+        Single-stream baseline, equivalent to the previous transfer path
+        """
+        fileobj.write(self.client.get_object(Bucket=bucket, Key=key)['Body'].read())
+
+
+def open_sftp(host, port, username, password):
+    transport = paramiko.Transport((host, port))
+    transport.connect(username=username, password=password)
+    return paramiko.SFTPClient.from_transport(transport)
+
+
+def report(label, size, elapsed):
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tracemalloc.start()
+    print(f'{label:<45} {elapsed:>7.2f} s {size / elapsed / 1024 / 1024:>8.1f} MB/s {peak / 1024 / 1024:>8.1f} MB peak')
+
+
+def main(size_mb=256, host='localhost', port=2222, username='foo', password='pass', folder='upload'):
+    size = int(size_mb) * 1024 * 1024
+    s3_client = FakeS3Client(os.urandom(size))
+    sftp = open_sftp(host, int(port), username, password)
+    sftp.chdir(folder)
+    tracemalloc.start()
+
+    start = time.perf_counter()
+    with sftp.open('benchmark_baseline.bin', 'wb') as f:
+        s3_client.download_fileobj('fake-bucket', 'fake-key', f)
+    report('baseline (single stream)', size, time.perf_counter() - start)
+
+    for chunk_mb, max_workers in [(8, 1), (8, 4), (8, 8), (16, 4), (4, 8)]:
+        engine = S3ToSftpTransfer(s3_client, chunk_size=chunk_mb * 1024 * 1024, max_workers=max_workers)
+        start = time.perf_counter()
+        with sftp.open('benchmark_engine.bin', 'wb', bufsize=0) as f:
+            engine.transfer('fake-bucket', 'fake-key', f)
+        report(f'S3ToSftpTransfer chunk={chunk_mb}MB workers={max_workers}', size, time.perf_counter() - start)
+        assert sftp.stat('benchmark_engine.bin').st_size == size
+
+    sftp.remove('benchmark_baseline.bin')
+    sftp.remove('benchmark_engine.bin')
+    sftp.close()
+    tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,188 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Local benchmark of status table scans against queries of the processing_status GSI.
+
+Uses an in-process stand-in for a DynamoDB table (no AWS calls) that pages results in 1 MB pages and accounts for read
+capacity like DynamoDB does for eventually consistent reads (0.5 RCU per 4 KB read, per page). Scans pay for every
+item in the table; queries only for the items in the matching key range. Reported latency is the local processing time
+plus a modelled round trip per page.
+
+Usage:
+    python -m tests.benchmarks.benchmark_status_queries [number_of_items ...]
+"""
+import bisect
+import datetime
+import math
+import sys
+import time
+import uuid
+
+from boto3.dynamodb.conditions import Attr
+
+from src.common.constants import STATUS_INDEX
+from src.common.helpers import format_ddb_timestamp, iter_ddb_items, iter_items_by_status
+
+
+ITEM_SIZE = 700  # bytes; typical size of a status table item
+PAGE_SIZE = 1024 * 1024  # DynamoDB returns at most 1 MB per scan or query page
+PAGE_LATENCY = 0.015  # seconds; modelled round trip of each page request
+NOW = datetime.datetime(2021, 3, 1, tzinfo=datetime.timezone.utc)
+
+
+def evaluate(condition, item):
+    """
+    Evaluates the subset of boto3 conditions used by the status table helpers against item
+    """
+    expression = condition.get_expression()
+    operator, values = expression['operator'], expression['values']
+    if operator == 'AND':
+        return all(evaluate(x, item) for x in values)
+    value = item.get(values[0].name)
+    if value is None:
+        return False
+    if operator == '=':
+        return value == values[1]
+    if operator == 'BETWEEN':
+        return values[1] <= value <= values[2]
+    if operator == '>=':
+        return value >= values[1]
+    if operator == '<':
+        return value < values[1]
+    raise NotImplementedError(operator)
+
+
+def get_equality_value(condition, name):
+    expression = condition.get_expression()
+    if expression['operator'] == 'AND':
+        for x in expression['values']:
+            value = get_equality_value(x, name)
+            if value is not None:
+                return value
+    elif (expression['operator'] == '=') and (expression['values'][0].name == name):
+        return expression['values'][1]
+
+
+class FakeStatusTable:
+    """
+    Items are generated on demand from their position in the table, so that a million of them fit in memory. About 0.5%
+    of items are new and the rest processed, with modified timestamps spread over the last year.
+    """
+    def __init__(self, n_items):
+        self.n_items = n_items
+        self.consumed_rcu = 0
+        self.pages = 0
+        self._last_query = (None, None)  # key condition and matching index positions, reused while paging
+        self.index = dict()
+        for i in range(n_items):
+            item = self.get_item(i)
+            self.index.setdefault(item['processing_status'], list()).append((item['modified'], i))
+        for entries in self.index.values():
+            entries.sort()
+
+    def get_item(self, i):
+        return {
+            'id': f'{uuid.UUID(int=i)}/video/{uuid.UUID(int=i + 1)}.mp4',
+            'processing_status': 'new' if i % 200 == 0 else 'processed',
+            'modified': format_ddb_timestamp(NOW - datetime.timedelta(seconds=(i * 7919) % (365 * 24 * 60 * 60))),
+        }
+
+    def _page(self, candidates, condition, start):
+        """
+        Reads up to PAGE_SIZE bytes of candidates, starting at position start, and returns the items matching condition
+        """
+        items = list()
+        end = min(start + PAGE_SIZE // ITEM_SIZE, len(candidates))
+        for i in candidates[start:end]:
+            item = self.get_item(i)
+            if (condition is None) or evaluate(condition, item):
+                items.append(item)
+        self.consumed_rcu += math.ceil((end - start) * ITEM_SIZE / 4096) * 0.5
+        self.pages += 1
+        response = {'Items': items}
+        if end < len(candidates):
+            response['LastEvaluatedKey'] = {'position': end}
+        return response
+
+    def scan(self, FilterExpression=None, ExclusiveStartKey=None, **kwargs):
+        start = ExclusiveStartKey['position'] if ExclusiveStartKey else 0
+        return self._page(range(self.n_items), FilterExpression, start)
+
+    def query(self, IndexName, KeyConditionExpression, ExclusiveStartKey=None, **kwargs):
+        assert IndexName == STATUS_INDEX
+        # the key condition selects a contiguous range of the index; items outside it are neither read nor billed
+        if self._last_query[0] is not KeyConditionExpression:
+            status = get_equality_value(KeyConditionExpression, 'processing_status')
+            entries = self.index.get(status, list())
+            # like DynamoDB, locate the start of the sort key range instead of evaluating every entry in the partition
+            start = 0
+            for x in KeyConditionExpression.get_expression()['values']:
+                if hasattr(x, 'get_expression') and x.get_expression()['operator'] in ('BETWEEN', '>='):
+                    start = bisect.bisect_left(entries, (x.get_expression()['values'][1],))
+            matches = list()
+            for modified, i in entries[start:]:
+                if not evaluate(KeyConditionExpression, {'processing_status': status, 'modified': modified}):
+                    break
+                matches.append(i)
+            self._last_query = (KeyConditionExpression, matches)
+        candidates = self._last_query[1]
+        start = ExclusiveStartKey['position'] if ExclusiveStartKey else 0
+        return self._page(candidates, None, start)
+
+
+class FakeDynamodb:
+    def __init__(self, table):
+        self.table = table
+
+    def get_table(self, table_name):
+        return self.table
+
+
+def timed(label, table, function):
+    table.consumed_rcu, table.pages = 0, 0
+    start = time.perf_counter()
+    n_results = len(function())
+    elapsed = time.perf_counter() - start + table.pages * PAGE_LATENCY
+    print(f'  {label:<40} {n_results:>8} items {table.pages:>6} pages {table.consumed_rcu:>10.1f} RCU {elapsed:>9.3f} s')
+
+
+def main(*sizes):
+    seven_days_ago = NOW - datetime.timedelta(days=7)
+    for n_items in sizes or (10000, 100000, 1000000):
+        table = FakeStatusTable(n_items)
+        ddb_client = FakeDynamodb(table)
+        print(f'{n_items} items')
+        timed('scan new', table, lambda: list(iter_ddb_items(
+            table.scan, FilterExpression=Attr('processing_status').eq('new'))))
+        timed('query new', table, lambda: list(iter_items_by_status(ddb_client, 'new')))
+        timed('scan processed older than 7 days', table, lambda: [
+            x for x in iter_ddb_items(table.scan, FilterExpression=Attr('processing_status').eq('processed'))
+            if x['modified'] < format_ddb_timestamp(seven_days_ago)
+        ])
+        timed('query processed older than 7 days', table, lambda: list(iter_items_by_status(
+            ddb_client, 'processed', modified_before=seven_days_ago)))
+        # cleaner runs every 12 hours, so in steady state only about half a day of items has aged past the cutoff
+        timed('query processed aged in last 12 hours', table, lambda: list(iter_items_by_status(
+            ddb_client, 'processed',
+            modified_after=seven_days_ago - datetime.timedelta(hours=12),
+            modified_before=seven_days_ago,
+        )))
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -27,6 +27,8 @@ import tests.test_data as td
 from local.dev_config import TEST_ON_AWS, DELETE_TEST_DATA
 from thiscovery_lib.dynamodb_utilities import Dynamodb
 from src.main import PROJECTS_TABLE, STATUS_TABLE, STACK_NAME
+from src.common.constants import CHECKPOINTS_TABLE
+import common.cache_utilities as cache  # same module object used by src.main and src.monitor
 from src.monitor import IncomingMonitor, InterviewFile
 
 
@@ -108,6 +110,7 @@ class SdhsTransferTestCase(test_tools.BaseTestCase):
         super().setUpClass()
         cls.ddb_client = Dynamodb(stack_name=STACK_NAME)
         cls.ddb_client.delete_all(STATUS_TABLE)
+        cls.ddb_client.delete_all(CHECKPOINTS_TABLE)
         for k, v in cls.test_projects.items():
             cls.ddb_client.put_item(
                 table_name=PROJECTS_TABLE,
@@ -117,6 +120,7 @@ class SdhsTransferTestCase(test_tools.BaseTestCase):
                 item=v,
                 update_allowed=True,
             )
+        cache.invalidate()
 
     @classmethod
     def tearDownClass(cls):
@@ -0,0 +1,61 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import tests.testing_utilities as test_utils  # sets environment variables used in testing
+import thiscovery_dev_tools.testing_tools as test_tools
+
+from time import sleep
+
+import common.cache_utilities as cache
+
+
+class TestCacheUtilities(test_tools.BaseTestCase):
+
+    def setUp(self):
+        cache.invalidate()
+        self.factory_calls = 0
+
+    def factory(self):
+        self.factory_calls += 1
+        return self.factory_calls
+
+    def test_get_or_create_reuses_value(self):
+        self.assertEqual(1, cache.get_or_create('test', self.factory))
+        self.assertEqual(1, cache.get_or_create('test', self.factory))
+        self.assertEqual(1, self.factory_calls)
+
+    def test_get_or_create_expires_value(self):
+        self.assertEqual(1, cache.get_or_create('test', self.factory, ttl=0.1))
+        sleep(0.2)
+        self.assertEqual(2, cache.get_or_create('test', self.factory, ttl=0.1))
+
+    def test_invalidate(self):
+        cache.get_or_create('test', self.factory)
+        cache.invalidate('test')
+        self.assertEqual(2, cache.get_or_create('test', self.factory))
+        cache.invalidate()
+        self.assertEqual(3, cache.get_or_create('test', self.factory))
+
+    def test_get_secret_cached(self):
+        secret = cache.get_secret('sdhs-connection')
+        self.assertIs(secret, cache.get_secret('sdhs-connection'))
+
+    def test_get_core_api_client_does_not_share_correlation_id(self):
+        client_1 = cache.get_core_api_client(correlation_id='correlation-1')
+        client_2 = cache.get_core_api_client(correlation_id='correlation-2')
+        self.assertEqual('correlation-1', client_1.correlation_id)
+        self.assertEqual('correlation-2', client_2.correlation_id)
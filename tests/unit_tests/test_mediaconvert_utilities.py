@@ -19,8 +19,12 @@ import tests.testing_utilities as test_utils  # sets environment variables used
 import thiscovery_dev_tools.testing_tools as test_tools
 import thiscovery_lib.utilities as utils
 
+import time
 from time import sleep
 
+from botocore.exceptions import ClientError
+
+import src.common.mediaconvert_utilities as mcu
 from src.common.mediaconvert_utilities import MediaConvertClient
 from src.common.constants import STACK_NAME
 
@@ -43,3 +47,61 @@ class TestMediaConvertClient(test_tools.BaseTestCase):
         listed_job = response['Jobs'][0]
         self.assertEqual(created_job['Id'], listed_job['Id'])
         self.assertIn(listed_job['Status'], ['PROGRESSING', 'COMPLETE'])
+
+    def test_get_audio_extraction_settings(self):
+        settings = MediaConvertClient.get_audio_extraction_settings('s3://input-bucket/a/video/b.mp4', 's3://output-bucket/a/$fn$')
+        self.assertEqual('s3://input-bucket/a/video/b.mp4', settings['Inputs'][0]['FileInput'])
+        self.assertEqual('s3://output-bucket/a/$fn$', settings['OutputGroups'][0]['OutputGroupSettings']['FileGroupSettings']['Destination'])
+        self.assertEqual(
+            mcu.AUDIO_EXTRACTION_SETTINGS['OutputGroups'][0]['Outputs'],
+            settings['OutputGroups'][0]['Outputs'],
+        )
+        # shared settings object must not be modified
+        self.assertIsNone(mcu.AUDIO_EXTRACTION_SETTINGS['Inputs'][0]['FileInput'])
+        self.assertIsNone(mcu.AUDIO_EXTRACTION_SETTINGS['OutputGroups'][0]['OutputGroupSettings']['FileGroupSettings']['Destination'])
+        self.assertTrue(self.media_convert_client.role_arn.endswith(':role/MediaConvert_Default_Role'))
+
+    def test_create_audio_extraction_job_is_idempotent(self):
+        key = 'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp4'
+        token = mcu.get_client_request_token(key, 0)
+        jobs = [self.media_convert_client.create_audio_extraction_job(
+            f'{STACK_NAME}-{utils.get_environment_name()}-mockincomingbucket',
+            key,
+            ClientRequestToken=token,
+        )['Job'] for _ in range(2)]
+        self.assertEqual(jobs[0]['Id'], jobs[1]['Id'])
+        self.assertNotEqual(token, mcu.get_client_request_token(key, 1))
+
+
+class TestSubmissionRateLimiting(test_tools.BaseTestCase):
+
+    def test_token_bucket(self):
+        bucket = mcu.TokenBucket(rate=20, capacity=5)
+        start = time.monotonic()
+        for _ in range(15):
+            bucket.acquire()
+        # 5 tokens are available straight away; the other 10 take 0.5 seconds to accrue
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+
+    def test_call_with_backoff_retries_throttled_calls(self):
+        calls = list()
+
+        def throttled_twice():
+            calls.append(time.monotonic())
+            if len(calls) <= 2:
+                raise ClientError({'Error': {'Code': 'TooManyRequestsException', 'Message': 'Too many requests'}}, 'CreateJob')
+            return 'created'
+
+        self.assertEqual('created', mcu.call_with_backoff(throttled_twice))
+        self.assertEqual(3, len(calls))
+
+    def test_call_with_backoff_raises_other_errors(self):
+        calls = list()
+
+        def bad_request():
+            calls.append(1)
+            raise ClientError({'Error': {'Code': 'BadRequestException', 'Message': 'Bad request'}}, 'CreateJob')
+
+        with self.assertRaises(ClientError):
+            mcu.call_with_backoff(bad_request)
+        self.assertEqual(1, len(calls))
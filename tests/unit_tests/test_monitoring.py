@@ -27,7 +27,7 @@ import tests.testing_utilities as test_utils
 from thiscovery_lib.dynamodb_utilities import Dynamodb
 from thiscovery_lib.lambda_utilities import Lambda
 from src.common.constants import STATUS_TABLE, STACK_NAME
-from src.monitor import IncomingMonitor, InterviewFile
+from src.monitor import CoreApiCache, IncomingMonitor, InterviewFile, MAX_REGISTRATION_ATTEMPTS
 
 
 class TestMonitoring(test_utils.SdhsTransferTestCase):
@@ -56,6 +56,7 @@ class TestMonitoring(test_utils.SdhsTransferTestCase):
             ddb_client=self.monitor.ddb_client,
             s3_client=self.monitor.s3_client,
             logger=self.monitor.logger,
+            appointments_index=self.monitor.appointments_index,
         )
 
     def test_01_parse_on_demand_interview_metadata_ok(self):
@@ -189,6 +190,73 @@ class TestMonitoring(test_utils.SdhsTransferTestCase):
             self.assertEqual(td.test_s3_files[k]['expected_target_basename'], item['target_basename'])
             self.ddb_client.delete_item(table_name=STATUS_TABLE, key=k)
 
+    def test_09b_incoming_monitor_main_skips_files_older_than_checkpoint(self):
+        monitor = IncomingMonitor(utils.get_logger())
+        monitor.save_checkpoint(self.bucket_name, utils.now_with_tz())
+
+        # checkpoint is more recent than test files, so an incremental run should ignore them
+        self.assertEqual(list(), monitor.main(bucket_name='mockincomingbucket'))
+
+        # but a full rescan should find them again
+        files_added_to_status_table = monitor.main(bucket_name='mockincomingbucket', full_rescan=True)
+        self.assertCountEqual(self.test_files_keys, files_added_to_status_table)
+        for k in self.test_files_keys:
+            self.ddb_client.delete_item(table_name=STATUS_TABLE, key=k)
+
+    def test_09c_incoming_monitor_checkpoint_does_not_pass_failed_files(self):
+        failing_key = self.test_files_keys[0]
+
+        class PartlyFailingMonitor(IncomingMonitor):
+            def register_file(self, s3_bucket_name, s3_path):
+                if s3_path == failing_key:
+                    return None
+                return super().register_file(s3_bucket_name, s3_path)
+
+        monitor = PartlyFailingMonitor(utils.get_logger())
+        files_added_to_status_table = monitor.main(bucket_name='mockincomingbucket', full_rescan=True)
+        self.assertNotIn(failing_key, files_added_to_status_table)
+        failing_file_last_modified = monitor.s3_client.client.head_object(
+            Bucket=self.bucket_name, Key=failing_key)['LastModified']
+        self.assertLessEqual(monitor.get_checkpoint(self.bucket_name), failing_file_last_modified)
+
+        # the next incremental run picks up the file that failed
+        self.assertEqual([failing_key], IncomingMonitor(utils.get_logger()).main(bucket_name='mockincomingbucket'))
+        for k in self.test_files_keys:
+            self.ddb_client.delete_item(table_name=STATUS_TABLE, key=k)
+
+    def test_09c2_incoming_monitor_checkpoint_passes_abandoned_files(self):
+        failing_key = self.test_files_keys[0]
+
+        class PartlyFailingMonitor(IncomingMonitor):
+            def register_file(self, s3_bucket_name, s3_path):
+                if s3_path == failing_key:
+                    return None
+                return super().register_file(s3_bucket_name, s3_path)
+
+        monitor = PartlyFailingMonitor(utils.get_logger())
+        monitor.save_checkpoint(self.bucket_name, utils.now_with_tz(), registration_failures={
+            failing_key: MAX_REGISTRATION_ATTEMPTS - 1,
+        })
+        monitor.main(bucket_name='mockincomingbucket', full_rescan=True)
+        newest_last_modified = max(
+            monitor.s3_client.client.head_object(Bucket=self.bucket_name, Key=k)['LastModified']
+            for k in self.test_files_keys
+        )
+        checkpoint, registration_failures = monitor.get_checkpoint(self.bucket_name, with_registration_failures=True)
+        self.assertEqual(MAX_REGISTRATION_ATTEMPTS, registration_failures[failing_key])
+        self.assertGreaterEqual(checkpoint, newest_last_modified)
+        for k in self.test_files_keys[1:]:
+            self.ddb_client.delete_item(table_name=STATUS_TABLE, key=k)
+
+    def test_09d_core_api_cache(self):
+        cache = CoreApiCache(self.monitor.core_api_client, maxsize=1)
+        for _ in range(3):
+            self.assertEqual(self.test_user['id'], cache.get_user_id_by_email(email=self.test_user['email']))
+        self.assertEqual({'hits': 2, 'misses': 1, 'cached_user_ids': 1, 'cached_user_projects': 0}, cache.stats())
+        cache.get_userprojects(user_id=self.test_user['id'])
+        cache.get_userprojects(user_id='8518c7ed-1df4-45e9-8dc4-d49b57ae0663')
+        self.assertEqual(1, cache.stats()['cached_user_projects'])
+
     @unittest.skipUnless(os.environ['TEST_ON_AWS'] == 'True', 'Invokes lambda on AWS')
     def test_10_monitor_lambda_working_on_aws(self):
         lambda_client = Lambda(stack_name=STACK_NAME)
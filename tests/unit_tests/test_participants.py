@@ -15,6 +15,9 @@
 #   A copy of the GNU Affero General Public License is available in the
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
+import csv
+import gzip
+import io
 import os
 import thiscovery_lib.utilities as utils
 import unittest
@@ -73,6 +76,41 @@ class TestParticipants(test_utils.SdhsTransferTestCase):
         result = pp.transfer_participant_csv()
         self.assertEqual(HTTPStatus.OK, result)
 
+    def test_03b_transfer_participant_csv_gzip_ok(self):
+        project_acronym = 'unittest-1'
+        pp = p.ProjectParser(
+            project_acronym=project_acronym,
+            project_id=self.test_projects[project_acronym]['project_id'],
+            filename_prefix=self.test_projects[project_acronym]['filename_prefix'],
+            appointment_type_ids=['17271544'],
+            compression='gzip',
+        )
+        result = pp.transfer_participant_csv()
+        self.assertEqual(HTTPStatus.OK, result)
+
+    def test_03c_render_participant_csv(self):
+        pp = p.ProjectParser(
+            project_acronym='PSFU-07',
+            project_id=self.test_project_id,
+            filename_prefix='PSFU-07-file',
+            compression='gzip',
+        )
+        pp._get_users()
+        buffer = io.BytesIO()
+        file_size = pp.render_participant_csv(buffer)
+        self.assertEqual(len(buffer.getvalue()), file_size)
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(buffer.getvalue()).decode('utf-8'))))
+        self.assertCountEqual([x['email'] for x in self.expected_users], [x['email'] for x in rows])
+
+    def test_03d_unsupported_compression(self):
+        with self.assertRaises(utils.DetailedValueError):
+            p.ProjectParser(
+                project_acronym='PSFU-07',
+                project_id=self.test_project_id,
+                filename_prefix='PSFU-07-file',
+                compression='zip',
+            )
+
     def test_04_parse_project_participants_ok(self):
         project_acronym = 'unittest-1'
         lambda_event = {
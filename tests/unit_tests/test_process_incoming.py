@@ -16,7 +16,10 @@
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
 import copy
+import datetime
+import json
 import os
+import time
 import unittest
 from http import HTTPStatus
 from pprint import pprint
@@ -26,7 +29,10 @@ import thiscovery_lib.utilities as utils
 import tests.test_data as td
 import tests.testing_utilities as test_utils
 from src.common.constants import STACK_NAME, STATUS_TABLE
-from src.main import ProcessIncoming, IncomingMonitor
+from src.common.extraction_utilities import FFMPEG_MAX_CONCURRENCY, FfmpegAudioExtractor, get_audio_output_key, \
+    get_ffmpeg_path
+from src.common.helpers import iter_items_by_status, update_item_if_status
+from src.main import ProcessIncoming, IncomingMonitor, IncomingEventProcessor, JobStateTracker, MAX_AUDIO_EXTRACTION_ATTEMPTS
 from src.monitor import InterviewFile
 
 
@@ -57,6 +63,176 @@ class TestProcessIncoming(test_utils.SdhsTransferTestCase):
             )
         self.ddb_client.delete_all(STATUS_TABLE)
 
+    def test_iter_items_by_status(self):
+        key = 'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp4'
+        file = InterviewFile(
+            s3_bucket_name=f'{STACK_NAME}-{utils.get_environment_name()}-mockincomingbucket',
+            s3_path=key,
+        )
+        file.add_to_status_table()
+        time.sleep(2)  # global secondary indexes are updated asynchronously
+        one_hour_ago = utils.now_with_tz() - datetime.timedelta(hours=1)
+        self.assertEqual([key], [x['id'] for x in iter_items_by_status(self.ddb_client, 'new')])
+        self.assertEqual([key], [x['id'] for x in iter_items_by_status(self.ddb_client, 'new', modified_after=one_hour_ago)])
+        self.assertEqual([], list(iter_items_by_status(self.ddb_client, 'new', modified_before=one_hour_ago)))
+        self.assertEqual([], list(iter_items_by_status(self.ddb_client, 'processed')))
+        self.ddb_client.delete_all(STATUS_TABLE)
+
+    @staticmethod
+    def get_test_s3_event(key):
+        return {
+            "Records": [
+                {
+                    "eventVersion": "2.1",
+                    "eventSource": "aws:s3",
+                    "awsRegion": "eu-west-1",
+                    "eventTime": "2020-10-13T11:03:26.628Z",
+                    "eventName": "ObjectCreated:CompleteMultipartUpload",
+                    "s3": {
+                        "s3SchemaVersion": "1.0",
+                        "bucket": {
+                            "name": f"{STACK_NAME}-{utils.get_environment_name()}-mockincomingbucket",
+                        },
+                        "object": {
+                            "key": key,
+                            "size": 10084809,
+                        }
+                    }
+                }
+            ],
+        }
+
+    def test_incoming_event_processor_s3_event(self):
+        k = 'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp4'
+        event_processor = IncomingEventProcessor(utils.get_logger())
+        result = event_processor.main(self.get_test_s3_event(k))
+        self.assertEqual([k], result['files_added_to_status_table'])
+        self.assertEqual(list(), result['batchItemFailures'])
+        item = self.ddb_client.get_item(STATUS_TABLE, key=k)
+        self.assertEqual('audio extraction job submitted', item['processing_status'])
+        self.assertEqual(1, item['audio_extraction_attempts'])
+
+        # a duplicate event should be skipped
+        result = event_processor.main(self.get_test_s3_event(k))
+        self.assertEqual(list(), result['files_added_to_status_table'])
+        self.ddb_client.delete_all(STATUS_TABLE)
+
+    def test_incoming_event_processor_sqs_event(self):
+        keys = [
+            'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp4',
+            'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/non-existent-file.mp4',
+        ]
+        sqs_event = {
+            "Records": [
+                {
+                    "messageId": f"message-{i}",
+                    "eventSource": "aws:sqs",
+                    "body": json.dumps(self.get_test_s3_event(k)),
+                } for i, k in enumerate(keys)
+            ]
+        }
+        event_processor = IncomingEventProcessor(utils.get_logger())
+        result = event_processor.main(sqs_event)
+        self.assertEqual(keys[:1], result['files_added_to_status_table'])
+        self.assertEqual([{'itemIdentifier': 'message-1'}], result['batchItemFailures'])
+        self.ddb_client.delete_all(STATUS_TABLE)
+
+    def test_submit_audio_extraction_job_stores_job_id(self):
+        k = 'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp4'
+        IncomingEventProcessor(utils.get_logger()).main(self.get_test_s3_event(k))
+        item = self.ddb_client.get_item(STATUS_TABLE, key=k)
+        self.assertTrue(item['mediaconvert_job_id'])
+        self.assertEqual('SUBMITTED', item['mediaconvert_job_status'])
+        self.ddb_client.delete_all(STATUS_TABLE)
+
+    def test_submit_audio_extraction_job_adopts_job_of_interrupted_submission(self):
+        k = 'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp4'
+        IncomingEventProcessor(utils.get_logger()).main(self.get_test_s3_event(k))
+        # simulate a run interrupted after creating the job but before recording it
+        self.ddb_client.update_item(STATUS_TABLE, k, {
+            'processing_status': 'new',
+            'audio_extraction_attempts': 0,
+        })
+        item = self.ddb_client.get_item(STATUS_TABLE, key=k)
+        self.process_incoming.submit_audio_extraction_job(
+            key=k,
+            source_bucket=item['source_bucket'],
+            audio_extraction_attempts=0,
+            item=item,
+        )
+        updated_item = self.ddb_client.get_item(STATUS_TABLE, key=k)
+        self.assertEqual(item['mediaconvert_job_id'], updated_item['mediaconvert_job_id'])
+        self.assertEqual(item['mediaconvert_submission_started'], updated_item['mediaconvert_submission_started'])
+        self.assertEqual(1, updated_item['audio_extraction_attempts'])
+        self.ddb_client.delete_all(STATUS_TABLE)
+
+    def test_update_item_if_status_does_not_revert_processed_item(self):
+        k = 'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp4'
+        InterviewFile(
+            s3_bucket_name=f'{STACK_NAME}-{utils.get_environment_name()}-mockincomingbucket',
+            s3_path=k,
+        ).add_to_status_table()
+        self.ddb_client.update_item(STATUS_TABLE, k, {'processing_status': 'processed'})
+        response = update_item_if_status(self.ddb_client, k, 'audio extraction in progress', {
+            'processing_status': 'audio extraction job submitted',
+        })
+        self.assertIsNone(response)
+        self.assertEqual('processed', self.ddb_client.get_item(STATUS_TABLE, key=k)['processing_status'])
+        self.ddb_client.delete_all(STATUS_TABLE)
+
+    def test_select_backend(self):
+        process_incoming = ProcessIncoming(
+            utils.get_logger(),
+            audio_extractor=FfmpegAudioExtractor(s3_client=None, audio_bucket_name=None, ffmpeg_path='ffmpeg'),
+            fast_path_max_sizes={'video': 1024, 'audio': 4096},
+        )
+        self.assertEqual('ffmpeg', process_incoming.select_backend('uuid/video/a.mp4', 'bucket', object_size=1024))
+        self.assertEqual('mediaconvert', process_incoming.select_backend('uuid/video/a.mp4', 'bucket', object_size=1025))
+        self.assertEqual('ffmpeg', process_incoming.select_backend('uuid/audio/a.m4a', 'bucket', object_size=4096))
+        self.assertEqual('mediaconvert', process_incoming.select_backend('uuid/other/a.mp4', 'bucket', object_size=1))
+
+    def test_ffmpeg_extractor_does_not_wait(self):
+        extractor = FfmpegAudioExtractor(s3_client=None, audio_bucket_name=None, ffmpeg_path='ffmpeg')
+        with self.assertRaises(utils.DetailedValueError):
+            extractor.extract('bucket', 'uuid/video/a.mp4', deadline=time.monotonic() + extractor.timeout - 1)
+        for _ in range(FFMPEG_MAX_CONCURRENCY):
+            extractor._semaphore.acquire()
+        try:
+            with self.assertRaises(utils.DetailedValueError):
+                extractor.extract('bucket', 'uuid/video/a.mp4')
+        finally:
+            for _ in range(FFMPEG_MAX_CONCURRENCY):
+                extractor._semaphore.release()
+
+    def test_get_audio_output_key(self):
+        self.assertEqual('uuid/video/a.mp3', get_audio_output_key('uuid/video/a.mp4'))
+
+    @unittest.skipIf(get_ffmpeg_path() is None, 'ffmpeg is not available')
+    def test_ffmpeg_fast_path(self):
+        k = 'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp4'
+        event_processor = IncomingEventProcessor(utils.get_logger())
+        event_processor.incoming_processor.fast_path_max_sizes = {'video': 10 ** 12, 'audio': 10 ** 12}
+        event_processor.main(self.get_test_s3_event(k))
+        item = self.ddb_client.get_item(STATUS_TABLE, key=k)
+        self.assertEqual('ffmpeg', item['extraction_backend'])
+        self.assertEqual('audio extraction job submitted', item['processing_status'])
+        audio_bucket_name = event_processor.incoming_processor.audio_extractor.audio_bucket_name
+        head = event_processor.s3_client.client.head_object(Bucket=audio_bucket_name, Key=get_audio_output_key(k))
+        self.assertEqual(item['audio_output_size'], head['ContentLength'])
+        self.ddb_client.delete_all(STATUS_TABLE)
+
+    @unittest.skipIf(get_ffmpeg_path() is None, 'ffmpeg is not available')
+    def test_failed_ffmpeg_extraction_publishes_no_output(self):
+        k = 'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/non-existent-file.mp4'
+        extractor = self.process_incoming.audio_extractor
+        with self.assertRaises(utils.DetailedValueError):
+            extractor.extract(f'{STACK_NAME}-{utils.get_environment_name()}-mockincomingbucket', k)
+        response = extractor.s3_client.client.list_objects_v2(
+            Bucket=extractor.audio_bucket_name,
+            Prefix=get_audio_output_key(k),
+        )
+        self.assertEqual(0, response['KeyCount'])
+
     @unittest.skipUnless(os.environ['TEST_ON_AWS'] == 'True', 'Invokes lambda on AWS')
     def test_process_incoming_lambda_working_on_aws(self):
         """
@@ -68,3 +244,86 @@ class TestProcessIncoming(test_utils.SdhsTransferTestCase):
         )
         self.assertNotIn('FunctionError', response.keys())
         self.assertEqual(list(), response['Payload'])
+
+
+class TestJobStateTracker(test_utils.SdhsTransferTestCase):
+    key = 'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp4'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tracker = JobStateTracker(utils.get_logger())
+
+    def setUp(self):
+        IncomingEventProcessor(utils.get_logger()).main(TestProcessIncoming.get_test_s3_event(self.key))
+        self.item = self.ddb_client.get_item(STATUS_TABLE, key=self.key)
+
+    def tearDown(self):
+        self.ddb_client.delete_all(STATUS_TABLE)
+
+    def get_job_state_change_event(self, status, job_id=None, **detail):
+        return {
+            "source": "aws.mediaconvert",
+            "detail-type": "MediaConvert Job State Change",
+            "detail": {
+                "status": status,
+                "jobId": job_id or self.item['mediaconvert_job_id'],
+                "userMetadata": {
+                    "application": STACK_NAME,
+                    "environment": utils.get_environment_name(),
+                    "status_table_key": self.key,
+                },
+                **detail,
+            },
+        }
+
+    def test_complete_event(self):
+        event = self.get_job_state_change_event('COMPLETE', outputGroupDetails=[
+            {'outputDetails': [{'durationInMs': 61000}]},
+        ])
+        self.tracker.process_event(event)
+        item = self.ddb_client.get_item(STATUS_TABLE, key=self.key)
+        self.assertEqual('COMPLETE', item['mediaconvert_job_status'])
+        self.assertEqual(61000, item['audio_duration_ms'])
+        self.assertEqual('audio extraction job submitted', item['processing_status'])
+
+    def test_superseded_job_is_ignored(self):
+        event = self.get_job_state_change_event('ERROR', job_id='superseded-job-id', errorCode=1010)
+        self.assertIsNone(self.tracker.process_event(event))
+        item = self.ddb_client.get_item(STATUS_TABLE, key=self.key)
+        self.assertEqual(1, item['audio_extraction_attempts'])
+
+    def test_failed_job_is_resubmitted_until_attempts_run_out(self):
+        for attempt in range(1, MAX_AUDIO_EXTRACTION_ATTEMPTS):
+            event = self.get_job_state_change_event('ERROR', errorCode=1010, errorMessage='Input file not found')
+            self.tracker.process_event(event)
+            item = self.ddb_client.get_item(STATUS_TABLE, key=self.key)
+            self.assertEqual(attempt + 1, item['audio_extraction_attempts'])
+            self.assertNotEqual(self.item['mediaconvert_job_id'], item['mediaconvert_job_id'])
+            self.assertEqual(1010, item['mediaconvert_error_code'])
+            self.item = item
+        self.tracker.process_event(self.get_job_state_change_event('ERROR', errorCode=1010))
+        item = self.ddb_client.get_item(STATUS_TABLE, key=self.key)
+        self.assertEqual('audio extraction failed', item['processing_status'])
+        self.assertEqual(MAX_AUDIO_EXTRACTION_ATTEMPTS, item['audio_extraction_attempts'])
+
+    def test_event_of_other_environment_is_ignored(self):
+        event = self.get_job_state_change_event('COMPLETE')
+        event['detail']['userMetadata']['environment'] = 'some-other-environment'
+        self.assertIsNone(self.tracker.process_event(event))
+
+    def test_reconcile(self):
+        """
+        The job of the test item is still being processed (or has just failed, as the test file is a mock), so
+        reconcile should at most update that item
+        """
+        time.sleep(2)  # global secondary indexes are updated asynchronously
+        reconciled = self.tracker.reconcile()
+        self.assertLessEqual(set(reconciled.keys()), {self.key})
+
+    def test_get_output_group_details_of_listed_job(self):
+        job = {'Status': 'COMPLETE', 'OutputGroupDetails': [{'OutputDetails': [{'DurationInMs': 61000}]}]}
+        output_details = self.tracker.get_output_group_details(job, self.key)[0]['outputDetails'][0]
+        self.assertEqual(61000, output_details['durationInMs'])
+        audio_bucket_name = self.tracker.media_convert_client.audio_bucket_name
+        self.assertEqual([f's3://{audio_bucket_name}/{get_audio_output_key(self.key)}'], output_details['outputFilePaths'])
@@ -15,7 +15,10 @@
 #   A copy of the GNU Affero General Public License is available in the
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
+import datetime
+import hashlib
 import os
+import time
 import unittest
 from http import HTTPStatus
 from pprint import pprint
@@ -26,7 +29,10 @@ import tests.testing_utilities as test_utils
 from thiscovery_lib.dynamodb_utilities import Dynamodb
 from thiscovery_lib.lambda_utilities import Lambda
 from src.common.constants import STATUS_TABLE, STACK_NAME
-from src.common.helpers import get_sftp_parameters
+from src.common.helpers import get_sftp_parameters, sftp_profile_registry, SftpProfileRegistry
+from src.common.sftp_utilities import auto_tune, get_partial_filename, is_unsupported_operation, parse_transfer_tuning, \
+    remove_stale_partials, sftp_connection_pool, SFTP_MAX_REQUEST_SIZE, SFTP_MIN_REQUEST_SIZE, SFTP_PIPELINE_DEPTH
+from src.common.transfer_utilities import S3ObjectInfo, TransferDigest, write_view
 from src.main import TransferManager
 
 
@@ -64,6 +70,34 @@ class TestTransferManager(test_utils.SdhsTransferTestCase):
         self.assertEqual('ftpuser', sdhs_params['username'])
         self.assertCountEqual(['username', 'password', 'host', 'port'], sdhs_params.keys())
 
+    def test_sftp_profile_registry(self):
+        registry = SftpProfileRegistry()
+        profile = registry.get_profile('unittest-1')
+        self.assertEqual('ftpuser', profile.target_folder)
+        self.assertIs(profile, registry.get_profile('unittest-1'))
+        with self.assertRaises(TypeError):
+            profile.connection_params['username'] = 'someone-else'
+        registry.refresh()
+        self.assertIsNot(profile, registry.get_profile('unittest-1'))
+        with self.assertRaises(utils.ObjectDoesNotExistError):
+            registry.get_profile('non-existent-project')
+
+    def test_transfer_tuning(self):
+        sdhs_secret = {'transfer_profile': {'request_size': 65536}}
+        tuning = parse_transfer_tuning({'transfer_profile': {'auto_tune': True}}, sdhs_secret)
+        self.assertEqual(65536, tuning.request_size)
+        self.assertTrue(tuning.auto_tune)
+        self.assertTrue(tuning.pipelined)
+        with self.assertRaises(utils.DetailedValueError):
+            parse_transfer_tuning({'transfer_profile': {'window_size': 1}}, sdhs_secret)
+
+        # 1 Gbit/s link with a 100 ms RTT: 12.5 MB must be in flight
+        tuned = auto_tune(tuning._replace(bandwidth=125000000), 0.1)
+        self.assertEqual(125000, tuned.request_size)
+        self.assertGreaterEqual(tuned.request_size * SFTP_PIPELINE_DEPTH, 12500000)
+        self.assertEqual(SFTP_MAX_REQUEST_SIZE, auto_tune(tuning._replace(bandwidth=125000000), 1).request_size)
+        self.assertEqual(SFTP_MIN_REQUEST_SIZE, auto_tune(tuning, 0.001).request_size)
+
     def test_update_status_of_processed_item(self):
         key = 'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp4'
         r = self.ddb_client.update_item(STATUS_TABLE, key, {
@@ -74,6 +108,23 @@ class TestTransferManager(test_utils.SdhsTransferTestCase):
         result = self.transfer_manager.update_status_of_processed_item(item, key)
         self.assertEqual(HTTPStatus.OK, result['ResponseMetadata']['HTTPStatusCode'])
 
+    def test_transfer_digest_multipart_etag(self):
+        data = os.urandom(100000)
+        part_size = 30000
+        part_digests = [hashlib.md5(data[i:i + part_size]).digest() for i in range(0, len(data), part_size)]
+        expected_etag = f'{hashlib.md5(b"".join(part_digests)).hexdigest()}-{len(part_digests)}'
+        digest = TransferDigest(part_size=part_size)
+        for i in range(0, len(data), 7777):
+            digest.update(data[i:i + 7777])
+        self.assertEqual(expected_etag, digest.etag)
+        self.assertEqual(hashlib.sha256(data).hexdigest(), digest.sha256.hexdigest())
+        self.assertEqual('passed', digest.verify(S3ObjectInfo(len(data), expected_etag, part_size, None)))
+        self.assertEqual('failed', digest.verify(S3ObjectInfo(len(data), expected_etag, part_size, 'stored-checksum')))
+        # ETags of SSE-KMS objects, and of multipart objects whose parts are not uniform, cannot be reproduced
+        self.assertEqual('unverifiable', digest.verify(
+            S3ObjectInfo(len(data), expected_etag, part_size, None, etag_is_md5=False)))
+        self.assertEqual('unverifiable', digest.verify(S3ObjectInfo(len(data), expected_etag, None, None)))
+
     def test_transfer_file(self):
         file_keys = [
             'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp3',
@@ -84,6 +135,140 @@ class TestTransferManager(test_utils.SdhsTransferTestCase):
             self.mark_audio_extraction_submitted(k.replace('.mp3', '.mp4'))
             result = self.transfer_manager.transfer_file(k, bucket_name)
             self.assertEqual(HTTPStatus.OK, result['ResponseMetadata']['HTTPStatusCode'])
+            item = self.ddb_client.get_item(STATUS_TABLE, k.replace('.mp3', '.mp4'))
+            self.assertEqual('passed', item['sdhs_integrity_check'])
+
+    def test_transfer_file_skips_duplicate_event(self):
+        file_key = 'bf67ce1c-757a-46d6-bed6-13d50e1ff0b5/video/2526a433-58d7-4368-921e-7d85cb042c69.mp3'
+        status_key = file_key.replace('.mp3', '.mp4')
+        bucket_name = f'{STACK_NAME}-{utils.get_environment_name()}-interview-audio'
+        self.mark_audio_extraction_submitted(status_key)
+        self.transfer_manager.transfer_file(file_key, bucket_name)
+        item = self.ddb_client.get_item(STATUS_TABLE, status_key)
+        self.assertEqual('processed', item['processing_status'])
+
+        # a second ObjectCreated event for the same file must not fail nor transfer it again
+        result = self.transfer_manager.transfer_file(file_key, bucket_name)
+        self.assertEqual(HTTPStatus.OK, result['ResponseMetadata']['HTTPStatusCode'])
+        updated_item = self.ddb_client.get_item(STATUS_TABLE, status_key)
+        self.assertEqual(item['sdhs_transfer_attempts'], updated_item['sdhs_transfer_attempts'])
+        self.assertEqual(item.get('sdhs_duplicate_events', 0) + 1, updated_item['sdhs_duplicate_events'])
+
+        # researchers may have moved the delivered file; a duplicate event must still not upload it again
+        profile = sftp_profile_registry.get_profile(item['project_acronym'])
+        with sftp_connection_pool.connection(profile) as sftp:
+            sftp.remove(f"{item['target_basename']}.mp3")
+        self.transfer_manager.transfer_file(file_key, bucket_name)
+        moved_item = self.ddb_client.get_item(STATUS_TABLE, status_key)
+        self.assertEqual(item['sdhs_transfer_attempts'], moved_item['sdhs_transfer_attempts'])
+        self.assertEqual(updated_item['sdhs_duplicate_events'] + 1, moved_item['sdhs_duplicate_events'])
+
+    def test_transfer_file_resumes_partial_upload(self):
+        file_key = 'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp3'
+        status_key = file_key.replace('.mp3', '.mp4')
+        bucket_name = f'{STACK_NAME}-{utils.get_environment_name()}-interview-audio'
+        self.mark_audio_extraction_submitted(status_key)
+        item = self.transfer_manager.get_item_and_validate_status(status_key)
+        target_filename = f"{item['target_basename']}.mp3"
+        partial_filename = get_partial_filename(target_filename, 'interrupted')
+        engine = self.transfer_manager.transfer_engine
+        object_size = engine.get_object_size(bucket_name, file_key)
+        profile = sftp_profile_registry.get_profile(item['project_acronym'])
+
+        # upload the first half of the file, as an interrupted transfer that started an hour ago would
+        with sftp_connection_pool.connection(profile) as sftp:
+            if sftp.exists(target_filename):  # delivered by an earlier test
+                sftp.remove(target_filename)
+            with sftp.sftp_client.open(partial_filename, 'wb') as f:
+                engine.transfer(bucket_name, file_key, f, object_size=object_size // 2)
+            self.assertEqual(object_size // 2, engine.get_resume_offset(sftp.sftp_client, partial_filename, bucket_name, file_key, object_size))
+        self.ddb_client.update_item(
+            table_name=STATUS_TABLE,
+            key=status_key,
+            name_value_pairs={
+                "sdhs_partial_filename": partial_filename,
+                "sdhs_transfer_started": str(utils.now_with_tz() - datetime.timedelta(hours=1)),
+                "sdhs_etag": None,
+                "sdhs_sha256": None,
+            },
+        )
+        item = self.transfer_manager.get_item_and_validate_status(status_key)
+        self.assertEqual(partial_filename, self.transfer_manager.get_resumable_partial(item))
+
+        result = self.transfer_manager.transfer_file(file_key, bucket_name)
+        self.assertEqual(HTTPStatus.OK, result['ResponseMetadata']['HTTPStatusCode'])
+        updated_item = self.ddb_client.get_item(STATUS_TABLE, status_key)
+        self.assertEqual(item['sdhs_transfer_attempts'] + 1, updated_item['sdhs_transfer_attempts'])
+        self.assertEqual(object_size, updated_item['sdhs_bytes_transferred'])
+        self.assertEqual('passed', updated_item['sdhs_integrity_check'])
+        with sftp_connection_pool.connection(profile) as sftp:
+            self.assertEqual(object_size, sftp.stat(target_filename).st_size)
+            self.assertFalse(sftp.exists(partial_filename))
+
+    def test_partial_of_recent_attempt_is_not_resumed(self):
+        item = {
+            'sdhs_partial_filename': get_partial_filename('target.mp3', '1-0a1b2c3d'),
+            'sdhs_transfer_started': str(utils.now_with_tz() - datetime.timedelta(minutes=5)),
+        }
+        self.assertIsNone(self.transfer_manager.get_resumable_partial(item))
+
+    def test_is_unsupported_operation(self):
+        self.assertTrue(is_unsupported_operation(IOError('Operation unsupported')))
+        self.assertFalse(is_unsupported_operation(PermissionError(13, 'Permission denied')))
+        self.assertFalse(is_unsupported_operation(FileNotFoundError(2, 'No such file')))
+        self.assertFalse(is_unsupported_operation(IOError('Failure')))
+
+    def test_write_view_to_unbuffered_sftp_file(self):
+        """
+        The zero-copy transfer path relies on paramiko accepting memoryviews in SFTPFile.write
+        """
+        data = bytearray(os.urandom(1024 * 1024))
+        profile = sftp_profile_registry.get_profile('unittest-1')
+        with sftp_connection_pool.connection(profile) as sftp:
+            with sftp.sftp_client.open('write_view.bin', 'wb', bufsize=0) as f:
+                write_view(f, memoryview(data)[:len(data) // 2])
+                write_view(f, memoryview(data)[len(data) // 2:])
+            with sftp.sftp_client.open('write_view.bin', 'rb') as f:
+                self.assertEqual(data, f.read())
+            sftp.remove('write_view.bin')
+
+    def test_remove_stale_partials(self):
+        profile = sftp_profile_registry.get_profile('unittest-1')
+        with sftp_connection_pool.connection(profile) as sftp:
+            with sftp.sftp_client.open('stale.mp3.partial', 'wb') as f:
+                f.write(b'stale')
+            with sftp.sftp_client.open('fresh.mp3.partial', 'wb') as f:
+                f.write(b'fresh')
+            one_week_ago = time.time() - 7 * 24 * 60 * 60
+            sftp.sftp_client.utime('stale.mp3.partial', (one_week_ago, one_week_ago))
+            self.assertEqual(['stale.mp3.partial'], remove_stale_partials(sftp.sftp_client))
+            self.assertTrue(sftp.exists('fresh.mp3.partial'))
+            sftp.remove('fresh.mp3.partial')
+
+    def test_transfer_files_reports_failures_independently(self):
+        file_keys = [
+            'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp3',
+            'bf67ce1c-757a-46d6-bed6-13d50e1ff0b5/video/2526a433-58d7-4368-921e-7d85cb042c69.mp3',
+        ]
+        non_existent_key = '00000000-0000-0000-0000-000000000000/video/00000000-0000-0000-0000-000000000000.mp3'
+        bucket_name = f'{STACK_NAME}-{utils.get_environment_name()}-interview-audio'
+        for k in file_keys:
+            self.mark_audio_extraction_submitted(k.replace('.mp3', '.mp4'))
+        failures = self.transfer_manager.transfer_files([(x, bucket_name) for x in file_keys + [non_existent_key]])
+        self.assertEqual([non_existent_key], list(failures.keys()))
+        self.assertIsInstance(failures[non_existent_key], utils.ObjectDoesNotExistError)
+        for k in file_keys:
+            item = self.ddb_client.get_item(STATUS_TABLE, k.replace('.mp3', '.mp4'))
+            self.assertEqual('processed', item['processing_status'])
+
+    def test_transfer_files_defers_files_past_deadline(self):
+        file_key = 'f21d28a7-d3a5-42bf-8771-5d205ab67dcb/video/61ca75b6-2c2e-4d32-a8a6-300bf7fd6fa1.mp3'
+        bucket_name = f'{STACK_NAME}-{utils.get_environment_name()}-interview-audio'
+        self.mark_audio_extraction_submitted(file_key.replace('.mp3', '.mp4'))
+        failures = self.transfer_manager.transfer_files([(file_key, bucket_name)], deadline=time.monotonic() - 1)
+        self.assertEqual([file_key], list(failures.keys()))
+        item = self.ddb_client.get_item(STATUS_TABLE, file_key.replace('.mp3', '.mp4'))
+        self.assertEqual('audio extraction job submitted', item['processing_status'])
 
     @unittest.skipUnless(os.environ['TEST_ON_AWS'] == 'True', 'Invokes lambda on AWS')
     def test_transfer_file_working_on_aws(self):